@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# The modules of warp import each other by their bare names, as warp.py and
+# server.py are run from their directory.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "warp"))
+# Keeps the hash cache and the rest of ~/.warp out of the user's home.
+os.environ["HOME"] = tempfile.mkdtemp(prefix="warp-tests-")
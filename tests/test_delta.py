@@ -0,0 +1,174 @@
+import logging
+import os
+
+import pytest
+
+import delta
+from delta import apply_delta, compute_delta, signature
+
+BLOCK = delta.DELTA_MIN_BLOCK_SIZE
+
+
+@pytest.fixture(params=["numpy", "no numpy"])
+def rolling(request, monkeypatch):
+    """
+    Runs a test with the rolling checksum, then with blocks only compared
+    at block boundaries.
+    """
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+        return True
+    monkeypatch.setattr(delta, "numpy", None)
+    return False
+
+
+def data(length):
+    return os.urandom(length)
+
+
+def send(tmp_path, source, dest):
+    """
+    Brings dest up to date with source the way a delta transfer does.
+    Returns how many bytes had to be sent.
+    """
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    src.write_bytes(source)
+    dst.write_bytes(dest)
+    copies, literals = compute_delta(
+        str(src),
+        BLOCK,
+        signature(str(dst), BLOCK, "sha256"),
+        len(dest),
+        "sha256",
+    )
+    apply_delta(str(dst), copies, len(source))
+    with open(dst, "r+b") as f:
+        for offset, length in literals:
+            f.seek(offset)
+            f.write(source[offset : offset + length])
+    assert dst.read_bytes() == source
+    assert not os.path.exists(str(dst) + ".warp-part")
+    return sum(length for _, length in literals)
+
+
+def test_identical(tmp_path, rolling):
+    base = data(20 * BLOCK + 123)
+    assert send(tmp_path, base, base) == 0
+
+
+def test_changed_in_place(tmp_path, rolling):
+    base = data(20 * BLOCK)
+    changed = bytearray(base)
+    changed[3 * BLOCK + 10] ^= 0xFF
+    changed[11 * BLOCK + 500] ^= 0xFF
+    assert send(tmp_path, bytes(changed), base) == 2 * BLOCK
+
+
+@pytest.mark.parametrize("length", [6, BLOCK + 5000])
+def test_inserted_at_the_start(tmp_path, rolling, length):
+    base = data(20 * BLOCK + 777)
+    sent = send(tmp_path, data(length) + base, base)
+    if rolling:
+        assert sent == length
+    else:
+        assert sent >= 19 * BLOCK
+
+
+def test_deleted_at_the_start(tmp_path, rolling):
+    base = data(20 * BLOCK + 777)
+    sent = send(tmp_path, base[5000:], base)
+    if rolling:
+        assert sent < BLOCK
+    else:
+        assert sent >= 19 * BLOCK
+
+
+def test_inserted_in_the_middle(tmp_path, rolling):
+    base = data(20 * BLOCK)
+    sent = send(
+        tmp_path,
+        base[: 7 * BLOCK + 3] + b"x" * 40 + base[7 * BLOCK + 3 :],
+        base,
+    )
+    if rolling:
+        assert sent < 2 * BLOCK
+    else:
+        assert sent > 12 * BLOCK
+
+
+def test_swapped_halves(tmp_path, rolling):
+    base = data(20 * BLOCK)
+    sent = send(tmp_path, base[10 * BLOCK :] + base[: 10 * BLOCK], base)
+    # Block-aligned, found either way.
+    assert sent == 0
+
+
+def test_swapped_unaligned_halves(tmp_path, rolling):
+    base = data(20 * BLOCK + 777)
+    half = 10 * BLOCK + 300
+    sent = send(tmp_path, base[half:] + base[:half], base)
+    if rolling:
+        assert sent < 2 * BLOCK
+
+
+def test_appended_and_truncated(tmp_path, rolling):
+    base = data(20 * BLOCK)
+    assert send(tmp_path, base + data(5000), base) == 5000
+    assert send(tmp_path, base[: 10 * BLOCK + 5], base) == 5
+    # A short last block only matches at the end of the file.
+    base += data(777)
+    assert send(tmp_path, base + data(5000), base) == 5777
+
+
+def test_empty_destination(tmp_path, rolling):
+    assert send(tmp_path, data(3 * BLOCK), b"") == 3 * BLOCK
+
+
+def write(tmp_path, content, mode=0o600):
+    path = tmp_path / "f"
+    path.write_bytes(content)
+    os.chmod(path, mode)
+    return str(path)
+
+
+def test_apply_moves_backward_in_place(tmp_path):
+    path = write(tmp_path, b"xxAAAABBBB")
+    inode = os.stat(path).st_ino
+    apply_delta(path, ((0, 2, 8),), 8)
+    assert open(path, "rb").read() == b"AAAABBBB"
+    assert os.stat(path).st_ino == inode
+
+
+def test_apply_moves_forward_in_place(tmp_path, monkeypatch):
+    # Small chunks, so the overlapping move takes several.
+    monkeypatch.setattr(delta, "IO_BUFFER_SIZE", 3)
+    path = write(tmp_path, b"AAAABBBBCC")
+    inode = os.stat(path).st_ino
+    apply_delta(path, ((2, 0, 8), (12, 8, 2)), 14)
+    assert open(path, "rb").read() == b"AAAAAABBBB\0\0CC"
+    assert os.stat(path).st_ino == inode
+
+
+def test_apply_mixed_moves_into_new_file(tmp_path):
+    path = write(tmp_path, b"AAAABBBBCCCC", 0o640)
+    apply_delta(path, ((0, 8, 4), (4, 4, 4), (8, 0, 4)), 12)
+    assert open(path, "rb").read() == b"CCCCBBBBAAAA"
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert not os.path.exists(path + ".warp-part")
+
+
+def test_apply_failure_leaves_no_part_file(tmp_path):
+    path = write(tmp_path, b"AAAABBBB")
+    with pytest.raises(EOFError):
+        apply_delta(path, ((0, 4, 4), (4, 0, 4), (8, 100, 4)), 12)
+    assert open(path, "rb").read() == b"AAAABBBB"
+    assert not os.path.exists(path + ".warp-part")
+
+
+def test_warns_once_without_numpy(monkeypatch, caplog):
+    monkeypatch.setattr(delta, "numpy", None)
+    monkeypatch.setattr(delta, "_warned", False)
+    with caplog.at_level(logging.WARNING):
+        delta.warn_without_numpy()
+        delta.warn_without_numpy()
+    assert sum("NumPy" in record.message for record in caplog.records) == 1
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from common_tools import ThroughputMeter
+from config import MIN_BLOCK_SIZE
+from file_transfer_agent import FileTransferAgent
+from merkle import BlockTree
+from transfer_manager import TransferManager
+
+BLOCK = MIN_BLOCK_SIZE
+
+
+class LocalPool:
+    # What FileTransferAgent needs of a DataConnectionPool to compare
+    # copies, without data connections.
+    hash_algorithm = "sha256"
+
+    def __init__(self):
+        self.meter = ThroughputMeter()
+
+    def block_tree(self, file_src, block_size, length) -> BlockTree:
+        return BlockTree.from_file(file_src, block_size, length, self.hash_algorithm)
+
+
+@pytest.fixture
+def copies(tmp_path):
+    """
+    Writes the source and destination, returns an agent between them.
+    """
+
+    def make(source, dest):
+        src, dst = tmp_path / "src", tmp_path / "dst"
+        src.write_bytes(source)
+        dst.write_bytes(dest)
+        agent = FileTransferAgent(
+            LocalPool(),
+            TransferManager(),
+            str(src),
+            str(dst),
+            False,
+            False,
+            False,
+        )
+        agent.block_size = BLOCK
+        return agent
+
+    return make
+
+
+def data(blocks, extra=0):
+    return os.urandom(blocks * BLOCK + extra)
+
+
+def test_complete(copies):
+    source = data(4)
+    agent = copies(source, source)
+    assert agent.find_resume_block() is None
+
+
+def test_shorter_resumes_after_last_block(copies):
+    source = data(4, 100)
+    agent = copies(source, source[: 2 * BLOCK + 10])
+    assert agent.find_resume_block() == 2
+    assert os.path.getsize(agent.file_dest) == 2 * BLOCK
+
+
+def test_corrupted_resumes_from_first_difference(copies):
+    source = data(8)
+    dest = bytearray(source)
+    dest[5 * BLOCK + 7] ^= 0xFF
+    agent = copies(source, bytes(dest))
+    assert agent.find_resume_block() == 5
+    assert os.path.getsize(agent.file_dest) == 5 * BLOCK
+
+
+@pytest.mark.parametrize("extra", [0, 100])
+def test_longer_is_cut_to_source(copies, extra):
+    # The server's copy starts with the whole source, block-aligned or not.
+    source = data(4, extra)
+    agent = copies(source, source + b"x" * 16000)
+    assert agent.find_resume_block() == 4
+    assert os.path.getsize(agent.file_dest) == 4 * BLOCK
+
+
+def test_longer_block_aligned_sends_nothing_and_succeeds(copies):
+    source = data(64)
+    agent = copies(source, source + b"x" * 16000)
+    assert agent.base_server_validated_size == len(source)
+    assert agent.send_data() is False
+    assert agent.transfer_success
+    with open(agent.file_dest, "rb") as f:
+        assert f.read() == source
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from hash_cache import HashCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HashCache(str(tmp_path / "cache" / "hashes.sqlite3"))
+
+
+@pytest.fixture
+def counted():
+    """
+    A compute function that counts its calls and returns the call number.
+    """
+    calls = []
+
+    def compute():
+        calls.append(None)
+        return b"value %d" % len(calls)
+
+    compute.calls = calls
+    return compute
+
+
+def test_unchanged_file_is_computed_once(cache, counted, tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"data")
+    assert cache.cached(str(path), "kind", counted) == b"value 1"
+    assert cache.cached(str(path), "kind", counted) == b"value 1"
+    assert cache.lookup(str(path), "kind") == b"value 1"
+    assert len(counted.calls) == 1
+
+
+def test_kinds_are_cached_apart(cache, counted, tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"data")
+    assert cache.cached(str(path), "a", counted) == b"value 1"
+    assert cache.cached(str(path), "b", counted) == b"value 2"
+    assert cache.lookup(str(path), "c") is None
+
+
+def test_modified_file_is_computed_again(cache, counted, tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"data")
+    cache.cached(str(path), "kind", counted)
+    # Same size, later mtime.
+    path.write_bytes(b"DATA")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert cache.lookup(str(path), "kind") is None
+    assert cache.cached(str(path), "kind", counted) == b"value 2"
+    # Another size.
+    path.write_bytes(b"more data")
+    assert cache.cached(str(path), "kind", counted) == b"value 3"
+
+
+def test_replaced_file_is_computed_again(cache, counted, tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"data")
+    cache.cached(str(path), "kind", counted)
+    st = os.stat(path)
+    other = tmp_path / "g"
+    other.write_bytes(b"DATA")
+    os.utime(other, ns=(st.st_atime_ns, st.st_mtime_ns))
+    # Keeps the first file's inode from being reused for the second.
+    os.rename(path, tmp_path / "kept")
+    os.rename(other, path)
+    assert cache.cached(str(path), "kind", counted) == b"value 2"
+
+
+def test_unusable_directory_falls_back_to_computing(counted, tmp_path):
+    # The cache's directory would have to be made under a regular file.
+    (tmp_path / "home").write_bytes(b"")
+    cache = HashCache(str(tmp_path / "home" / ".warp" / "hashes.sqlite3"))
+    path = tmp_path / "f"
+    path.write_bytes(b"data")
+    assert cache.cached(str(path), "kind", counted) == b"value 1"
+    assert cache.disabled
+    assert cache.cached(str(path), "kind", counted) == b"value 2"
+    assert cache.lookup(str(path), "kind") is None
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = HashCache(str(tmp_path / "hashes.sqlite3"), max_bytes=1000)
+    paths = []
+    for i in range(10):
+        path = tmp_path / ("f%d" % i)
+        path.write_bytes(b"%d" % i)
+        paths.append(str(path))
+        cache.cached(paths[-1], "kind", lambda: bytes(200))
+        # The first file stays in use.
+        assert cache.lookup(paths[0], "kind") is not None
+    assert cache._size <= 1000
+    assert cache.lookup(paths[0], "kind") is not None
+    assert cache.lookup(paths[1], "kind") is None
+    assert cache.lookup(paths[-1], "kind") is not None
@@ -0,0 +1,48 @@
+import pytest
+
+from hashing import digest
+from merkle import BlockTree
+
+
+def leaves(count, changed=()):
+    return [
+        digest("sha256", b"%d%s" % (i, b"!" if i in changed else b""))
+        for i in range(count)
+    ]
+
+
+def first_difference(local, remote):
+    asked = []
+
+    def remote_nodes(level, indices):
+        asked.append(len(indices))
+        return remote.nodes(level, indices)
+
+    index = local.first_difference(remote_nodes)
+    # One round trip per level below the root, at most two nodes each.
+    assert len(asked) == local.height - 1
+    return index
+
+
+@pytest.mark.parametrize("count", [2, 3, 8, 13])
+def test_finds_the_first_differing_block(count):
+    tree = BlockTree(leaves(count))
+    for block in range(count):
+        changed = BlockTree(leaves(count, {block, count - 1}))
+        assert changed.root != tree.root
+        assert first_difference(tree, changed) == block
+        assert first_difference(changed, tree) == block
+
+
+def test_same_blocks_same_root():
+    assert BlockTree(leaves(13)).root == BlockTree(leaves(13)).root
+    assert BlockTree([]).root == BlockTree([]).root
+
+
+def test_from_file(tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(bytes(10000))
+    tree = BlockTree.from_file(str(path), 1000, 9500)
+    assert len(tree.levels[0]) == 10
+    assert BlockTree.cached_root(str(path), 1000, 9500) == tree.root
+    assert BlockTree.cached_root(str(path), 1000, 9000) is None
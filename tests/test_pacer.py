@@ -0,0 +1,49 @@
+import multiprocessing
+import time
+
+from pacer import Pacer
+
+
+def _consume(pacer, started, nbytes):
+    started.set()
+    pacer.consume(nbytes)
+
+
+def test_shared_pacer_is_shared_with_forked_processes():
+    context = multiprocessing.get_context("fork")
+    pacer = Pacer(16 << 20, shared=True)
+    started = context.Event()
+    # The worker goes far into debt, its bytes count against the parent.
+    worker = context.Process(target=_consume, args=(pacer, started, 4 << 20))
+    worker.start()
+    started.wait()
+    worker.join(10)
+    assert pacer.sent == 4 << 20
+    assert pacer.tokens < -(2 << 20)
+
+
+def _report_rate(pacer, changed, rates):
+    changed.wait(10)
+    rates.put(pacer.rate)
+
+
+def test_shared_pacer_follows_the_parent_rate():
+    context = multiprocessing.get_context("fork")
+    pacer = Pacer(1 << 20, shared=True)
+    changed = context.Event()
+    rates = context.Queue()
+    worker = context.Process(target=_report_rate, args=(pacer, changed, rates))
+    worker.start()
+    pacer.scale(0.5)
+    changed.set()
+    assert rates.get(timeout=10) == 1 << 19
+    worker.join(10)
+
+
+def test_pacer_caps_the_rate():
+    pacer = Pacer(8 << 20)
+    start = time.monotonic()
+    for _ in range(8):
+        pacer.consume(1 << 20)
+    # The first burst goes through at once, the rest at 8 MiB/s.
+    assert time.monotonic() - start >= 0.8
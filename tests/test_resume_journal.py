@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+from resume_journal import ResumeJournal
+
+BLOCK = 1000
+# 20 blocks, the last one short.
+SIZE = 19 * BLOCK + 300
+MTIME = 1234567890123456789
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    # Each test starts as a new process would, with no journal open.
+    monkeypatch.setattr(ResumeJournal, "_registry", {})
+
+
+@pytest.fixture
+def filepath(tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"")
+    return str(path)
+
+
+def forget():
+    ResumeJournal._registry.clear()
+
+
+def test_create_counts_the_blocks_done(filepath):
+    journal = ResumeJournal.create(filepath, SIZE, BLOCK, MTIME, 10 * BLOCK)
+    assert journal.missing() == [(10 * BLOCK, SIZE - 10 * BLOCK)]
+    assert journal.remaining == 10
+    assert os.path.exists(journal.journal_path)
+    assert ResumeJournal.opened(filepath, SIZE) is journal
+    assert ResumeJournal.opened(filepath, SIZE + 1) is None
+
+
+def test_blocks_are_recorded_on_commit(filepath):
+    journal = ResumeJournal.create(filepath, SIZE, BLOCK, MTIME)
+    # Block 3 in two writes, blocks 9 to 16 across the bitmap's bytes, half
+    # of block 17, and the short last block.
+    journal.received(3 * BLOCK, 400)
+    journal.received(3 * BLOCK + 400, 600)
+    journal.received(9 * BLOCK, 8 * BLOCK + 500)
+    journal.received(19 * BLOCK, 300)
+    assert journal.missing() == [(0, SIZE)]
+    assert journal.commit() is False
+    assert journal.missing() == [
+        (0, 3 * BLOCK),
+        (4 * BLOCK, 5 * BLOCK),
+        (17 * BLOCK, 2 * BLOCK),
+    ]
+    assert journal.remaining == 20 - 10
+
+
+def test_saved_journal_is_loaded_back(filepath):
+    journal = ResumeJournal.create(filepath, SIZE, BLOCK, MTIME)
+    journal.received(5 * BLOCK, 3 * BLOCK)
+    journal.commit()
+    forget()
+    loaded = ResumeJournal.load(filepath, SIZE, MTIME)
+    assert loaded is not journal
+    assert loaded.missing() == journal.missing()
+    assert loaded.remaining == journal.remaining
+
+
+def test_partial_blocks_are_dropped_on_load(filepath):
+    journal = ResumeJournal.create(filepath, SIZE, BLOCK, MTIME)
+    journal.received(0, 500)
+    assert ResumeJournal.load(filepath, SIZE, MTIME) is journal
+    # The rest of block 0 alone doesn't complete it.
+    journal.received(500, 500)
+    journal.commit()
+    assert journal.missing() == [(0, SIZE)]
+
+
+def test_last_commit_removes_the_journal(filepath):
+    journal = ResumeJournal.create(filepath, SIZE, BLOCK, MTIME, 19 * BLOCK)
+    journal.received(19 * BLOCK, 300)
+    assert journal.commit() is True
+    assert not os.path.exists(journal.journal_path)
+    assert ResumeJournal.opened(filepath, SIZE) is None
+    assert ResumeJournal.load(filepath, SIZE, MTIME) is None
+
+
+def test_no_journal(filepath):
+    assert ResumeJournal.load(filepath, SIZE, MTIME) is None
+
+
+@pytest.mark.parametrize("size, mtime", [(SIZE + 1, MTIME), (SIZE, MTIME + 1)])
+def test_journal_of_another_source_is_ignored(filepath, size, mtime):
+    ResumeJournal.create(filepath, SIZE, BLOCK, MTIME, 5 * BLOCK)
+    assert ResumeJournal.load(filepath, size, mtime) is None
+    forget()
+    assert ResumeJournal.load(filepath, size, mtime) is None
+
+
+def test_journal_of_a_replaced_destination_is_ignored(filepath, tmp_path):
+    ResumeJournal.create(filepath, SIZE, BLOCK, MTIME, 5 * BLOCK)
+    forget()
+    # Keeps the old inode from being reused for the new file.
+    os.rename(filepath, str(tmp_path / "kept"))
+    with open(filepath, "wb"):
+        pass
+    assert ResumeJournal.load(filepath, SIZE, MTIME) is None
+
+
+def test_corrupt_journal_is_ignored(filepath):
+    journal = ResumeJournal.create(filepath, SIZE, BLOCK, MTIME, 5 * BLOCK)
+    forget()
+    with open(journal.journal_path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"\xff")
+    assert ResumeJournal.load(filepath, SIZE, MTIME) is None
+    with open(journal.journal_path, "wb") as f:
+        f.write(b"WARPJNL1")
+    assert ResumeJournal.load(filepath, SIZE, MTIME) is None
+
+
+def test_empty_file(filepath):
+    journal = ResumeJournal.create(filepath, 0, BLOCK, MTIME)
+    assert journal.missing() == []
+    assert journal.remaining == 0
+    forget()
+    assert ResumeJournal.load(filepath, 0, MTIME) is not None
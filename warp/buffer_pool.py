@@ -0,0 +1,34 @@
+import threading
+from typing import List
+
+from config import BUFFER_POOL_SIZE, IO_BUFFER_SIZE
+
+
+class BufferPool:
+    """
+    A free list of preallocated bytearrays for the data path. Buffers are
+    taken with acquire and handed back with release, so a transfer reuses the
+    same memory for every chunk instead of allocating a new object per recv.
+    At most `count` idle buffers are kept around.
+    """
+
+    def __init__(self, count=BUFFER_POOL_SIZE, size=IO_BUFFER_SIZE):
+        self.count = count
+        self.size = size
+        self._lock = threading.Lock()
+        self._free: List[bytearray] = [bytearray(size) for _ in range(count)]
+
+    def acquire(self) -> bytearray:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buf: bytearray):
+        with self._lock:
+            if (
+                isinstance(buf, bytearray)
+                and len(buf) == self.size
+                and len(self._free) < self.count
+            ):
+                self._free.append(buf)
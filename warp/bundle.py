@@ -0,0 +1,214 @@
+"""
+Bundles: many small files packed into one stream, so that they travel as a
+single transfer instead of each paying for its own round trips. The stream
+is a sequence of entries, each made of a BUNDLE_ENTRY header (path length,
+permission bits, mtime in nanoseconds and data length), the UTF-8 path of the
+file relative to the bundle's destination directory, and the file's data.
+It is sent over one data connection as FRAME_BUNDLE frames, and unpacked by
+the server as the frames arrive.
+"""
+
+import os
+import stat
+import struct
+from typing import List, Optional, Tuple, Union
+
+from config import BUNDLE_COMMIT_FILES, IO_BUFFER_SIZE, logger
+from framing import FRAME_BUNDLE
+from hashing import digest, new_hash
+
+BUNDLE_ENTRY = struct.Struct("!HIQQ")
+
+# Suffix of the files of a bundle that are unpacked but not committed yet.
+PART_SUFFIX = ".warp-part"
+
+
+class BundleWriter:
+    """
+    Packs files into a bundle stream and sends it over a data connection.
+    When verifying, each file's data is hashed with algorithm.
+    """
+
+    def __init__(self, connection, bundle_id, verify, algorithm="sha256"):
+        self.connection = connection
+        self.bundle_id = bundle_id
+        self.verify = verify
+        self.algorithm = algorithm
+        self.buf = bytearray()
+        # Bytes of the stream sent so far.
+        self.offset = 0
+        self.digests: List[str] = []
+
+    def add(self, file_src, rel_path) -> int:
+        """
+        Adds file_src to the bundle, to be unpacked at rel_path. Returns the
+        size of its data.
+        """
+        with open(file_src, "rb") as f:
+            data = f.read()
+            mode = stat.S_IMODE(os.fstat(f.fileno()).st_mode)
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        name = rel_path.encode("utf-8")
+        self.buf += BUNDLE_ENTRY.pack(len(name), mode, mtime_ns, len(data))
+        self.buf += name
+        self.buf += data
+        if self.verify:
+            self.digests.append(digest(self.algorithm, data).hex())
+        if len(self.buf) >= IO_BUFFER_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buf:
+            return
+        self.connection.send_payload(
+            FRAME_BUNDLE, self.bundle_id, self.offset, self.buf
+        )
+        self.offset += len(self.buf)
+        self.buf.clear()
+
+
+class BundleReader:
+    """
+    Unpacks a bundle stream under dest_root as it is fed. Each file is
+    written under a temporary name, and files are moved into place in batches
+    of BUNDLE_COMMIT_FILES. results holds, per entry in stream order, the
+    hash of its data with algorithm when verifying (True otherwise), or None
+    if it could not be written.
+    """
+
+    def __init__(self, dest_root, copy_status, verify, sync="none", algorithm="sha256"):
+        self.dest_root = dest_root
+        self.copy_status = copy_status
+        self.verify = verify
+        self.algorithm = algorithm
+        # Files are flushed before being moved into place unless sync is
+        # "none", see SYNC_POLICIES.
+        self.sync = sync
+        self.results: List[Union[str, bool, None]] = []
+        self.header = bytearray()
+        # The entry being unpacked: its data length still to come, the
+        # destination file descriptor (None if it can't be written) etc.
+        self.remaining = 0
+        self.entry: Optional[Tuple[str, str, int, int]] = None
+        self.fd: Optional[int] = None
+        self.hash = None
+        self.ok = True
+        self.uncommitted: List[Tuple[str, str]] = []
+
+    def feed(self, data):
+        view = memoryview(data)
+        while view:
+            if self.entry is None:
+                view = self.read_header(view)
+                continue
+            n = min(len(view), self.remaining)
+            self.write(view[:n])
+            view = view[n:]
+            self.remaining -= n
+            if not self.remaining:
+                self.end_entry()
+
+    def read_header(self, view):
+        need = BUNDLE_ENTRY.size
+        if len(self.header) >= need:
+            need += BUNDLE_ENTRY.unpack_from(self.header)[0]
+        n = min(len(view), need - len(self.header))
+        self.header += view[:n]
+        view = view[n:]
+        if len(self.header) < BUNDLE_ENTRY.size:
+            return view
+        path_len, mode, mtime_ns, size = BUNDLE_ENTRY.unpack_from(self.header)
+        if len(self.header) < BUNDLE_ENTRY.size + path_len:
+            # Only the header is in, the path is still to come.
+            return view
+        path = self.header[BUNDLE_ENTRY.size :].decode("utf-8")
+        self.header.clear()
+        self.begin_entry(path, mode, mtime_ns, size)
+        return view
+
+    def begin_entry(self, path, mode, mtime_ns, size):
+        rel_path = os.path.normpath(path)
+        final_path = os.path.join(self.dest_root, rel_path)
+        self.entry = (final_path, final_path + PART_SUFFIX, mode, mtime_ns)
+        self.remaining = size
+        self.hash = new_hash(self.algorithm) if self.verify else None
+        self.ok = True
+        try:
+            if os.path.isabs(rel_path) or rel_path.split(os.sep)[0] == "..":
+                raise ValueError(path + " is outside the destination")
+            os.makedirs(os.path.dirname(final_path) or ".", exist_ok=True)
+            self.fd = os.open(
+                self.entry[1], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666
+            )
+        except (OSError, ValueError):
+            logger.exception("Can't unpack %s", path)
+            self.ok = False
+        if not size:
+            self.end_entry()
+
+    def write(self, data):
+        if self.hash is not None:
+            self.hash.update(data)
+        if self.fd is None:
+            return
+        try:
+            while data:
+                data = data[os.write(self.fd, data) :]
+        except OSError:
+            logger.exception("Can't write %s", self.entry[0])
+            self.ok = False
+            self.close_fd()
+
+    def close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def end_entry(self):
+        final_path, part_path, mode, mtime_ns = self.entry
+        if self.ok and self.fd is not None and self.sync != "none":
+            try:
+                os.fdatasync(self.fd)
+            except OSError:
+                logger.exception("Can't flush %s", final_path)
+                self.ok = False
+        self.close_fd()
+        if self.ok and self.copy_status:
+            try:
+                os.chmod(part_path, mode)
+                os.utime(part_path, ns=(mtime_ns, mtime_ns))
+            except OSError:
+                logger.exception("Can't set status of %s", final_path)
+                self.ok = False
+        if self.ok:
+            self.uncommitted.append((part_path, final_path))
+            self.results.append(
+                self.hash.hexdigest() if self.hash is not None else True
+            )
+        else:
+            self.results.append(None)
+        self.entry = None
+        if len(self.uncommitted) >= BUNDLE_COMMIT_FILES:
+            self.commit()
+
+    def commit(self):
+        """
+        Moves the files unpacked since the last commit into place.
+        """
+        for part_path, final_path in self.uncommitted:
+            os.replace(part_path, final_path)
+        self.uncommitted.clear()
+
+    def close(self):
+        """
+        Commits what was unpacked and drops a file left incomplete.
+        """
+        if self.entry is not None:
+            self.close_fd()
+            try:
+                os.remove(self.entry[1])
+            except OSError:
+                pass
+            self.entry = None
+        self.commit()
@@ -0,0 +1,82 @@
+from typing import List, Optional, Tuple
+
+from config import logger
+
+
+class BundleTransferAgent:
+    """
+    Sends a batch of small files as one bundle (see bundle.py): one stream
+    on one data connection and a couple of round trips for the whole batch,
+    instead of a validation, size and hash round trip per file. Exposes the
+    same progress attributes as FileTransferAgent.
+    """
+
+    def __init__(self, udt, dest_root, files, verify, stat):
+        self.udt = udt
+        self.dest_root = dest_root
+        # (source path, path relative to dest_root, size) of each file.
+        self.files: List[Tuple[str, str, int]] = files
+        self.verify = verify
+        self.stat = stat
+        self.is_transferring = False
+        self.transfer_finished = False
+        self.transfer_success = False
+        self.is_verifying = False
+        self.bundle_id: Optional[int] = None
+        # Why the transfer failed, as reported for manifest entries.
+        self.error: Optional[str] = None
+
+    @property
+    def file_count(self) -> int:
+        return len(self.files)
+
+    @property
+    def file_size(self) -> int:
+        return sum(size for _, _, size in self.files)
+
+    def get_progress(self):
+        if self.transfer_finished:
+            return self.file_size
+        if self.bundle_id is None:
+            return 0
+        # The stream also carries the entries' headers and paths.
+        return min(self.file_size, self.udt.get_total_recieved(self.bundle_id))
+
+    def send_file(self):
+        logger.debug("Bundling %d files into %s", self.file_count, self.dest_root)
+        self.bundle_id = self.udt.open_bundle(self.dest_root, self.stat, self.verify)
+        self.is_transferring = True
+        sources = []
+        try:
+            sources, digests, stream_size = self.udt.send_bundle(
+                self.bundle_id, self.files, self.verify
+            )
+        except Exception as e:
+            logger.exception("Could not send bundle to %s", self.dest_root)
+            self.error = "Could not send a bundle of %d files: %s" % (
+                self.file_count,
+                e,
+            )
+            self.udt.abort_file(self.bundle_id)
+            results = None
+        else:
+            results = self.udt.finish_bundle(self.bundle_id, stream_size)
+            if results is None:
+                self.error = "A bundle of %d files did not all arrive" % (
+                    self.file_count
+                )
+        self.is_transferring = False
+
+        self.transfer_success = results is not None and len(sources) == len(self.files)
+        if results is not None:
+            expected = digests if self.verify else [True] * len(results)
+            for file_src, result, wanted in zip(sources, results, expected):
+                if result != wanted:
+                    logger.error("%s was not received intact.", file_src)
+                    self.error = "%s was not received intact" % file_src
+                    self.transfer_success = False
+            if len(sources) < len(self.files):
+                self.error = "%d files of a bundle could not be read" % (
+                    len(self.files) - len(sources)
+                )
+        self.transfer_finished = True
@@ -1,15 +1,42 @@
 import os
 import threading
 from functools import reduce
-from multiprocessing.pool import ThreadPool
-from typing import List, Tuple
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
-from client_udt_manager import ClientUDTManager
-from common_tools import fail
-from config import logger
+from bundle_transfer_agent import BundleTransferAgent
+from common_tools import ThroughputMeter, fail
+from compression import AdaptiveCompressor
+from config import (
+    BUNDLE_MAX_BYTES,
+    BUNDLE_MAX_FILES,
+    PREPARE_BATCH_FILES,
+    logger,
+)
+from data_connection_pool import DataConnectionPool
+from dedup import find_duplicates
+from delta import warn_without_numpy
+from duplicate_transfer_agent import DuplicateTransferAgent
+from engine import TransferEngine
 from file_transfer_agent import FileTransferAgent
+from hashing import by_speed
+from metadata_batch import MetadataBatch
+from pacer import Pacer
+from process_pool import ProcessConnectionPool
 from rpyc import Connection
 
+TransferAgent = Union[
+    FileTransferAgent, BundleTransferAgent, DuplicateTransferAgent
+]
+
 
 class ClientTransferController:
     def __init__(
@@ -24,6 +51,16 @@ class ClientTransferController:
         parallelism,
         follow_links,
         stat,
+        stripes=1,
+        bundle_threshold=0,
+        compression=None,
+        bwlimit=0,
+        use_mmap=False,
+        sync="none",
+        processes=0,
+        delta=False,
+        dedup=False,
+        manifest=None,
     ):
         self.server_channel = server_channel
         self.hostname = hostname
@@ -31,12 +68,90 @@ class ClientTransferController:
         self.file_root_dest = file_dest
         self.file_dest = file_dest
         self.recursive = recursive
+        # The (source, destination) pairs sent in batch mode (see
+        # manifest.py), instead of file_src to file_dest. Directories among
+        # them are sent recursively.
+        self.manifest = manifest
+        self.entries: List[Tuple[str, str]] = (
+            [(file_src, file_dest)] if manifest is None else list(manifest)
+        )
+        # The agents of each entry, why those that couldn't be sent
+        # weren't, and the entry being started.
+        self.entry_agents: List[List[TransferAgent]] = [
+            [] for _ in self.entries
+        ]
+        self.entry_errors: Dict[int, str] = {}
+        self.entry = 0
         self.verify = not disable_verify
         self.tcp_mode = tcp_mode
         self.parallelism = parallelism
         self.follow_links = follow_links
         self.stat = stat
-        self.transfer_agents: List[FileTransferAgent] = []
+        self.stripes = stripes
+        # Whether files the server has are sent as deltas, see delta.py.
+        self.delta = delta
+        if delta:
+            warn_without_numpy()
+        # Whether duplicate files are only sent once, see dedup.py.
+        self.dedup = dedup
+        # The (source, relative path, hard link or not) of the duplicates
+        # of each file sent, the sources of all the duplicates, and those
+        # of the duplicates whose agent was started.
+        self.duplicates: Dict[str, List[Tuple[str, str, bool]]] = {}
+        self.duplicate_sources: Set[str] = set()
+        self.duplicates_submitted: Set[str] = set()
+        # Files smaller than this are sent in bundles, 0 disables bundling.
+        self.bundle_threshold = bundle_threshold
+        self.transfer_agents: List[TransferAgent] = []
+        # Send rates observed across the session, used to size the blocks of
+        # the files that follow.
+        self.meter = ThroughputMeter()
+        # (codec id, level) to compress the data stream with, or None.
+        self.compressor = None
+        if compression is not None:
+            self.compressor = AdaptiveCompressor(*compression, self.meter)
+        # Caps the combined send rate of all the connections, 0 for no cap,
+        # those of worker processes included.
+        self.pacer = Pacer(bwlimit, shared=bool(processes))
+        # Hash algorithm of the session, see hashing.py.
+        self.hash_algorithm = (
+            server_channel.root.get_transfer_manager().negotiate_hash(
+                by_speed()
+            )
+        )
+        # Data connections shared by all the files of the session, or
+        # worker processes with connections of their own.
+        if processes:
+            self.pool = ProcessConnectionPool(
+                server_channel,
+                hostname,
+                tcp_mode,
+                0,
+                self.meter,
+                use_mmap=use_mmap,
+                sync=sync,
+                hash_algorithm=self.hash_algorithm,
+                processes=processes,
+                compression=compression,
+                pacer=self.pacer,
+            )
+        else:
+            self.pool = DataConnectionPool(
+                server_channel,
+                hostname,
+                tcp_mode,
+                max(parallelism, stripes),
+                self.meter,
+                self.compressor,
+                self.pacer,
+                use_mmap,
+                sync,
+                self.hash_algorithm,
+            )
+        # Runs the agents, parallelism of them sending at once.
+        self.engine = TransferEngine(parallelism)
+        # Times and modes of the files received, set in batches.
+        self.metadata = None
         self.start_success = None
 
         self.files_processed = 0
@@ -49,92 +164,250 @@ class ClientTransferController:
         return start_thread
 
     def _start(self):
-        if os.path.isdir(self.file_src) and not self.recursive:
-            fail(str(self.file_src) + " is a directory")
-        if os.path.isfile(self.file_src) and self.recursive:
-            fail(str(self.file_src) + " is a file")
-        if not os.path.isfile(self.file_src) and not os.path.isdir(
-            self.file_src
-        ):
-            fail("Source file not found")
+        if self.manifest is None:
+            error = self.check_source(self.file_src, self.recursive)
+            if error is not None:
+                fail(error)
 
-        pool = ThreadPool(processes=self.parallelism)
+        # Connections are opened while the sources are walked.
+        self.pool.open()
         transfer_manager = self.server_channel.root.get_transfer_manager()
-        if not self.recursive:
-            try:
+        self.transfer_manager = transfer_manager
+        self.metadata = MetadataBatch(transfer_manager)
+        # Agents of single files waiting to be prepared together, across
+        # entries.
+        batch: List[Tuple[FileTransferAgent, List[Tuple[str, str]]]] = []
+        try:
+            for index, (file_src, file_dest) in enumerate(self.entries):
+                self.entry = index
+                recursive = self.recursive
+                if self.manifest is not None:
+                    recursive = os.path.isdir(file_src)
+                    error = self.check_source(file_src, recursive)
+                    if error is not None:
+                        self.entry_errors[index] = error
+                        continue
+                if recursive:
+                    self.add_directory(file_src, file_dest)
+                    continue
                 transfer_agent = FileTransferAgent(
-                    ClientUDTManager(
-                        self.server_channel, self.hostname, self.tcp_mode
-                    ),
+                    self.pool,
                     transfer_manager,
-                    self.file_src,
-                    self.file_dest,
+                    file_src,
+                    file_dest,
                     self.verify,
                     False,
                     self.stat,
+                    self.stripes,
+                    self.delta,
+                    self.metadata,
                 )
                 self.files_processed += 1
-            except EOFError:
-                logger.error("Could not connect")
-                self.start_success = False
-                return
-            self.transfer_agents.append(transfer_agent)
-            pool.apply_async(transfer_agent.send_file)
-        else:
-            for directory, subdirs, files in os.walk(
-                self.file_src, followlinks=self.follow_links
-            ):
-                # Make sure the directory we use on the server starts where we
-                # want it to instead of having the same path the client has.
-                server_directory = os.path.relpath(directory, self.file_src)
-                if str(server_directory) == ".":
-                    server_directory = ""
-                for f in files:
-                    file_dest = os.path.join(
-                        self.file_root_dest, server_directory, f
-                    )
-                    file_src = os.path.join(directory, f)
-                    try:
-                        transfer_agent = FileTransferAgent(
-                            ClientUDTManager(
-                                self.server_channel,
-                                self.hostname,
-                                self.tcp_mode,
-                            ),
-                            transfer_manager,
-                            file_src,
-                            file_dest,
-                            self.verify,
-                            True,
-                            self.stat,
-                        )
-                    except EOFError:
-                        logger.error("Could not connect")
-                        self.start_success = False
-                        return
-
-                    self.files_processed += 1
-                    self.transfer_agents.append(transfer_agent)
-
-                    pool.apply_async(transfer_agent.send_file)
+                self.entry_agents[self.entry].append(transfer_agent)
+                batch.append((transfer_agent, []))
+                if len(batch) >= PREPARE_BATCH_FILES:
+                    self.prepare(batch)
+                    batch = []
+            if batch:
+                self.prepare(batch)
+        except EOFError:
+            logger.error("Could not connect")
+            self.start_success = False
+            return
 
         self.start_success = True
 
-    def get_server_received_size(self):
-        pool = ThreadPool(processes=20)
-        res = pool.map(lambda x: x.get_progress(), self.transfer_agents)
-        pool.close()
-        return reduce(lambda x, y: x + y, res, 0)
+    @staticmethod
+    def check_source(file_src, recursive) -> Optional[str]:
+        """
+        Returns why file_src can't be sent, None if it can.
+        """
+        if os.path.isdir(file_src) and not recursive:
+            return str(file_src) + " is a directory"
+        if os.path.isfile(file_src) and recursive:
+            return str(file_src) + " is a file"
+        if not os.path.isfile(file_src) and not os.path.isdir(file_src):
+            return "Source file not found"
+        return None
 
-    def is_transfer_validating(self) -> bool:
-        pool = ThreadPool(processes=20)
+    def add_directory(self, file_src, file_dest):
+        """
+        Starts the agents sending the files under file_src to file_dest.
+        """
+        self.file_src = file_src
+        self.file_root_dest = file_dest
+        self.duplicates = {}
+        self.duplicate_sources = set()
+        self.duplicates_submitted = set()
+        # Agents waiting to be prepared together, with the files they send.
+        batch: List[Tuple[FileTransferAgent, List[Tuple[str, str]]]] = []
+        bundle: List[Tuple[str, str, int]] = []
+        bundle_bytes = 0
+        files: Iterable[Tuple[str, str]] = self.walk()
+        if self.dedup:
+            # Duplicates are found among all the files before any is sent.
+            files = list(files)
+            self.find_duplicates(files)
+        for file_src, rel_path in files:
+            if file_src in self.duplicate_sources:
+                self.files_processed += 1
+                continue
+            file_dest = os.path.join(self.file_root_dest, rel_path)
+            size = self.bundle_size(file_src)
+            if size is not None:
+                bundle.append((file_src, rel_path, size))
+                bundle_bytes += size
+                self.files_processed += 1
+                if (
+                    len(bundle) >= BUNDLE_MAX_FILES
+                    or bundle_bytes >= BUNDLE_MAX_BYTES
+                ):
+                    self.add_bundle(bundle)
+                    bundle = []
+                    bundle_bytes = 0
+                continue
+            transfer_agent = FileTransferAgent(
+                self.pool,
+                self.transfer_manager,
+                file_src,
+                file_dest,
+                self.verify,
+                True,
+                self.stat,
+                self.stripes,
+                self.delta,
+                self.metadata,
+            )
+            self.files_processed += 1
+            self.entry_agents[self.entry].append(transfer_agent)
+            batch.append((transfer_agent, [(file_src, rel_path)]))
+            if len(batch) >= PREPARE_BATCH_FILES:
+                self.prepare(batch)
+                batch = []
+        # The duplicates and bundles of the directory are sent relative to
+        # its destination, so its files are all started before the next
+        # entry's.
+        if batch:
+            self.prepare(batch)
+        if bundle:
+            self.add_bundle(bundle)
+        # Duplicates of files whose agent couldn't be started.
+        if unsent := self.duplicate_sources - self.duplicates_submitted:
+            logger.error("%d duplicate files not sent", len(unsent))
+            self.entry_errors[self.entry] = "%d duplicate files not sent" % (
+                len(unsent)
+            )
 
-        res = pool.map(
-            lambda x: (x.transfer_finished, x.is_verifying),
-            self.transfer_agents,
+    def bundle_size(self, file_src):
+        """
+        Returns the size of file_src if it is small enough to be bundled,
+        None if it is to be sent on its own.
+        """
+        if not self.bundle_threshold:
+            return None
+        try:
+            size = os.path.getsize(file_src)
+        except OSError:
+            return None
+        return size if size < self.bundle_threshold else None
+
+    def prepare(self, batch):
+        """
+        Has the server prepare the files of the agents of batch, (agent,
+        files it sends) pairs, in one round trip, then starts the agents.
+        """
+        agents, records = [], []
+        for transfer_agent, files in batch:
+            record = transfer_agent.prepare_record()
+            if record is None:
+                self.transfer_agents.append(transfer_agent)
+                continue
+            records.append(record)
+            agents.append((transfer_agent, files))
+        results = self.transfer_manager.prepare_files(tuple(records))
+        for (transfer_agent, files), result in zip(agents, results):
+            transfer_agent.prepared(result)
+            self.submit(transfer_agent, files)
+
+    def add_bundle(self, files):
+        transfer_agent = BundleTransferAgent(
+            self.pool, self.file_root_dest, files, self.verify, self.stat
+        )
+        self.entry_agents[self.entry].append(transfer_agent)
+        self.submit(
+            transfer_agent,
+            [(file_src, rel_path) for file_src, rel_path, _ in files],
         )
 
-        pool.close()
+    def submit(self, transfer_agent, files):
+        """
+        Starts transfer_agent, which sends files, (source, path relative to
+        the destination) pairs, followed by the duplicates of those files.
+        """
+        self.transfer_agents.append(transfer_agent)
+        duplicates = [
+            (duplicate, rel_path, original, hardlink)
+            for file_src, original in files
+            for duplicate, rel_path, hardlink in self.duplicates.get(
+                file_src, ()
+            )
+        ]
+        if duplicates:
+            self.duplicates_submitted.update(
+                duplicate for duplicate, *_ in duplicates
+            )
+            transfer_agent = DuplicateTransferAgent(
+                self.transfer_manager,
+                self.file_root_dest,
+                transfer_agent,
+                duplicates,
+                self.stat,
+            )
+            self.transfer_agents.append(transfer_agent)
+            self.entry_agents[self.entry].append(transfer_agent)
+        self.engine.submit(transfer_agent)
+
+    def walk(self) -> Iterator[Tuple[str, str]]:
+        """
+        Yields each file under the source directory with its path relative
+        to it, which is also its path relative to the destination.
+        """
+        for directory, subdirs, files in os.walk(
+            self.file_src, followlinks=self.follow_links
+        ):
+            # Make sure the directory we use on the server starts where we
+            # want it to instead of having the same path the client has.
+            server_directory = os.path.relpath(directory, self.file_src)
+            if str(server_directory) == ".":
+                server_directory = ""
+            for f in files:
+                yield os.path.join(directory, f), os.path.join(
+                    server_directory, f
+                )
+
+    def find_duplicates(self, files):
+        """
+        Records the duplicates among files, (source, relative path) pairs,
+        under the file they duplicate.
+        """
+        rel_paths = dict(files)
+        duplicates = find_duplicates(rel_paths, self.hash_algorithm)
+        for file_src, (original, hardlink) in duplicates.items():
+            self.duplicates.setdefault(original, []).append(
+                (file_src, rel_paths[file_src], hardlink)
+            )
+        self.duplicate_sources = set(duplicates)
+
+    def get_server_received_size(self):
+        # One call for the progress of all the files being received.
+        self.pool.poll_received()
+        return sum(agent.get_progress() for agent in self.transfer_agents)
+
+    def is_transfer_validating(self) -> bool:
+        res = [
+            (agent.transfer_finished, agent.is_verifying)
+            for agent in self.transfer_agents
+        ]
         status: Tuple[bool, bool] = reduce(
             lambda x, y: x if y[0] is True else (x[0] or y[1], x[1] and y[1]),
             res,
@@ -144,12 +417,9 @@ class ClientTransferController:
 
     def get_total_transfer_size(self):
         if not hasattr(self, "_get_total_transfer_size"):
-            pool = ThreadPool(processes=20)
-
-            res = pool.map(lambda x: x.file_size, self.transfer_agents)
-
-            pool.close()
-            self._get_total_transfer_size = reduce(lambda x, y: x + y, res, 0)
+            self._get_total_transfer_size = sum(
+                agent.file_size for agent in self.transfer_agents
+            )
         return self._get_total_transfer_size
 
     transfer_size = property(get_total_transfer_size)
@@ -158,16 +428,23 @@ class ClientTransferController:
         for i in self.transfer_agents:
             if not i.transfer_finished:
                 return False
+        # The last statuses are set once all the files are in.
+        if self.metadata is not None:
+            self.metadata.flush()
         return True
 
     def get_files_transfered(self):
         return reduce(
-            lambda x, y: x + (1 if y.transfer_finished else 0),
+            lambda x, y: x + (y.file_count if y.transfer_finished else 0),
             self.transfer_agents,
             0,
         )
 
     def is_transfer_success(self):
+        if self.metadata is not None and self.metadata.failed:
+            return False
+        if self.entry_errors:
+            return False
         return (
             reduce(
                 lambda y, x: 0 + y if x.transfer_success is True else 1 + y,
@@ -177,5 +454,40 @@ class ClientTransferController:
             == 0
         )
 
+    def entry_results(self) -> List[Tuple[str, str, Optional[str]]]:
+        """
+        Returns the source, destination and error, None if it was sent, of
+        each entry.
+        """
+        results = []
+        for index, (file_src, file_dest) in enumerate(self.entries):
+            if index in self.entry_errors:
+                error: Optional[str] = self.entry_errors[index]
+            elif index > self.entry or (
+                index == self.entry and self.start_success is False
+            ):
+                error = "Not sent"
+            else:
+                error = self.agent_errors(self.entry_agents[index])
+            results.append((file_src, file_dest, error))
+        return results
+
+    @staticmethod
+    def agent_errors(agents) -> Optional[str]:
+        """
+        Returns why the first of agents that failed did, and how many
+        others failed, or None if none did.
+        """
+        errors = [
+            agent.error or "Transfer failed"
+            for agent in agents
+            if agent.transfer_success is not True
+        ]
+        if len(errors) > 1:
+            return "%s, and %d more" % (errors[0], len(errors) - 1)
+        return errors[0] if errors else None
+
     def close(self):
+        self.engine.close()
+        self.pool.close()
         self.server_channel.root.get_transfer_manager().finish()
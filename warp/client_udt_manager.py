@@ -1,33 +1,53 @@
 from config import *
 from common_tools import *
+import errno
+import os
 import socket
+from framing import FRAME_DATA, FRAME_HEADER, FRAME_HOLE
+from hashing import digest, zeros_digest
+from read_ahead import ReadAheadReader, advise
 from udt4py import UDTSocket
 
 
+# errno values with which sendfile refuses a file or socket it can't handle,
+# as opposed to a genuine failure of the connection.
+SENDFILE_UNSUPPORTED = (
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSOCK,
+    errno.EOPNOTSUPP,
+)
+
+
 class ClientUDTManager:
-    def __init__(self, server_controller, hostname, tcp_mode):
-        self.server_controller = server_controller
+    """
+    One data connection of a session, see DataConnectionPool. Data is sent
+    in frames tagged with the server's id for the file it belongs to.
+    """
+
+    def __init__(self, hostname, tcp_mode):
         self.socket = None
         self.hostname = hostname
         self.port = None
         self.nonce = None
         self.tcp_mode = tcp_mode
-        self.server_udt_manager = None
-
-    def connect(self):
-        self.server_udt_manager = self.server_controller.root.get_udt_manager()(
-            self.tcp_mode
-        )
-
-        self.port, self.nonce = self.server_udt_manager.open_connection()
+        # Cleared the first time sendfile refuses this connection.
+        self.zero_copy = tcp_mode
+        # Set to an AdaptiveCompressor to compress the data stream.
+        self.compressor = None
+        # Set to the session's Pacer to cap the send rate.
+        self.pacer = None
+        # Whether blocks that can't go through sendfile are read via mmap.
+        self.use_mmap = False
+        # Hash algorithm of the session, see hashing.py.
+        self.hash_algorithm = "sha256"
+
+    def connect(self, port, nonce):
+        self.port, self.nonce = port, nonce
 
         self.connect_to_server()
         self.send_nonce()
 
-    def send_file(self, file_src, file_dest, block_count, file_size):
-        self.server_udt_manager.receive_data(file_dest, block_count, file_size)
-        self.send_data(file_src, block_count)
-
     def connect_to_server(self):
         """
         Connects to the provided host and port returning a socket object.
@@ -64,45 +84,165 @@ class ClientUDTManager:
 
     def send_nonce(self):
         if not self.tcp_mode:
-            self.socket.send(bytearray(self.nonce))
+            self.socket.send(bytearray(self.nonce, "ascii"))
         else:
-            self.socket.sendall(self.nonce)
+            self.socket.sendall(self.nonce.encode("ascii"))
 
-    def get_total_recieved(self):
-        if self.server_udt_manager is None:
-            return 0
+    def send_data(self, file_id, file_src, offset, end, block_size, digests=None):
+        """
+        Sends the bytes of file_src from offset to end as frames of up to
+        block_size bytes for the server's file file_id. In TCP mode each
+        frame's payload is handed to the kernel with sendfile, anything
+        sendfile can't handle is read ahead of the sends by a
+        ReadAheadReader. Blocks are compressed when there is a compressor
+        and it finds it worthwhile. If digests is given, the hash of each
+        block with hash_algorithm is added to it by block index as the
+        block is sent; those blocks are read rather than sent with
+        sendfile, so the file is only read once. Blocks of a sparse file
+        that are holes are sent as hole frames, without payload. Returns
+        the number of payload bytes put on the wire.
+        """
+        wire_bytes = 0
+        with open(file_src, "rb") as f:
+            sparse = is_sparse(f.fileno())
+            advise(f.fileno(), offset, end - offset, "POSIX_FADV_SEQUENTIAL")
+            reader = ReadAheadReader(f, end, block_size, use_mmap=self.use_mmap)
+            try:
+                while offset < end:
+                    length = min(block_size, end - offset)
+                    compress = self.compressor is not None and self.compressor.enabled()
+                    if sparse and is_hole(f.fileno(), offset, length):
+                        self.send_hole_frame(
+                            file_id, offset, length, block_size, digests
+                        )
+                    elif self.zero_copy and not compress and digests is None:
+                        self.send_zero_copy_frame(f, reader, file_id, offset, length)
+                        wire_bytes += length
+                    else:
+                        wire_bytes += self.send_read_frame(
+                            reader, file_id, offset, length, compress, digests
+                        )
+                    offset += length
+            finally:
+                reader.close()
+        logger.debug("Data sent.")
+        return wire_bytes
+
+    def send_zero_copy_frame(self, f, reader, file_id, offset, length):
+        # Have the kernel read the next block while this one is sent.
+        advise(f.fileno(), offset + length, length, "POSIX_FADV_WILLNEED")
+        self.send_header(FRAME_DATA, 0, file_id, offset, length)
+        sent_to = self.send_zero_copy(f, offset, offset + length)
+        self.zero_copy = sent_to == offset + length
+        if sent_to < offset + length:
+            data = reader.get(sent_to, offset + length - sent_to)
+            if len(data) < offset + length - sent_to:
+                # The frame promised more than the file now holds, the
+                # stream can't be resynchronised.
+                raise EOFError(f.name + " shrank while being sent")
+            self.send_bytes(data)
+
+    def send_hole_frame(self, file_id, offset, length, block_size, digests):
+        self.send_header(FRAME_HOLE, 0, file_id, offset, length)
+        if digests is not None:
+            digests[offset // block_size] = zeros_digest(self.hash_algorithm, length)
+
+    def send_read_frame(self, reader, file_id, offset, length, compress, digests):
+        """
+        Sends a block taken from reader. Returns its size on the wire.
+        """
+        data = reader.get(offset, length)
+        if len(data) < length:
+            raise EOFError(reader.name + " shrank while being sent")
+        if digests is not None:
+            digests[offset // reader.block_size] = digest(self.hash_algorithm, data)
+        flags, payload = 0, data
+        if compress:
+            flags, payload = self.compressor.compress(data)
+        self.send_frame(FRAME_DATA, flags, file_id, offset, payload)
+        return len(payload)
+
+    def send_payload(self, kind, file_id, offset, data):
+        """
+        Sends data, already in memory, as a single frame, compressed if
+        worthwhile. Returns the number of payload bytes put on the wire.
+        """
+        flags = 0
+        if self.compressor is not None and self.compressor.enabled():
+            flags, data = self.compressor.compress(data)
+        self.send_frame(kind, flags, file_id, offset, data)
+        return len(data)
+
+    def send_frame(self, kind, flags, file_id, offset, payload):
+        self.send_header(kind, flags, file_id, offset, len(payload))
+        if not self.tcp_mode:
+            # UDT sockets want a buffer they can slice into bytes.
+            if isinstance(payload, memoryview):
+                payload = payload.tobytes()
+        self.send_bytes(payload)
 
-        return self.server_udt_manager.get_total_recieved()
+    def send_header(self, kind, flags, file_id, offset, length):
+        header = FRAME_HEADER.pack(kind, flags, file_id, offset, length)
+        if not self.tcp_mode:
+            header = bytearray(header)
+        self.send_bytes(header)
 
-    def send_data(self, file_src, block_count=0):
+    def send_bytes(self, data):
         """
-        Opens the file at the number of blocks passed in and uses that along with
-        the other parameters to send a file to the host at the specified port.
+        Sends all of data, in pieces the pacer lets through if there is one.
         """
-        f = open(file_src, "r")
-        f.seek(block_count * CHUNK_SIZE)
-        data = f.read(CHUNK_SIZE)
-        byteData = bytearray(CHUNK_SIZE)
-        while data:
+        quantum = self.pacer.quantum if self.pacer is not None else len(data)
+        for start in range(0, len(data), max(quantum, 1)):
+            piece = data[start : start + quantum]
             if not self.tcp_mode:
-                byteData[0:CHUNK_SIZE] = data
-                self.send_chunk(byteData)
+                self.send_chunk(piece)
             else:
-                self.socket.sendall(data)
-            data = f.read(CHUNK_SIZE)
-        logger.debug("Data sent.")
-        self.socket.close()
-        f.close()
+                self.socket.sendall(piece)
+            if self.pacer is not None:
+                self.pacer.consume(len(piece))
+
+    def send_zero_copy(self, f, offset, end):
+        """
+        Sends the file from offset to end with os.sendfile, without copying
+        the data through Python. Returns the offset reached, which is where
+        the buffered path picks up if sendfile is not supported for this file
+        or socket.
+        """
+        if not hasattr(os, "sendfile"):
+            return offset
+
+        in_fd = f.fileno()
+        out_fd = self.socket.fileno()
+        while offset < end:
+            quantum = self.pacer.quantum if self.pacer is not None else 1 << 30
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, min(end - offset, quantum))
+            except OSError as e:
+                if e.errno not in SENDFILE_UNSUPPORTED:
+                    raise
+                logger.debug("sendfile unusable (%s), sending buffered", e)
+                break
+            if sent == 0:
+                # The file was truncated underneath us.
+                break
+            if self.pacer is not None:
+                self.pacer.consume(sent)
+            offset += sent
+        return offset
 
     def send_chunk(self, data):
-        size = self.socket.send(data)
-        if not size == len(data):
-            self.send_chunk(data[size:])
+        while data:
+            size = self.socket.send(data)
+            data = data[size:]
 
     def generate_nonce(self, length=NONCE_SIZE):
         """Generate pseudorandom number. Ripped from google."""
         return "".join([str(random.randint(0, 9)) for i in range(length)])
 
-    def __del__(self):
+    def close(self):
         if self.socket:
             self.socket.close()
+            self.socket = None
+
+    def __del__(self):
+        self.close()
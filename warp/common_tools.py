@@ -1,31 +1,188 @@
+import ctypes
 import errno
-import hashlib
 import os
 import signal
 import sys
+import threading
 from functools import wraps
 from typing import List, Tuple, Union
 
-from config import CHUNK_SIZE, logger
+from config import (
+    BLOCK_SECONDS,
+    HASH_CHUNK_SIZE,
+    IO_BUFFER_SIZE,
+    MAX_BLOCK_SIZE,
+    MIN_BLOCK_SIZE,
+    MIN_BLOCKS_PER_FILE,
+    logger,
+)
+from merkle import BlockTree
 
 
-def getHash(file):
+def getHash(file, algorithm="sha256"):
     """
-    Returns a sha256 hash for the specified file.
+    Returns the hash of the specified file: the root of its block tree in
+    blocks of HASH_CHUNK_SIZE bytes, which are hashed in parallel.
     Eventually sent to server to check for restarts.
     """
-    hash = hashlib.sha256()
-    # i = 0
-    with open(file, "rb") as file:
-        # while True:
-        while data := file.read(CHUNK_SIZE):
-            # data = file.read(CHUNK_SIZE)
-            # if not data or (block_count != 0 and i >= block_count):
-            # file.close()
-            # return hash.hexdigest()
-            # i += 1
-            hash.update(data)
-    return hash.hexdigest()
+    return BlockTree.from_file(
+        file, HASH_CHUNK_SIZE, os.path.getsize(file), algorithm
+    ).root
+
+
+def choose_block_size(file_size: int, throughput: float = 0) -> int:
+    """
+    Returns the block size the client proposes for a file of file_size bytes.
+    Large files get large blocks (about 1/1024th of the file), a known link
+    throughput (bytes per second) raises that to BLOCK_SECONDS worth of data,
+    but a file is never cut into fewer than MIN_BLOCKS_PER_FILE blocks. The
+    result is a power of two between MIN_BLOCK_SIZE and MAX_BLOCK_SIZE.
+    """
+    target = max(file_size // 1024, int(throughput * BLOCK_SECONDS))
+    target = min(target, file_size // MIN_BLOCKS_PER_FILE)
+    block_size = MIN_BLOCK_SIZE
+    while block_size * 2 <= target and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+class ThroughputMeter:
+    """
+    Exponentially weighted average of the rate, in bytes per second, at which
+    data has been sent so far. Shared by all the transfers of a session.
+    """
+
+    def __init__(self, weight=0.3):
+        self.weight = weight
+        self.rate = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, nbytes: int, seconds: float):
+        if nbytes <= 0 or seconds <= 0:
+            return
+        sample = nbytes / seconds
+        with self._lock:
+            if self.rate:
+                sample = self.weight * sample + (1 - self.weight) * self.rate
+            self.rate = sample
+
+
+def pwrite_all(fd, data, offset):
+    """
+    Writes all of data to fd at offset, without moving the file position.
+    """
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+# fallocate(2) modes: reserve blocks without changing the file size, and
+# deallocate blocks (with FALLOC_FL_KEEP_SIZE).
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+try:
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate64
+    _fallocate.argtypes = [
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int64,
+        ctypes.c_int64,
+    ]
+except (AttributeError, OSError):
+    _fallocate = None
+
+
+def preallocate(fd, offset, length, keep_size=False) -> bool:
+    """
+    Reserves disk space for length bytes of fd at offset, so the file isn't
+    fragmented by being written piecewise. With keep_size the file size
+    stays as it is, which is only possible on Linux. Returns whether the
+    space could be reserved.
+    """
+    if length <= 0:
+        return True
+    try:
+        if not keep_size:
+            os.posix_fallocate(fd, offset, length)
+            return True
+        if _fallocate is not None:
+            return not _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length)
+    except (AttributeError, OSError) as e:
+        logger.debug("Can't preallocate: %s", e)
+    return False
+
+
+def punch_hole(fd, offset, length):
+    """
+    Makes length bytes of fd at offset read as zeros, deallocating them
+    where the filesystem can and writing zeros elsewhere.
+    """
+    if _fallocate is not None and not _fallocate(
+        fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length
+    ):
+        return
+    zeros = bytes(min(length, IO_BUFFER_SIZE))
+    end = offset + length
+    while offset < end:
+        pwrite_all(fd, zeros[: end - offset], offset)
+        offset += len(zeros)
+
+
+def is_hole(fd, offset, length) -> bool:
+    """
+    Whether the length bytes of fd at offset all lie in a hole, where the
+    file has no data allocated. Moves the file position. Always False where
+    the system can't tell.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        return False
+    try:
+        return os.lseek(fd, offset, os.SEEK_DATA) >= offset + length
+    except OSError as e:
+        # No data from offset to the end of the file.
+        return e.errno == errno.ENXIO
+
+
+def is_sparse(file) -> bool:
+    """
+    Whether file, a path or descriptor, has fewer blocks allocated than its
+    size needs, so likely holes.
+    """
+    st = os.stat(file)
+    return hasattr(st, "st_blocks") and st.st_blocks * 512 < st.st_size
+
+
+def pread_into(fd, buf, offset) -> int:
+    """
+    Fills buf with the bytes of fd at offset, without moving the file
+    position. Returns how many were read, fewer only at the end of the file.
+    """
+    view = memoryview(buf)
+    filled = 0
+    while filled < len(view):
+        if hasattr(os, "preadv"):
+            n = os.preadv(fd, [view[filled:]], offset + filled)
+        else:
+            data = os.pread(fd, len(view) - filled, offset + filled)
+            n = len(data)
+            view[filled : filled + n] = data
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def parse_size(spec) -> int:
+    """
+    Parses a byte count such as "512K", "1.5M" or "2G" (powers of 1024).
+    """
+    units = "KMGT"
+    spec = spec.strip().upper().rstrip("B")
+    if spec and spec[-1] in units:
+        return int(float(spec[:-1]) * 1024 ** (units.index(spec[-1]) + 1))
+    return int(spec)
 
 
 def fail(msg):
@@ -37,6 +194,18 @@ def fail(msg):
     sys.exit(1)
 
 
+def detach():
+    """
+    Detaches a forked process from the session and terminal of its parent,
+    so it outlives them, and points its standard streams at /dev/null.
+    """
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    os.close(null)
+
+
 # from: http://stackoverflow.com/questions/2281850/timeout-function-if-it-takes-too-long-to-finish
 
 
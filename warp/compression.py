@@ -0,0 +1,125 @@
+"""
+Optional compression of the data stream. Frames whose payload is compressed
+carry the id of the codec in the low bits of their flags, the server
+decompresses them before writing. The client decides block by block whether
+compressing is worth it, see AdaptiveCompressor.
+"""
+
+import bz2
+import lzma
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Tuple
+
+from config import (
+    COMPRESSION_BACKOFF_BLOCKS,
+    COMPRESSION_SAMPLE_SIZE,
+    COMPRESSION_WINDOW_BLOCKS,
+    INCOMPRESSIBLE_RATIO,
+    logger,
+)
+
+# Frame flags bits holding the codec id, 0 meaning not compressed.
+CODEC_MASK = 0x0F
+
+CODEC_IDS = {"zlib": 1, "bz2": 2, "lzma": 3}
+
+COMPRESSORS: Dict[int, Callable[[bytes, int], bytes]] = {
+    1: lambda data, level: zlib.compress(data, level),
+    2: lambda data, level: bz2.compress(data, compresslevel=level),
+    3: lambda data, level: lzma.compress(data, preset=level),
+}
+
+DECOMPRESSORS: Dict[int, Callable[[bytes], bytes]] = {
+    1: zlib.decompress,
+    2: bz2.decompress,
+    3: lzma.decompress,
+}
+
+DEFAULT_LEVELS = {"zlib": 6, "bz2": 9, "lzma": 1}
+
+
+def parse_compression(spec) -> Tuple[int, int]:
+    """
+    Parses a --compress argument such as "zlib" or "lzma:3" into a codec id
+    and level.
+    """
+    name, _, level = spec.partition(":")
+    if name not in CODEC_IDS:
+        raise ValueError(
+            "Unknown codec %s, expected one of %s" % (name, ", ".join(CODEC_IDS))
+        )
+    return CODEC_IDS[name], int(level) if level else DEFAULT_LEVELS[name]
+
+
+def decompress(flags, payload) -> bytes:
+    return DECOMPRESSORS[flags & CODEC_MASK](payload)
+
+
+class AdaptiveCompressor:
+    """
+    Compresses the blocks of the data stream when that pays off. A block is
+    sent raw when a fast compression of a sample of it barely shrinks it
+    (media, archives and other already compressed data). Every
+    COMPRESSION_WINDOW_BLOCKS blocks, the time spent compressing is weighed
+    against the time the saved bytes would have taken on the wire at the
+    rate measured by meter; if compressing lost, it is switched off for
+    COMPRESSION_BACKOFF_BLOCKS blocks before being tried again. Shared by
+    all the connections of a session.
+    """
+
+    def __init__(self, codec, level, meter):
+        self.codec = codec
+        self.level = level
+        self.meter = meter
+        self._lock = threading.Lock()
+        self.skip_blocks = 0
+        self.window_blocks = 0
+        self.window_seconds = 0.0
+        self.window_saved = 0
+
+    def enabled(self) -> bool:
+        """
+        Whether the next block should be offered to compress, if not it can
+        be sent without going through userspace.
+        """
+        with self._lock:
+            if self.skip_blocks:
+                self.skip_blocks -= 1
+                return False
+            return True
+
+    def compress(self, data) -> Tuple[int, bytes]:
+        """
+        Returns the frame flags and payload to send for the block data.
+        """
+        start_time = time.perf_counter()
+        sample = data[:COMPRESSION_SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > INCOMPRESSIBLE_RATIO * len(sample):
+            self.account(time.perf_counter() - start_time, 0)
+            return 0, data
+        payload = COMPRESSORS[self.codec](data, self.level)
+        self.account(time.perf_counter() - start_time, max(0, len(data) - len(payload)))
+        if len(payload) >= len(data):
+            return 0, data
+        return self.codec, payload
+
+    def account(self, seconds, saved):
+        with self._lock:
+            self.window_blocks += 1
+            self.window_seconds += seconds
+            self.window_saved += saved
+            if self.window_blocks < COMPRESSION_WINDOW_BLOCKS:
+                return
+            rate = self.meter.rate
+            if rate and self.window_seconds > self.window_saved / rate:
+                logger.debug(
+                    "Compression took %.3fs to save %d bytes, pausing it",
+                    self.window_seconds,
+                    self.window_saved,
+                )
+                self.skip_blocks = COMPRESSION_BACKOFF_BLOCKS
+            self.window_blocks = 0
+            self.window_seconds = 0.0
+            self.window_saved = 0
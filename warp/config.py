@@ -3,16 +3,120 @@
 # configuration file.
 
 import logging
+import os
 
 
 LOG_LEVEL = logging.INFO
 
 logging.basicConfig(format="%(levelname)s: %(message)s", level=LOG_LEVEL)
 
-# Just a random chunk size to send the file in pieces,
-# should be the same as the chunk size used to write
-CHUNK_SIZE = 4096
+# Bounds for the block size of a transfer. Resume offsets are counted in
+# blocks; the client proposes a size per file (see choose_block_size) and the
+# server clamps it to its own bounds, so both ends always agree on it.
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+# A file is split into at least this many blocks, so that an interrupted
+# transfer doesn't have to throw much of it away on resume.
+MIN_BLOCKS_PER_FILE = 64
+# Once the throughput of the link is known, blocks are sized to carry about
+# this many seconds of data.
+BLOCK_SECONDS = 0.1
+# Files of at least STRIPE_THRESHOLD bytes can be striped: cut into stripes
+# of STRIPE_SIZE bytes that are sent over several connections at once.
+STRIPE_THRESHOLD = 256 * 1024 * 1024
+STRIPE_SIZE = 64 * 1024 * 1024
+# Files of at least RESUME_THRESHOLD bytes, and striped files, are received
+# with a journal of the blocks on disk (see resume_journal.py). It is
+# brought up to date, after flushing the file, every RESUME_FLUSH_BYTES
+# received or RESUME_FLUSH_SECONDS, whichever comes first.
+RESUME_THRESHOLD = 64 * 1024 * 1024
+RESUME_FLUSH_BYTES = 256 * 1024 * 1024
+RESUME_FLUSH_SECONDS = 10
+# Limits of a bundle of small files (see bundle.py), and the number of its
+# files the server unpacks before moving them into place together.
+BUNDLE_MAX_BYTES = 64 * 1024 * 1024
+BUNDLE_MAX_FILES = 4096
+BUNDLE_COMMIT_FILES = 256
+# A block is sent uncompressed when a fast compression of its first
+# COMPRESSION_SAMPLE_SIZE bytes doesn't get below INCOMPRESSIBLE_RATIO of
+# their size. Every COMPRESSION_WINDOW_BLOCKS blocks compression is checked
+# to still save more time than it costs, else it is paused for
+# COMPRESSION_BACKOFF_BLOCKS blocks.
+COMPRESSION_SAMPLE_SIZE = 16 * 1024
+INCOMPRESSIBLE_RATIO = 0.9
+COMPRESSION_WINDOW_BLOCKS = 16
+COMPRESSION_BACKOFF_BLOCKS = 256
+# Blocks read ahead of the sender by the buffered send path.
+READ_AHEAD_BLOCKS = 4
+# With --bwlimit, data is handed to the socket in pieces of PACING_QUANTUM
+# bytes, and at most PACING_BURST_SECONDS worth of unused rate is saved up.
+PACING_QUANTUM = 256 * 1024
+PACING_BURST_SECONDS = 0.05
+# Size of the buffer used when the data path has to copy file contents
+# through userspace instead of handing them to the kernel with sendfile.
+IO_BUFFER_SIZE = 1024 * 1024
+# Received buffers the server queues for its disk writer before the receive
+# loops have to wait for the disk.
+WRITE_BEHIND_BUFFERS = 16
+# Number of idle IO_BUFFER_SIZE buffers kept for reuse by the data path,
+# enough for a full write-behind queue and the buffers being received into.
+BUFFER_POOL_SIZE = WRITE_BEHIND_BUFFERS + 4
+# How received files are flushed to disk: not at all ("none", left to the
+# kernel), once complete ("end"), or also every SYNC_PERIOD_BYTES written
+# ("periodic"). Files with a resume journal are also flushed before it is
+# updated.
+SYNC_POLICIES = ("none", "end", "periodic")
+SYNC_PERIOD_BYTES = 64 * 1024 * 1024
+# Cache of file hashes (see hash_cache.py) and the most it may hold.
+HASH_CACHE_PATH = os.path.expanduser("~/.warp/hash-cache.sqlite3")
+HASH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Files prepared on the server in one round trip (see
+# TransferManager.prepare_files), and received files whose times and mode
+# are set in one (see metadata_batch.py).
+PREPARE_BATCH_FILES = 256
+METADATA_BATCH_FILES = 256
+# Delta transfers (see delta.py) compare files in blocks of about the square
+# root of their size, within these bounds, and roll a checksum over at most
+# DELTA_SCAN_SIZE bytes of the local file at a time.
+DELTA_MIN_BLOCK_SIZE = 16 * 1024
+DELTA_MAX_BLOCK_SIZE = 1024 * 1024
+DELTA_SCAN_SIZE = 1024 * 1024
+# Hash algorithms supported (see hashing.py), and the threads hashing the
+# blocks of a file, HASH_CHUNK_SIZE bytes at a time.
+HASH_ALGORITHMS = ("blake2b", "sha256")
+HASH_THREADS = min(8, os.cpu_count() or 1)
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+# Bytes the SSH tunnel's forwarder moves at a time, and the window and
+# largest packet of its SSH channels (see forward.py). While a channel's
+# window is full, the forwarder tries again every FORWARD_POLL_SECONDS.
+FORWARD_BUFFER_SIZE = 256 * 1024
+FORWARD_POLL_SECONDS = 0.01
+FORWARD_WINDOW_SIZE = 16 * 1024 * 1024
+FORWARD_PACKET_SIZE = 32 * 1024
+# Protocols of the control channel: the binary one of control.py, or rpyc.
+# The binary server runs up to CONTROL_THREADS calls of a session at once,
+# and pushes the progress of its files every CONTROL_NOTIFY_SECONDS.
+CONTROL_PROTOCOLS = ("binary", "rpyc")
+CONTROL_THREADS = 64
+CONTROL_NOTIFY_SECONDS = 0.1
+# Longest control message, and longest before a session is authenticated.
+CONTROL_MAX_MESSAGE_BYTES = 256 * 1024 * 1024
+CONTROL_AUTH_MAX_BYTES = 256
+# Agents the client runs at once (see engine.py): --parallelism of them send
+# data, the others wait for the server to acknowledge their file. Each wait
+# holds one of the CONTROL_THREADS, some are left for the other calls.
+IN_FLIGHT_FILES = CONTROL_THREADS - 16
+# With --persist, the client leaves a master process holding the SSH
+# connection, listening on a socket in CONTROL_SOCKET_DIR, for later runs to
+# connect to. It talks to a warp-server daemon (warp-server --daemon) that
+# serves all of the user's sessions, found through DAEMON_STATE_PATH, until
+# it has had no session for DAEMON_IDLE_SECONDS.
+CONTROL_SOCKET_DIR = os.path.expanduser("~/.warp/sessions")
+DAEMON_STATE_PATH = os.path.expanduser("~/.warp/warp-server.daemon")
+DAEMON_IDLE_SECONDS = 3600
 NONCE_SIZE = 32
+# Pending data connections the server queues while accepting.
+DATA_CONNECTIONS_BACKLOG = 16
 PORT = 29977
 
 
@@ -1,8 +1,9 @@
 import getpass
 import logging
+import socket
 import sys
 import threading
-from typing import Optional, cast
+from typing import Optional, Union, cast
 
 import paramiko
 import rpyc
@@ -10,7 +11,9 @@ from paramiko import SSHClient
 
 from common_tools import fail
 from config import logger
-from forward import forward_tunnel
+from control import ControlClient
+from control_master import connect_master, socket_path, start_master
+from forward import forward_tunnel, open_channel
 
 hostkeytype = None
 hostkey = None
@@ -20,11 +23,19 @@ logging.getLogger("paramiko").setLevel(logging.WARNING)
 
 
 class Connection:
-    def __init__(self, hostname, username, ssh_port=22):
-        self.channel: Optional[rpyc.Connection] = None
+    def __init__(
+        self, hostname, username, ssh_port=22, control="rpyc", persist=0
+    ):
+        self.channel: Optional[Union[rpyc.Connection, ControlClient]] = None
         self.hostname = hostname
         self.username = username
         self.ssh_port = ssh_port
+        # Protocol of the control channel, one of CONTROL_PROTOCOLS.
+        self.control = control
+        # Seconds the SSH master and the warp-server daemon are kept for
+        # later runs, see control_master.py. Without, neither is used.
+        self.persist = persist
+        self.token = None
 
     def connect_ssh(self):
         """Initiate an SSH connection using the information passed to the
@@ -73,26 +84,60 @@ class Connection:
                     "SSH Authentication Failed. Tried: pubkey, password."
                 )
                 raise
-        (sshin1, sshout1, ssherr1) = self.client.exec_command("warp-server")
+        try:
+            # Control messages are small, don't hold them back.
+            self.client.get_transport().sock.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+            )
+        except (AttributeError, OSError):
+            pass
+        command = "warp-server"
+        # Servers from before the binary protocol don't know the option.
+        if self.control != "rpyc":
+            command += " --control " + self.control
+        if self.persist:
+            command += " --daemon"
+        (sshin1, sshout1, ssherr1) = self.client.exec_command(command)
         if err := ssherr1.read(500):
             raise RuntimeError(
                 "Execution of 'warp-server' on the remote host may have failed."
                 " This message was printed to stderr (truncated to 500 bytes):"
                 f"\n\n{err.decode(errors='replace')}"
             )
+        if self.persist:
+            port, self.token = sshout1.read().decode().split()
+            self.comm_port = int(port)
+            return
         self.comm_port = int(sshout1.read(5))
 
     def connect(self):
         """Start a UDT listener on the remote host using Connection.connect_ssh,
-        establish a UDT connection to it, and return the rpyc.Connection through
-        which data can be dumped into the UDT tunnel.
+        establish a UDT connection to it, and return the rpyc.Connection (or
+        ControlClient, see control.py) through which data can be dumped into
+        the UDT tunnel. With persist, through the SSH master of the host,
+        started first unless it runs.
         """
+        if self.persist:
+            path = socket_path(self.username, self.hostname, self.ssh_port)
+            if (channel := connect_master(path)) is None:
+                start_master(self, path)
+                channel = connect_master(path)
+                if channel is None:
+                    raise RuntimeError("Could not connect to the SSH master")
+            self.channel = channel
+            return channel
+
         self.connect_ssh()
+        transport = self.client.get_transport()
+        if self.control == "binary":
+            # Straight over an SSH channel, without a forwarded local socket.
+            self.channel = ControlClient(
+                open_channel(transport, "127.0.0.1", self.comm_port)
+            )
+            return self.channel
 
         # Now we start the port forwarding
-        channel = forward_tunnel(
-            0, "127.0.0.1", self.comm_port, self.client.get_transport()
-        )
+        channel = forward_tunnel(0, "127.0.0.1", self.comm_port, transport)
         self.forward_thread = threading.Thread(
             target=start_tunnel, args=(channel,)
         )
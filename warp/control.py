@@ -0,0 +1,459 @@
+"""
+Binary control protocol (--control binary), an alternative to rpyc for the
+control channel of a session. Every message is a CONTROL_HEADER (body
+length, kind, request id) followed by a body encoded with marshal, which
+only takes plain values: no proxies, no attribute lookups, one message per
+call each way.
+
+- CALL: (target, method, args, kwargs), a call of a method of one of the
+  session's objects, named by target. The empty target is the session
+  itself, see ControlSession.create_udt_manager.
+- REPLY: what the call with the same request id returned.
+- ERROR: (exception type name, message) of a call that raised.
+- AUTH: the token of the server, as raw bytes rather than marshalled.
+- NOTIFY: (topic, value), pushed by the server without being asked, with
+  request id 0. "<target>.received" carries get_all_received of a
+  ServerUDTManager whenever it changed, so the client doesn't poll it.
+
+Calls are tagged with request ids, so any number of client threads share the
+one connection: replies come back as the calls finish, in any order, the
+server running up to CONTROL_THREADS calls at once. RemoteObject and
+ControlClient.root mimic rpyc's netrefs and root, so the classes written for
+rpyc work with either.
+
+A server started with a token (the warp-server daemon) only answers the
+sessions that first authenticate with it, and outlives them: finish ends the
+session rather than the server. Until then it takes nothing but an AUTH of
+at most CONTROL_AUTH_MAX_BYTES, and never unmarshals what it receives, as
+anyone on the host can connect. No message may be longer than
+CONTROL_MAX_MESSAGE_BYTES.
+"""
+
+import hmac
+import itertools
+import marshal
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List, Optional
+
+from config import (
+    CONTROL_AUTH_MAX_BYTES,
+    CONTROL_MAX_MESSAGE_BYTES,
+    CONTROL_NOTIFY_SECONDS,
+    CONTROL_THREADS,
+    logger,
+)
+from server_udt_manager import ServerUDTManager
+from transfer_manager import TransferManager
+
+CONTROL_HEADER = struct.Struct("!IBI")
+CALL, REPLY, ERROR, NOTIFY, AUTH = 1, 2, 3, 4, 5
+# Readable by every Python 3 since 3.4, whatever the versions on each end.
+MARSHAL_VERSION = 4
+
+
+class RemoteError(Exception):
+    """
+    An exception raised by a call on the server, by type name and message.
+    """
+
+    def __init__(self, name, message):
+        super().__init__("%s: %s" % (name, message))
+        self.name = name
+
+
+def send_message(sock, lock, kind, request_id, value):
+    body = marshal.dumps(value, MARSHAL_VERSION)
+    with lock:
+        sock.sendall(CONTROL_HEADER.pack(len(body), kind, request_id) + body)
+
+
+def recv_message(sock):
+    """
+    Returns the (kind, request id, value) of the next message, or None if
+    the connection was closed between messages.
+    """
+    message = recv_raw(sock, CONTROL_MAX_MESSAGE_BYTES)
+    if message is None:
+        return None
+    kind, request_id, body = message
+    return kind, request_id, marshal.loads(body)
+
+
+def recv_raw(sock, limit):
+    """
+    Returns the kind, request id and body, not unmarshalled, of the next
+    message, or None if the connection was closed between messages. Raises
+    ValueError if the body is longer than limit.
+    """
+    header = recv_exactly(sock, CONTROL_HEADER.size)
+    if header is None:
+        return None
+    length, kind, request_id = CONTROL_HEADER.unpack(header)
+    if length > limit:
+        raise ValueError("Control message of %d bytes is too long" % length)
+    body = recv_exactly(sock, length)
+    if body is None:
+        raise EOFError("Control channel closed mid-message")
+    return kind, request_id, body
+
+
+def authenticate(sock, token):
+    """
+    Authenticates the session of sock, before anything else is sent over it,
+    with the token of a server started with one.
+    """
+    body = token.encode()
+    sock.sendall(CONTROL_HEADER.pack(len(body), AUTH, 0) + body)
+    message = recv_message(sock)
+    if message is None:
+        raise EOFError("Control channel closed")
+    kind, _, value = message
+    if kind == ERROR:
+        raise RemoteError(*value)
+
+
+def recv_exactly(sock, length) -> Optional[bytearray]:
+    buf = bytearray(length)
+    view = memoryview(buf)
+    filled = 0
+    while filled < length:
+        if hasattr(sock, "recv_into"):
+            n = sock.recv_into(view[filled:])
+        else:
+            # A paramiko channel.
+            data = sock.recv(length - filled)
+            n = len(data)
+            view[filled : filled + n] = data
+        if not n:
+            if filled:
+                raise EOFError("Control channel closed mid-message")
+            return None
+        filled += n
+    return buf
+
+
+class RemoteObject:
+    """
+    One of the objects of the server's session. Its methods are called over
+    the channel; there are no attributes to read.
+    """
+
+    def __init__(self, client, target):
+        self.client = client
+        self.target = target
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return partial(self.client.call, self.target, method)
+
+    def call_async(self, method, *args) -> Future:
+        return self.client.call_async(self.target, method, *args)
+
+
+class _Root:
+    # What rpyc's root is to ServerTransferController.
+
+    def __init__(self, client):
+        self.client = client
+
+    def get_transfer_manager(self) -> RemoteObject:
+        return RemoteObject(self.client, "transfer_manager")
+
+    def get_udt_manager(self) -> Callable[..., RemoteObject]:
+        def create(*args) -> RemoteObject:
+            target = self.client.call("", "create_udt_manager", *args)
+            return RemoteObject(self.client, target)
+
+        return create
+
+
+class ControlClient:
+    """
+    The client end of the control channel, over a socket or straight over
+    an SSH channel. Calls block the calling thread until their reply
+    arrives, which a reader thread hands over, unless made with call_async.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.root = _Root(self)
+        self.closed = False
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._waiting: Dict[int, Future] = {}
+        self._subscribers: Dict[str, List[Callable]] = {}
+        thread = threading.Thread(target=self._read)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def connect(cls, host, port) -> "ControlClient":
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(sock)
+
+    def call(self, target, method, *args, **kwargs):
+        return self.call_async(target, method, *args, **kwargs).result()
+
+    def call_async(self, target, method, *args, **kwargs) -> Future:
+        """
+        Sends a call and returns the future of its reply, without waiting.
+        """
+        future: Future = Future()
+        with self._lock:
+            if self.closed:
+                raise EOFError("Control channel closed")
+            request_id = next(self._ids)
+            self._waiting[request_id] = future
+        try:
+            send_message(
+                self.sock,
+                self._send_lock,
+                CALL,
+                request_id,
+                (target, method, args, kwargs),
+            )
+        except BaseException:
+            with self._lock:
+                self._waiting.pop(request_id, None)
+            raise
+        return future
+
+    def subscribe(self, topic, callback):
+        """
+        Has callback called with the value of every notification of topic,
+        from the reader thread.
+        """
+        with self._lock:
+            self._subscribers.setdefault(topic, []).append(callback)
+
+    def _read(self):
+        try:
+            while (message := recv_message(self.sock)) is not None:
+                kind, request_id, value = message
+                if kind == NOTIFY:
+                    topic, value = value
+                    with self._lock:
+                        callbacks = list(self._subscribers.get(topic, ()))
+                    for callback in callbacks:
+                        callback(value)
+                    continue
+                with self._lock:
+                    future = self._waiting.pop(request_id, None)
+                if future is None:
+                    logger.debug("Reply to unknown request %d", request_id)
+                elif kind == ERROR:
+                    future.set_exception(RemoteError(*value))
+                else:
+                    future.set_result(value)
+        except (OSError, EOFError, ValueError) as e:
+            logger.debug("Control channel failed: %s", e)
+        finally:
+            with self._lock:
+                self.closed = True
+                waiting, self._waiting = self._waiting, {}
+            for future in waiting.values():
+                future.set_exception(EOFError("Control channel closed"))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ControlServer:
+    """
+    Listens for control connections on localhost, each served by a
+    ControlSession, until a session's TransferManager.finish. With
+    idle_seconds, until it has had no session for that long instead.
+    """
+
+    def __init__(self, hostname="localhost", port=0, token=None, idle_seconds=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((hostname, port))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.closed = False
+        # Secret the sessions must authenticate with, if any.
+        self.token = token
+        self.idle_seconds = idle_seconds
+        self.sessions = 0
+        self.last_active = time.monotonic()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.idle_seconds:
+            # Idleness is looked at every idle_seconds, so the server may
+            # stay up to twice as long.
+            self.sock.settimeout(self.idle_seconds)
+        while not self.closed:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                with self._lock:
+                    idle = time.monotonic() - self.last_active
+                    if self.sessions or idle < self.idle_seconds:
+                        continue
+                logger.info("No session for %d seconds, exiting", idle)
+                self.close()
+                return
+            except OSError:
+                if self.closed:
+                    return
+                raise
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self.sessions += 1
+            thread = threading.Thread(target=ControlSession(conn, self).run)
+            thread.daemon = True
+            thread.start()
+
+    def session_ended(self):
+        with self._lock:
+            self.sessions -= 1
+            self.last_active = time.monotonic()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ControlSession:
+    """
+    The objects of one client's session, as ServerTransferController holds
+    them for rpyc, and the calls and notifications to it.
+    """
+
+    def __init__(self, conn, server):
+        self.conn = conn
+        self.server = server
+        self.objects: Dict[str, object] = {"transfer_manager": TransferManager()}
+        self.udt_ids = itertools.count(1)
+        self.authenticated = server.token is None
+        self.executor = ThreadPoolExecutor(CONTROL_THREADS)
+        self.send_lock = threading.Lock()
+        self.closed = threading.Event()
+
+    def run(self):
+        logger.info("on connect")
+        notifier = threading.Thread(target=self.notify_progress)
+        notifier.daemon = True
+        notifier.start()
+        try:
+            if not self.authenticated:
+                self.authenticate()
+            while (message := recv_message(self.conn)) is not None:
+                kind, request_id, value = message
+                if kind != CALL:
+                    raise ValueError("Unexpected message kind %d" % kind)
+                self.executor.submit(self.dispatch, request_id, value)
+        except (OSError, EOFError, ValueError, PermissionError):
+            logger.exception("Control connection failed")
+        finally:
+            logger.info("on disconnect")
+            self.closed.set()
+            self.executor.shutdown(wait=False)
+            self.conn.close()
+            # What the client left open, when the server outlives it.
+            for target, obj in self.objects.items():
+                if target.startswith("udt_manager:") and not obj.closed:
+                    obj.close()
+            self.server.session_ended()
+
+    def dispatch(self, request_id, call):
+        target, method, args, kwargs = call
+        try:
+            if not target and method == "create_udt_manager":
+                result = self.create_udt_manager(*args, **kwargs)
+            elif target in self.objects and not method.startswith("_"):
+                result = getattr(self.objects[target], method)(*args, **kwargs)
+            else:
+                raise AttributeError("No method %s.%s" % (target, method))
+        except SystemExit:
+            # TransferManager.finish: the client is done with the server,
+            # unless the server outlives its sessions.
+            self.reply(REPLY, request_id, None)
+            if not self.server.idle_seconds:
+                self.server.close()
+            return
+        except Exception as e:
+            logger.debug("%s.%s failed: %s", target, method, e)
+            self.reply(ERROR, request_id, (type(e).__name__, str(e)))
+            return
+        self.reply(REPLY, request_id, result)
+
+    def reply(self, kind, request_id, value):
+        try:
+            send_message(self.conn, self.send_lock, kind, request_id, value)
+        except ValueError as e:
+            # Not a plain value.
+            send_message(
+                self.conn,
+                self.send_lock,
+                ERROR,
+                request_id,
+                ("ValueError", str(e)),
+            )
+        except OSError as e:
+            logger.debug("Can't reply to %d: %s", request_id, e)
+
+    def authenticate(self):
+        """
+        Takes the AUTH the session must start with, raising PermissionError
+        unless it carries the server's token.
+        """
+        message = recv_raw(self.conn, CONTROL_AUTH_MAX_BYTES)
+        if message is None:
+            raise EOFError("Closed before authenticating")
+        kind, request_id, body = message
+        if kind != AUTH or not hmac.compare_digest(
+            bytes(body), self.server.token.encode()
+        ):
+            self.reply(ERROR, request_id, ("PermissionError", "Wrong token"))
+            raise PermissionError("Control connection failed to authenticate")
+        self.authenticated = True
+        self.reply(REPLY, request_id, None)
+
+    def create_udt_manager(self, *args) -> str:
+        target = "udt_manager:%d" % next(self.udt_ids)
+        self.objects[target] = ServerUDTManager(*args)
+        return target
+
+    def notify_progress(self):
+        """
+        Pushes the progress of the files of each ServerUDTManager every
+        CONTROL_NOTIFY_SECONDS when it changed.
+        """
+        last: Dict[str, tuple] = {}
+        while not self.closed.wait(CONTROL_NOTIFY_SECONDS):
+            for target, obj in list(self.objects.items()):
+                if not target.startswith("udt_manager:"):
+                    continue
+                received = obj.get_all_received()
+                if received == last.get(target):
+                    continue
+                last[target] = received
+                try:
+                    send_message(
+                        self.conn,
+                        self.send_lock,
+                        NOTIFY,
+                        0,
+                        (target + ".received", received),
+                    )
+                except OSError:
+                    return
@@ -0,0 +1,158 @@
+"""
+The client side of --persist, like OpenSSH's ControlMaster. The first run
+forks a master process that holds the SSH connection to the warp-server
+daemon (see daemon.py) and listens on a socket in CONTROL_SOCKET_DIR; that
+run and the later ones connect their ControlClient to the socket, so they
+skip the SSH handshake and the start of a server. The master opens an SSH
+channel to the daemon for each of them and authenticates the session with
+the daemon's token. One Forwarder (see forward.py) then forwards all the
+sessions as they are. It exits once it has had no client for the --persist
+number of seconds, or when the SSH connection drops.
+"""
+
+import hashlib
+import os
+import socket
+import threading
+import time
+from typing import Optional
+
+from common_tools import detach
+from config import CONTROL_SOCKET_DIR, logger
+from control import ControlClient, authenticate
+from forward import Forwarder, open_channel
+
+
+def socket_path(username, hostname, ssh_port) -> str:
+    # Hashed, as socket paths can't be much longer than 100 bytes.
+    key = "%s@%s:%d" % (username, hostname, ssh_port)
+    name = hashlib.sha256(key.encode()).hexdigest()[:32]
+    return os.path.join(CONTROL_SOCKET_DIR, name + ".sock")
+
+
+def connect_master(path) -> Optional[ControlClient]:
+    """
+    Returns a ControlClient through the master listening on path, None if
+    there is none.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return ControlClient(sock)
+
+
+def start_master(connection, path):
+    """
+    Forks the master of connection, which listens on path once connected to
+    the daemon. Returns once it listens; the parent never touches SSH.
+    """
+    read_fd, write_fd = os.pipe()
+    if os.fork():
+        os.close(write_fd)
+        with os.fdopen(read_fd, "rb") as f:
+            error = f.read()
+        if error:
+            raise RuntimeError(error.decode(errors="replace"))
+        return
+    os.close(read_fd)
+    try:
+        # Still on the terminal, should a password be asked for.
+        connection.connect_ssh()
+        master = ControlMaster(
+            connection.client.get_transport(),
+            connection.comm_port,
+            connection.token,
+            path,
+            connection.persist,
+        )
+    except BaseException as e:
+        error = "Could not start the SSH master: %s" % e
+        os.write(write_fd, error.encode())
+        os._exit(1)
+    detach()
+    os.close(write_fd)
+    try:
+        master.serve()
+    except Exception:
+        logger.exception("SSH master failed")
+    finally:
+        os._exit(0)
+
+
+class ControlMaster:
+    """
+    Listens on path, forwarding each client to the daemon at port over a
+    channel of transport.
+    """
+
+    def __init__(self, transport, port, token, path, persist_seconds):
+        self.transport = transport
+        self.port = port
+        self.token = token
+        self.path = path
+        self.persist_seconds = persist_seconds
+        self.clients = 0
+        self.last_active = time.monotonic()
+        self._lock = threading.Lock()
+        # Forwards the sessions once opened.
+        self.forwarder = Forwarder()
+
+        os.makedirs(CONTROL_SOCKET_DIR, 0o700, exist_ok=True)
+        # Left by a master that died.
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self.inode = os.stat(path).st_ino
+
+    def serve(self):
+        # Checked every second for the SSH connection, so the master may
+        # outlive its last client by persist_seconds and a second.
+        self.sock.settimeout(1)
+        try:
+            while self.transport.is_active():
+                try:
+                    conn, _ = self.sock.accept()
+                except socket.timeout:
+                    with self._lock:
+                        idle = time.monotonic() - self.last_active
+                        if not self.clients and idle >= self.persist_seconds:
+                            return
+                    continue
+                conn.settimeout(None)
+                with self._lock:
+                    self.clients += 1
+                thread = threading.Thread(target=self.handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.sock.close()
+            try:
+                # Unless a newer master took the path over.
+                if os.stat(self.path).st_ino == self.inode:
+                    os.remove(self.path)
+            except OSError:
+                pass
+
+    def handle(self, conn):
+        # In a thread of its own, as opening a session takes round trips.
+        try:
+            chan = open_channel(self.transport, "127.0.0.1", self.port)
+            authenticate(chan, self.token)
+        except Exception as e:
+            logger.error("Could not open a session: %s", e)
+            conn.close()
+            self.client_left()
+            return
+        self.forwarder.add(conn, chan, self.client_left)
+
+    def client_left(self):
+        with self._lock:
+            self.clients -= 1
+            self.last_active = time.monotonic()
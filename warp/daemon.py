@@ -0,0 +1,79 @@
+"""
+The warp-server daemon (warp-server --daemon): a control server that serves
+every session of the user on this host, so that a client run doesn't pay
+for starting a server. `warp-server --daemon` prints the port and token of
+the running daemon, starting one in the background first if there is none.
+The port, token and pid of the daemon are kept in DAEMON_STATE_PATH, only
+readable by the user, as the token is all it takes to use the daemon.
+"""
+
+import fcntl
+import os
+import secrets
+import socket
+from typing import Optional, Tuple
+
+from common_tools import detach
+from config import DAEMON_IDLE_SECONDS, DAEMON_STATE_PATH, logger
+from control import ControlServer
+
+
+def start_daemon() -> Tuple[int, str]:
+    """
+    Returns the port and token of the user's daemon, started unless it
+    already runs.
+    """
+    os.makedirs(os.path.dirname(DAEMON_STATE_PATH), 0o700, exist_ok=True)
+    # Runs starting at once agree on a single daemon.
+    with open(DAEMON_STATE_PATH + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if (state := read_state()) is not None:
+            return state
+        token = secrets.token_hex(32)
+        server = ControlServer(
+            hostname="localhost",
+            port=0,
+            token=token,
+            idle_seconds=DAEMON_IDLE_SECONDS,
+        )
+        if pid := os.fork():
+            # The daemon accepts on the socket, it is only closed here.
+            server.sock.close()
+            write_state(pid, server.port, token)
+            return server.port, token
+        # Or the lock would be held as long as the daemon runs.
+        lock.close()
+    detach()
+    logger.info("Daemon listening on port %d", server.port)
+    try:
+        server.start()
+    except Exception:
+        logger.exception("Daemon failed")
+    finally:
+        if read_state(check=False) == (server.port, token):
+            os.remove(DAEMON_STATE_PATH)
+        os._exit(0)
+
+
+def read_state(check=True) -> Optional[Tuple[int, str]]:
+    """
+    Returns the port and token of the daemon, if it runs and, with check,
+    accepts connections.
+    """
+    try:
+        with open(DAEMON_STATE_PATH) as f:
+            pid, port, token = f.read().split()
+        os.kill(int(pid), 0)
+        if check:
+            socket.create_connection(("localhost", int(port)), 1).close()
+    except (OSError, ValueError):
+        return None
+    return int(port), token
+
+
+def write_state(pid, port, token):
+    tmp_path = DAEMON_STATE_PATH + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write("%d %d %s\n" % (pid, port, token))
+    os.replace(tmp_path, DAEMON_STATE_PATH)
@@ -0,0 +1,251 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from bundle import BundleWriter
+from client_udt_manager import ClientUDTManager
+from common_tools import ThroughputMeter
+from config import logger
+from control import RemoteObject
+from delta import compute_delta
+from merkle import BlockTree
+
+
+class DataConnectionPool:
+    """
+    The data connections of a session. The server side (a ServerUDTManager)
+    is created once, and up to `size` connections to it are opened and kept
+    for the whole session. Every file is sent over whichever connection is
+    idle, in frames tagged with its file id, so files don't pay for a
+    connection and nonce handshake each.
+    """
+
+    def __init__(
+        self,
+        server_channel,
+        hostname,
+        tcp_mode,
+        size,
+        meter=None,
+        compressor=None,
+        pacer=None,
+        use_mmap=False,
+        sync="none",
+        hash_algorithm="sha256",
+    ):
+        self.server_channel = server_channel
+        self.hostname = hostname
+        self.tcp_mode = tcp_mode
+        self.size = size
+        self.meter = meter if meter is not None else ThroughputMeter()
+        self.compressor = compressor
+        self.pacer = pacer
+        self.use_mmap = use_mmap
+        self.sync = sync
+        self.hash_algorithm = hash_algorithm
+        self.server_udt_manager = None
+        # Bytes received by the server per open file, as of the last call to
+        # poll_received.
+        self.received: Dict[int, int] = {}
+        # Whether the server pushes it instead, see control.py.
+        self.received_pushed = False
+        self.port = None
+        self.nonce = None
+        self._lock = threading.Lock()
+        self._idle: "queue.Queue[ClientUDTManager]" = queue.Queue()
+        self._opened = 0
+
+    def open(self):
+        """
+        Opens the connections in the background, so they are ready by the
+        time the first files have been looked at.
+        """
+        thread = threading.Thread(target=self._warm_up)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _warm_up(self):
+        try:
+            for _ in range(self.size):
+                connection = self._new_connection()
+                if connection is None:
+                    return
+                self._idle.put(connection)
+        except Exception:
+            logger.exception("Could not pre-open data connections")
+
+    def get_server_udt_manager(self):
+        with self._lock:
+            if self.server_udt_manager is None:
+                self.server_udt_manager = self.server_channel.root.get_udt_manager()(
+                    self.tcp_mode, self.sync, self.hash_algorithm
+                )
+                (
+                    self.port,
+                    self.nonce,
+                ) = self.server_udt_manager.open_connection()
+                subscribe = getattr(self.server_channel, "subscribe", None)
+                if subscribe is not None:
+                    subscribe(
+                        self.server_udt_manager.target + ".received",
+                        self.update_received,
+                    )
+                    self.received_pushed = True
+            return self.server_udt_manager
+
+    def _new_connection(self):
+        """
+        Opens another connection if the pool isn't full, else returns None.
+        """
+        self.get_server_udt_manager()
+        with self._lock:
+            if self._opened >= self.size:
+                return None
+            self._opened += 1
+        connection = ClientUDTManager(self.hostname, self.tcp_mode)
+        connection.compressor = self.compressor
+        connection.pacer = self.pacer
+        connection.use_mmap = self.use_mmap
+        connection.hash_algorithm = self.hash_algorithm
+        try:
+            connection.connect(self.port, self.nonce)
+        except BaseException:
+            self._discard(connection)
+            raise
+        return connection
+
+    def _discard(self, connection):
+        connection.close()
+        with self._lock:
+            self._opened -= 1
+
+    def acquire(self) -> ClientUDTManager:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        while True:
+            connection = self._new_connection()
+            if connection is not None:
+                return connection
+            try:
+                # A connection given up on frees a slot, so look again
+                # every so often instead of only waiting for a release.
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    def release(self, connection):
+        self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        """
+        Lends a connection for the duration of the with block. It is given up
+        on if the block raises, the stream may be out of sync.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            self._discard(connection)
+            raise
+        self.release(connection)
+
+    def open_file(self, filepath, file_size=0, block_size=0, sparse=False) -> int:
+        return self.get_server_udt_manager().open_file(
+            filepath, file_size, block_size, sparse
+        )
+
+    def finish_file(self, file_id, expected_size):
+        return self.get_server_udt_manager().finish_file(file_id, expected_size)
+
+    def finish_file_async(self, file_id, expected_size) -> Optional[Future]:
+        """
+        Asks for finish_file without waiting for the reply, which only the
+        binary control channel can. Returns the future of the reply, None
+        if the caller has to call finish_file instead.
+        """
+        server_udt_manager = self.get_server_udt_manager()
+        if not isinstance(server_udt_manager, RemoteObject):
+            return None
+        return server_udt_manager.call_async("finish_file", file_id, expected_size)
+
+    def open_bundle(self, dest_root, copy_status, verify) -> int:
+        return self.get_server_udt_manager().open_bundle(dest_root, copy_status, verify)
+
+    def finish_bundle(self, bundle_id, stream_size):
+        return self.get_server_udt_manager().finish_bundle(bundle_id, stream_size)
+
+    def abort_file(self, file_id):
+        self.get_server_udt_manager().abort_file(file_id)
+
+    def get_total_recieved(self, file_id):
+        return self.received.get(file_id, 0)
+
+    def poll_received(self):
+        """
+        Fetches how much of each open file the server has received.
+        """
+        if self.server_udt_manager is not None and not self.received_pushed:
+            self.update_received(self.server_udt_manager.get_all_received())
+
+    def update_received(self, received):
+        self.received = dict(received)
+
+    def send_range(self, file_id, file_src, offset, end, block_size, hash_blocks=False):
+        """
+        Sends file_src from offset to end over one of the connections.
+        Returns the bytes put on the wire, the seconds it took and, with
+        hash_blocks, the hash of each block sent by block index.
+        """
+        digests: Optional[Dict[int, bytes]] = {} if hash_blocks else None
+        with self.connection() as connection:
+            start_time = time.time()
+            wire_bytes = connection.send_data(
+                file_id, file_src, offset, end, block_size, digests
+            )
+            seconds = time.time() - start_time
+            self.meter.record(wire_bytes, seconds)
+        return wire_bytes, seconds, digests
+
+    def send_bundle(self, bundle_id, files, verify):
+        """
+        Packs files, (source, path relative to the bundle's root, size)
+        tuples, into the bundle bundle_id and sends it over one of the
+        connections. Returns the sources that could be read, their hashes
+        if verifying, and the size of the stream.
+        """
+        sources = []
+        with self.connection() as connection:
+            writer = BundleWriter(connection, bundle_id, verify, self.hash_algorithm)
+            for file_src, rel_path, _ in files:
+                try:
+                    writer.add(file_src, rel_path)
+                except OSError:
+                    logger.exception("Can't read %s", file_src)
+                    continue
+                sources.append(file_src)
+            writer.flush()
+        return sources, writer.digests, writer.offset
+
+    def block_tree(self, file_src, block_size, length) -> BlockTree:
+        return BlockTree.from_file(file_src, block_size, length, self.hash_algorithm)
+
+    def compute_delta(self, file_src, block_size, signature, server_size):
+        return compute_delta(
+            file_src, block_size, signature, server_size, self.hash_algorithm
+        )
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        if self.server_udt_manager is not None:
+            self.server_udt_manager.close()
@@ -0,0 +1,71 @@
+"""
+Deduplication of the files of a recursive transfer (--dedup). Files that
+are hard links to the same inode, or that have the same content, are only
+sent once; the server then hard links (see TransferManager.link_files) or
+copies the file received to the other destinations.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from typing import Dict, List, Optional, Tuple
+
+from common_tools import getHash
+from config import HASH_THREADS, logger
+
+
+def find_duplicates(paths, algorithm) -> Dict[str, Tuple[str, bool]]:
+    """
+    Returns, for each of paths that is a hard link to or has the same
+    content as a path before it, the first of those paths, the one sent,
+    and whether it is a hard link to it. Only files of a size shared with
+    others are hashed.
+    """
+    duplicates: Dict[str, Tuple[str, bool]] = {}
+    inodes: Dict[Tuple[int, int], str] = {}
+    # Inode of each path, (device, number).
+    inode_of: Dict[str, Tuple[int, int]] = {}
+    by_size: Dict[int, List[str]] = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        inode_of[path] = (st.st_dev, st.st_ino)
+        original = inodes.setdefault(inode_of[path], path)
+        if original != path:
+            duplicates[path] = (original, True)
+        elif st.st_size:
+            by_size.setdefault(st.st_size, []).append(path)
+    groups = [group for group in by_size.values() if len(group) > 1]
+    candidates = [path for group in groups for path in group]
+    with ThreadPoolExecutor(HASH_THREADS) as executor:
+        hashes = dict(
+            zip(
+                candidates,
+                executor.map(hash_file, candidates, repeat(algorithm)),
+            )
+        )
+    for group in groups:
+        originals: Dict[str, str] = {}
+        for path in group:
+            if hashes[path] is None:
+                continue
+            original = originals.setdefault(hashes[path], path)
+            if original != path:
+                duplicates[path] = (original, False)
+    # A hard link to a file with the same content as an earlier one
+    # duplicates a duplicate: it is made from the file sent instead.
+    for path, (original, _) in duplicates.items():
+        while original in duplicates:
+            original = duplicates[original][0]
+        duplicates[path] = (original, inode_of[path] == inode_of[original])
+    logger.debug("%d duplicate files", len(duplicates))
+    return duplicates
+
+
+def hash_file(path, algorithm) -> Optional[str]:
+    try:
+        return getHash(path, algorithm)
+    except OSError:
+        return None
@@ -0,0 +1,342 @@
+"""
+Delta transfers (--delta), after rsync. The server sums up its copy of a
+file as a signature: the adler32 and strong hash (see hashing.py) of each
+of its blocks. The client rolls adler32 over every offset of its own copy
+to find the blocks the server already has, wherever they moved to, and
+confirms them with the strong hash. The server then rebuilds its copy from
+the blocks that are reused (see TransferManager.apply_delta), and only the
+data in between is sent over the data connections.
+
+Blocks that all move the same way, as when data was inserted or deleted,
+are moved in place, in an order that never overwrites one still to be
+moved. Otherwise the copy is rebuilt into a new file that replaces it,
+which takes room for both while it lasts.
+
+Rolling the checksum needs NumPy, installed with the delta extra (pip
+install warp[delta]); without it, only the blocks found at block boundaries
+of the client's copy are reused, which still covers data changed in place
+(database files, disk images).
+"""
+
+import os
+import struct
+import zlib
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+from bundle import PART_SUFFIX
+from common_tools import pread_into, pwrite_all
+from config import (
+    DELTA_MAX_BLOCK_SIZE,
+    DELTA_MIN_BLOCK_SIZE,
+    DELTA_SCAN_SIZE,
+    IO_BUFFER_SIZE,
+    logger,
+)
+from hash_cache import hash_cache
+from hashing import DIGEST_SIZE, digest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Whether warn_without_numpy has warned.
+_warned = False
+
+# A block of a signature: its adler32 and strong hash.
+SIGNATURE_ENTRY = struct.Struct("!I%ds" % DIGEST_SIZE)
+
+ADLER_MOD = 65521
+
+# (target offset, source offset, length) of data the server moves, and
+# (offset, length) of data the client sends.
+Copies = Tuple[Tuple[int, int, int], ...]
+Literals = Tuple[Tuple[int, int], ...]
+
+
+def warn_without_numpy():
+    """
+    Warns once, if NumPy is missing, that data inserted or deleted in a
+    file has the rest of it sent again.
+    """
+    global _warned
+    if numpy is None and not _warned:
+        _warned = True
+        logger.warning(
+            "NumPy is not installed: --delta only finds data that didn't"
+            " move, what follows an insertion or a deletion is sent again."
+            " Install warp[delta] to find moved data."
+        )
+
+
+def delta_block_size(file_size) -> int:
+    """
+    Returns the block size to compare a file of file_size bytes in: about
+    the square root of its size, as a power of two between
+    DELTA_MIN_BLOCK_SIZE and DELTA_MAX_BLOCK_SIZE.
+    """
+    block_size = DELTA_MIN_BLOCK_SIZE
+    while block_size * block_size < file_size:
+        if block_size >= DELTA_MAX_BLOCK_SIZE:
+            break
+        block_size *= 2
+    return block_size
+
+
+def signature(filepath, block_size, algorithm) -> bytes:
+    """
+    Returns the signature of filepath, a SIGNATURE_ENTRY per block of
+    block_size bytes (the last one possibly shorter).
+    """
+    return hash_cache.cached(
+        filepath,
+        "%s:delta:%d" % (algorithm, block_size),
+        lambda: _signature(filepath, block_size, algorithm),
+    )
+
+
+def _signature(filepath, block_size, algorithm) -> bytes:
+    entries = bytearray()
+    with open(filepath, "rb") as f:
+        while block := f.read(block_size):
+            entries += SIGNATURE_ENTRY.pack(
+                zlib.adler32(block), digest(algorithm, block)
+            )
+    return bytes(entries)
+
+
+def rolling_adler32(data, block_size):
+    """
+    Returns the adler32 of every block_size bytes window of data, by offset.
+    """
+    x = numpy.frombuffer(data, dtype=numpy.uint8)
+    index = numpy.arange(len(x), dtype=numpy.int64)
+    # Prefix sums of the bytes and of the bytes weighted by their offset:
+    # adler32's a and b of any window follow from two of each.
+    sums = numpy.zeros(len(x) + 1, dtype=numpy.int64)
+    numpy.cumsum(x, out=sums[1:])
+    weighted = numpy.zeros(len(x) + 1, dtype=numpy.int64)
+    numpy.cumsum(x * index, out=weighted[1:])
+    a = sums[block_size:] - sums[:-block_size]
+    b = (index[: len(a)] + block_size) * a
+    b -= weighted[block_size:] - weighted[:-block_size]
+    return ((b + block_size) % ADLER_MOD) << 16 | (a + 1) % ADLER_MOD
+
+
+class DeltaBuilder:
+    """
+    Turns the blocks of the server's copy found in the client's copy, in
+    offset order, into copies and literals.
+    """
+
+    def __init__(self, sources: Dict[bytes, List[int]], algorithm):
+        # Offsets of the blocks of the server's copy, by strong hash.
+        self.sources = sources
+        self.algorithm = algorithm
+        self.copies: List[Tuple[int, int, int]] = []
+        self.literals: List[Tuple[int, int]] = []
+        # Where the data not yet matched starts.
+        self.pos = 0
+        self.reused = 0
+
+    def match(self, offset, block) -> bool:
+        """
+        Reuses a block of the server's copy for block, found at offset in
+        the client's copy, if there is one it can be copied from.
+        """
+        sources = self.sources.get(digest(self.algorithm, block))
+        if not sources:
+            return False
+        # The block after the last one reused if it matches, so that runs
+        # move whole; else the server's copy at offset itself or the first
+        # block after it, then the last one before it. Moves in a single
+        # direction are made in place, see apply_delta.
+        source = offset
+        if self.copies:
+            target, start, size = self.copies[-1]
+            if target + size == offset:
+                source = start + size
+        i = bisect_left(sources, source)
+        if i == len(sources) or sources[i] != source:
+            i = bisect_left(sources, offset)
+            source = sources[min(i, len(sources) - 1)]
+        self.add(offset, source, len(block))
+        return True
+
+    def add(self, offset, source, length):
+        if offset > self.pos:
+            self.literals.append((self.pos, offset - self.pos))
+        target, start, size = self.copies[-1] if self.copies else (0,) * 3
+        if size and (target + size, start + size) == (offset, source):
+            # Continues the previous copy.
+            self.copies[-1] = (target, start, size + length)
+        else:
+            self.copies.append((offset, source, length))
+        self.pos = offset + length
+        self.reused += length
+
+    def finish(self, file_size):
+        if file_size > self.pos:
+            self.literals.append((self.pos, file_size - self.pos))
+
+
+class WeakFinder:
+    """
+    Finds where, in the client's copy, a block starts whose adler32 is that
+    of a block of the server's copy, by rolling adler32 over spans of the
+    file growing up to DELTA_SCAN_SIZE bytes.
+    """
+
+    def __init__(self, weaks, block_size):
+        self.weaks = numpy.array(sorted(weaks), dtype=numpy.int64)
+        # Whether a block of the server's copy has these low 16 bits of
+        # adler32, a first filter cheaper than searching weaks.
+        self.table = numpy.zeros(1 << 16, dtype=bool)
+        self.table[self.weaks & 0xFFFF] = True
+        self.block_size = block_size
+        # The offsets found in the last span rolled over, [start, end).
+        self.start = self.end = 0
+        self.hits = self.weaks[:0]
+
+    def find(self, fd, offset, file_size) -> int:
+        """
+        Returns the first offset from offset on where such a block starts,
+        or file_size if there is none.
+        """
+        span = self.block_size
+        while offset + self.block_size <= file_size:
+            if not self.start <= offset < self.end:
+                self.roll(fd, offset, span)
+                span = min(span * 2, DELTA_SCAN_SIZE)
+            i = numpy.searchsorted(self.hits, offset)
+            if i < len(self.hits):
+                return int(self.hits[i])
+            offset = self.end
+        return file_size
+
+    def roll(self, fd, offset, span):
+        data = os.pread(fd, span + self.block_size - 1, offset)
+        rolling = rolling_adler32(data, self.block_size)
+        hits = numpy.flatnonzero(self.table[rolling & 0xFFFF])
+        found = numpy.searchsorted(self.weaks, rolling[hits])
+        found[found == len(self.weaks)] = 0
+        self.hits = hits[self.weaks[found] == rolling[hits]] + offset
+        self.start, self.end = offset, offset + len(rolling)
+
+
+def compute_delta(
+    filepath, block_size, server_signature, server_size, algorithm
+) -> Tuple[Copies, Literals]:
+    """
+    Compares filepath with the server's copy, of server_size bytes and
+    summed up by server_signature with algorithm. Returns the copies that
+    rebuild filepath from the server's copy, in target order and including
+    the blocks that stay where they are, and the literals to send on top.
+    """
+    entries = [
+        SIGNATURE_ENTRY.unpack_from(server_signature, i)
+        for i in range(0, len(server_signature), SIGNATURE_ENTRY.size)
+    ]
+    whole_blocks = server_size // block_size
+    sources: Dict[bytes, List[int]] = {}
+    for i, (_, strong) in enumerate(entries[:whole_blocks]):
+        sources.setdefault(strong, []).append(i * block_size)
+    weaks = {weak for weak, _ in entries[:whole_blocks]}
+    builder = DeltaBuilder(sources, algorithm)
+    finder = None
+    if numpy is not None and weaks:
+        finder = WeakFinder(weaks, block_size)
+    with open(filepath, "rb") as f:
+        fd = f.fileno()
+        file_size = os.fstat(fd).st_size
+        offset = 0
+        # Blocks are looked for where the last one found ends, which finds
+        # unchanged runs without rolling, and rolled for after a mismatch.
+        while weaks and offset + block_size <= file_size:
+            block = os.pread(fd, block_size, offset)
+            if zlib.adler32(block) in weaks and builder.match(offset, block):
+                offset += block_size
+            elif finder is None:
+                offset += block_size
+            else:
+                offset = finder.find(fd, offset + 1, file_size)
+        # The server's last block, if shorter, can only be reused as the
+        # end of the file.
+        tail = server_size - whole_blocks * block_size
+        target = file_size - tail
+        if tail and builder.pos <= target:
+            data = os.pread(fd, tail, target)
+            if digest(algorithm, data) == entries[-1][1]:
+                builder.add(target, server_size - tail, tail)
+    builder.finish(file_size)
+    logger.debug(
+        "%s: %d bytes found on the server, %d to send",
+        filepath,
+        builder.reused,
+        file_size - builder.reused,
+    )
+    return tuple(builder.copies), tuple(builder.literals)
+
+
+def apply_delta(filepath, copies: Copies, size):
+    """
+    Rebuilds filepath from its blocks listed in copies, and cuts or extends
+    it to size.
+    """
+    moves = [copy for copy in copies if copy[0] != copy[1]]
+    buf = bytearray(IO_BUFFER_SIZE)
+    if all(source > target for target, source, _ in moves):
+        # In target order, each block is read before the blocks moved
+        # ahead of it reach its offset.
+        with _open(filepath) as fd:
+            for target, source, length in moves:
+                _copy(fd, fd, target, source, length, buf)
+            os.ftruncate(fd, size)
+    elif all(source < target for target, source, _ in moves):
+        # The same from the end, a move that overlaps itself is copied
+        # back to front.
+        with _open(filepath) as fd:
+            for target, source, length in reversed(moves):
+                _copy(fd, fd, target, source, length, buf, backwards=True)
+            os.ftruncate(fd, size)
+    else:
+        part_path = filepath + PART_SUFFIX
+        try:
+            with _open(filepath, os.O_RDONLY) as fd:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                with _open(part_path, flags) as part_fd:
+                    os.fchmod(part_fd, os.fstat(fd).st_mode & 0o7777)
+                    for target, source, length in copies:
+                        _copy(fd, part_fd, target, source, length, buf)
+                    os.ftruncate(part_fd, size)
+            os.replace(part_path, filepath)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+
+@contextmanager
+def _open(path, flags=os.O_RDWR):
+    fd = os.open(path, flags, 0o600)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def _copy(fd, dest_fd, target, source, length, buf, backwards=False):
+    """
+    Copies length bytes of fd at source to dest_fd at target, through buf.
+    """
+    done = 0
+    while done < length:
+        n = min(len(buf), length - done)
+        offset = length - done - n if backwards else done
+        view = memoryview(buf)[:n]
+        if pread_into(fd, view, source + offset) < n:
+            raise EOFError("Source of a delta is shorter than expected")
+        pwrite_all(dest_fd, view, target + offset)
+        done += n
@@ -0,0 +1,85 @@
+import os
+from typing import List, Optional, Tuple
+
+from config import logger
+
+
+class DuplicateTransferAgent:
+    """
+    Sends the files of another agent, then has the server hard link or copy
+    them to the destinations of their duplicates (see dedup.py), in one
+    round trip. Exposes the same progress attributes as FileTransferAgent.
+    """
+
+    def __init__(self, transfer_manager, dest_root, source, duplicates, stat):
+        self.transfer_manager = transfer_manager
+        self.dest_root = dest_root
+        # The agent sending the files duplicated.
+        self.source = source
+        # (path of the duplicate, path of its destination relative to
+        # dest_root, that of the file it duplicates, whether it is a hard
+        # link to it) of each duplicate.
+        self.duplicates: List[Tuple[str, str, str, bool]] = duplicates
+        self.stat = stat
+        self.is_transferring = False
+        self.transfer_finished = False
+        self.transfer_success = False
+        self.is_verifying = False
+        # Why the transfer failed, as reported for manifest entries.
+        self.error: Optional[str] = None
+
+    @property
+    def file_count(self) -> int:
+        return len(self.duplicates)
+
+    @property
+    def file_size(self) -> int:
+        if not hasattr(self, "_file_size"):
+            self._file_size = sum(
+                os.path.getsize(file_src) for file_src, *_ in self.duplicates
+            )
+        return self._file_size
+
+    def get_progress(self):
+        return self.file_size if self.transfer_finished else 0
+
+    def send_file(self):
+        self.source.send_file()
+        if not self.source.transfer_success:
+            logger.error(
+                "Not linking %d duplicates of files that failed",
+                self.file_count,
+            )
+            self.error = "%d duplicates of files that failed not linked" % (
+                self.file_count
+            )
+            self.transfer_finished = True
+            return
+        self.is_transferring = True
+        links = []
+        for file_src, rel_path, original, hardlink in self.duplicates:
+            status = None
+            if self.stat:
+                stats = os.stat(file_src)
+                status = (stats.st_atime, stats.st_mtime, stats.st_mode)
+            links.append(
+                (
+                    os.path.join(self.dest_root, original),
+                    os.path.join(self.dest_root, rel_path),
+                    hardlink,
+                    status,
+                )
+            )
+        try:
+            results = self.transfer_manager.link_files(tuple(links))
+        except Exception as e:
+            logger.exception("Could not link duplicates")
+            self.error = "Could not link duplicates: %s" % e
+            results = ()
+        self.is_transferring = False
+        self.transfer_success = len(results) == len(links) and all(results)
+        if results and not self.transfer_success:
+            self.error = "%d duplicates could not be linked" % (
+                len(links) - sum(map(bool, results))
+            )
+        self.transfer_finished = True
@@ -0,0 +1,68 @@
+"""
+The client's transfer engine: one asyncio event loop, in a thread of its
+own, runs every transfer agent of the session as a task. The blocking steps
+of the agents, opening files and sending their data, run on an executor of
+--parallelism threads. Once its data is sent, a file waits for the server
+to acknowledge it (see FileTransferAgent.send_data) as a future of the
+control channel, without holding a thread, so many more files than threads
+are in flight.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from config import IN_FLIGHT_FILES, logger
+
+
+class TransferEngine:
+    def __init__(self, parallelism):
+        self.loop = asyncio.new_event_loop()
+        # Where the agents' blocking steps run, parallelism at a time.
+        self.executor = ThreadPoolExecutor(max_workers=parallelism)
+        # Bounds the agents running, the others wait for their turn as
+        # tasks. Made on the loop, as it binds to it before Python 3.10.
+        self.in_flight: Optional[asyncio.Semaphore] = None
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, agent):
+        """
+        Has agent run on the loop, once fewer than IN_FLIGHT_FILES run.
+        """
+        asyncio.run_coroutine_threadsafe(self.send(agent), self.loop)
+
+    async def send(self, agent):
+        if self.in_flight is None:
+            self.in_flight = asyncio.Semaphore(IN_FLIGHT_FILES)
+        async with self.in_flight:
+            await self.run_agent(agent)
+
+    async def run_agent(self, agent):
+        try:
+            # Agents that can't have their file acknowledged apart, see
+            # send_data, are run whole on the executor.
+            if not hasattr(agent, "send_data"):
+                await self.run(agent.send_file)
+            elif await self.run(agent.send_data):
+                future = agent.finish_future()
+                if future is None:
+                    result = await self.run(agent.finish_file)
+                else:
+                    result = await asyncio.wrap_future(future)
+                await self.run(agent.finished, *result)
+        except Exception as e:
+            logger.exception("Transfer agent failed")
+            if agent.error is None:
+                agent.error = "%s: %s" % (type(e).__name__, e)
+            agent.is_transferring = False
+            agent.transfer_finished = True
+
+    def run(self, func, *args) -> asyncio.Future:
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
@@ -1,9 +1,19 @@
 import os
+import queue
 import threading
-from typing import Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
 
-from common_tools import getHash
-from config import CHUNK_SIZE, logger
+from common_tools import choose_block_size, is_sparse
+from config import (
+    MIN_BLOCK_SIZE,
+    RESUME_THRESHOLD,
+    STRIPE_SIZE,
+    STRIPE_THRESHOLD,
+    logger,
+)
+from delta import delta_block_size
+from merkle import BlockTree
 
 from transfer_manager import TransferManager
 
@@ -28,6 +38,8 @@ class FileTransferAgent:
     _base_server_file_size: Union[int, float]
     _base_server_validated_size: Union[int, float]
     _file_size: int
+    # Files sent by the agent, see BundleTransferAgent.
+    file_count = 1
 
     def __init__(
         self,
@@ -38,6 +50,9 @@ class FileTransferAgent:
         verify,
         createDirs,
         stat,
+        stripes=1,
+        delta=False,
+        metadata=None,
     ):
         self.file_dest = file_dest
         self.file_name = file_name
@@ -51,6 +66,43 @@ class FileTransferAgent:
         self.transfer_manager: TransferManager = transfer_manager
         self.createDirs = createDirs
         self.block_count = 0
+        self.block_size = MIN_BLOCK_SIZE
+        self.stripes = stripes
+        # Whether to send only what differs from the server's copy, see
+        # delta.py, and whether this file is sent that way.
+        self.delta = delta
+        self.is_delta = False
+        # Where the file's times and mode go to be set on the server in a
+        # batch, see metadata_batch.py; set one by one if None.
+        self.metadata = metadata
+        # Whether prepared has been given the server's state of the file,
+        # and the root of the block tree of its copy if the server had it.
+        self.is_prepared = False
+        self.server_root: Optional[str] = None
+        # Blocks the server still needs when it journals the file, or the
+        # data it lacks when sent as a delta.
+        self.missing_ranges: Optional[List[Tuple[int, int]]] = None
+        # The server's id for the file while its data is being sent.
+        self.file_id: Optional[int] = None
+        # Hashes of the blocks sent, by block index, when verifying.
+        self.block_digests: Dict[int, bytes] = {}
+        # Why the transfer failed, as reported for manifest entries.
+        self.error: Optional[str] = None
+
+    @property
+    def is_striped(self) -> bool:
+        return self.stripes > 1 and self.file_size >= STRIPE_THRESHOLD
+
+    @property
+    def is_resumable(self) -> bool:
+        # Whether the server journals the blocks it receives, see
+        # resume_journal.py.
+        return self.is_striped or self.file_size >= RESUME_THRESHOLD
+
+    @property
+    def stripe_size(self) -> int:
+        # A whole number of blocks, so stripes never split a block.
+        return max(1, STRIPE_SIZE // self.block_size) * self.block_size
 
     def get_progress(self):
         if self.is_verifying or (
@@ -60,9 +112,48 @@ class FileTransferAgent:
         elif self.is_transferring is False and self.transfer_finished is False:
             return self.base_server_validated_size
         elif self.is_transferring is True and self.transfer_finished is False:
-            return self.udt.get_total_recieved()
+            if self.file_id is None:
+                return self.base_server_validated_size
+            return self.base_server_validated_size + (
+                self.udt.get_total_recieved(self.file_id)
+            )
         return 0
 
+    def prepare_record(self) -> Optional[Tuple[str, str, bool, int, int]]:
+        """
+        Returns what TransferManager.prepare_files needs of the file, or
+        None if it can't be read, which fails the transfer.
+        """
+        try:
+            self.get_total_size()
+        except OSError as e:
+            logger.error("Can't send %s: %s", self.file_name, e)
+            self.error = "Can't read %s: %s" % (
+                self.file_name,
+                e.strerror or e,
+            )
+            self._file_size = 0
+            self.transfer_finished = True
+            return None
+        return (
+            self.file_dest,
+            self.file_name,
+            self.createDirs,
+            self.file_size,
+            choose_block_size(self.file_size, self.udt.meter.rate),
+        )
+
+    def prepared(self, result):
+        """
+        Takes the server's state of the file from prepare_files, instead of
+        asking for it piece by piece.
+        """
+        self.validate_success, self._server_file_path = result[:2]
+        if self.validate_success:
+            self._base_server_file_size = result[2]
+            self.block_size, self.server_root = result[3:]
+            self.is_prepared = True
+
     @synchronized
     def get_server_file_size(self):
         if not hasattr(self, "_base_server_file_size"):
@@ -80,20 +171,34 @@ class FileTransferAgent:
     @synchronized
     def get_server_validated_size(self):
         if not hasattr(self, "_base_server_validated_size"):
-            if self.base_server_file_size > 0:
-                self.block_count = 0
-                if self.base_server_file_size != self.file_size:
-                    self.block_count = self.transfer_manager.get_blocks(
-                        self.server_file_path
+            # The negotiated block size is the unit of the resume offset, the
+            # server uses it rather than its own default to count blocks.
+            if not self.is_prepared:
+                self.block_size = self.transfer_manager.negotiate_block_size(
+                    choose_block_size(self.file_size, self.udt.meter.rate)
+                )
+            if self.is_resumable:
+                resume = self.transfer_manager.get_missing_ranges(
+                    self.server_file_path, self.file_size, self.source_mtime
+                )
+                if resume is not None:
+                    # Blocks are counted the way the journal counts them.
+                    self.block_size, missing = resume
+                    self.missing_ranges = list(missing)
+                    self._base_server_validated_size = self.file_size - sum(
+                        length for _, length in self.missing_ranges
                     )
-                file_hash = self.transfer_manager.get_file_hash(
-                    self.server_file_path
+                    return self._base_server_validated_size
+            if self.delta and self.base_server_file_size > 0:
+                self.missing_ranges = self.prepare_delta()
+                self.is_delta = True
+                self._base_server_validated_size = self.file_size - sum(
+                    length for _, length in self.missing_ranges
                 )
-                if not self.verify_partial_hash(self.file_name, file_hash):
-                    logger.debug("Client and server side partial hash differ.")
-                    self.transfer_manager.overwrite_file(self.server_file_path)
-                    self.block_count = 0
-                elif self.block_count == 0:
+                return self._base_server_validated_size
+            if self.base_server_file_size > 0:
+                self.block_count = self.find_resume_block()
+                if self.block_count is None:
                     logger.debug("File already transfered")
                     self.transfer_finished = True
                     self.transfer_success = True
@@ -102,10 +207,22 @@ class FileTransferAgent:
                         self.base_server_file_size
                     )
                     return self._base_server_validated_size
-            else:
+            elif not self.is_prepared:
                 # This will create the file on the server side
                 self.transfer_manager.overwrite_file(self.server_file_path)
-            self._base_server_validated_size = self.block_count * CHUNK_SIZE
+            if self.is_resumable:
+                self.missing_ranges = list(
+                    self.transfer_manager.start_resumable_file(
+                        self.server_file_path,
+                        self.file_size,
+                        self.block_size,
+                        self.source_mtime,
+                        self.block_count * self.block_size,
+                    )
+                )
+            self._base_server_validated_size = (
+                self.block_count * self.block_size
+            )
         return self._base_server_validated_size
 
     @property
@@ -127,6 +244,11 @@ class FileTransferAgent:
     def server_file_path(self) -> str:
         return self.get_server_file_path()
 
+    @property
+    def source_mtime(self) -> int:
+        # With the size, what identifies the source of a journaled transfer.
+        return os.stat(self.file_name).st_mtime_ns
+
     @synchronized
     def get_total_size(self) -> int:
         if not hasattr(self, "_file_size"):
@@ -139,30 +261,99 @@ class FileTransferAgent:
         return self.get_total_size()
 
     def send_file(self):
+        if self.send_data():
+            self.finished(*self.finish_file())
+
+    def send_data(self) -> bool:
+        """
+        Opens the file on the server and sends its data. Returns whether
+        the server is then to acknowledge it, see finish_file and
+        finish_future, and finished to be given the acknowledgement.
+        """
         logger.debug("Source " + self.file_name + " Dest: " + self.file_dest)
 
         logger.debug("Saving to... " + self.server_file_path)
 
         if not self.validate_success:
+            # What validate_filepath had to say instead of the path.
+            self.error = self._server_file_path
             self.is_transferring = False
             self.transfer_finished = True
             self.transfer_success = False
-            return
+            return False
 
         # This will compute the block count
         if self.base_server_validated_size == self.file_size:
-            return
+            # Nothing to send, e.g. an empty file.
+            self.transfer_finished = True
+            self.transfer_success = True
+            return False
 
-        self.udt.connect()
-        self.is_transferring = True
-        self.udt.send_file(
-            self.file_name,
+        # When verifying, both sides hash each block as it goes through,
+        # except for a delta, which doesn't send whole blocks.
+        self.file_id = self.udt.open_file(
             self.server_file_path,
-            self.block_count,
             self.file_size,
+            self.block_size if self.verify and not self.is_delta else 0,
+            is_sparse(self.file_name),
+        )
+        self.is_transferring = True
+        try:
+            if self.missing_ranges is not None:
+                self.send_missing_ranges()
+            else:
+                self.send_range(
+                    self.base_server_validated_size, self.file_size
+                )
+        except Exception as e:
+            logger.exception("Could not send %s", self.file_name)
+            self.error = "Could not send %s: %s" % (self.file_name, e)
+            self.udt.abort_file(self.file_id)
+            self.finished(False, None)
+            return False
+        return True
+
+    def finish_file(self) -> Tuple[bool, Optional[str]]:
+        """
+        Waits for the server to have all the data sent, and returns whether
+        it has with the root of the block tree of what it received.
+        """
+        return self.udt.finish_file(
+            self.file_id, self.file_size - self.base_server_validated_size
         )
 
-        if self.stat:
+    def finish_future(self) -> Optional[Future]:
+        """
+        finish_file as a future, or None where the control channel can't.
+        """
+        return self.udt.finish_file_async(
+            self.file_id, self.file_size - self.base_server_validated_size
+        )
+
+    def finished(self, received, server_digest):
+        """
+        Completes the transfer of the file once the server acknowledged
+        it, with what finish_file returned.
+        """
+        self.file_id = None
+        if not received:
+            logger.error("Data of %s did not all arrive.", self.file_name)
+            if self.error is None:
+                self.error = "Data of %s did not all arrive" % self.file_name
+            self.is_transferring = False
+            self.transfer_finished = True
+            self.transfer_success = False
+            return
+
+        if self.stat and self.metadata is not None:
+            stats = os.stat(self.file_name)
+            self.metadata.add(
+                self.server_file_path,
+                stats.st_atime,
+                stats.st_mtime,
+                stats.st_mode,
+            )
+        elif self.stat:
             stats = os.stat(self.file_name)
             self.transfer_manager.set_timestamps(
                 self.server_file_path, (stats.st_atime, stats.st_mtime)
@@ -173,28 +364,182 @@ class FileTransferAgent:
 
         self.is_transferring = False
 
-        if self.verify:
-            self.is_verifying = True
-            if self.verify_partial_hash(
-                self.file_name,
-                self.transfer_manager.get_file_hash(self.server_file_path),
-            ):
+        if self.verify and self.is_delta:
+            self.transfer_success = self.verify_delta()
+            if not self.transfer_success:
+                self.error = "%s failed verification" % self.file_name
+        elif self.verify:
+            # The blocks kept from an earlier transfer were checked when
+            # the transfer resumed, see find_resume_block, or were flushed
+            # before the server's journal recorded them.
+            digest = BlockTree(
+                [
+                    self.block_digests[block]
+                    for block in sorted(self.block_digests)
+                ],
+                self.udt.hash_algorithm,
+            ).root
+            if digest == server_digest:
                 self.transfer_success = True
             else:
                 logger.debug("File failed validation check.")
+                self.error = "%s failed verification" % self.file_name
                 self.transfer_success = False
-            self.is_verifying = False
         else:
             self.transfer_success = True
         self.transfer_finished = True
 
-    def file_block_count(self, file_src):
-        return os.path.getsize(file_src) / CHUNK_SIZE
+    def send_missing_ranges(self):
+        """
+        Sends the ranges the server is missing, cut into stripes, over up to
+        self.stripes concurrent connections. The server writes each at its
+        offset.
+        """
+        ranges: "queue.Queue[Tuple[int, int]]" = queue.Queue()
+        for offset, length in self.missing_ranges:
+            for start in range(offset, offset + length, self.stripe_size):
+                ranges.put(
+                    (start, min(self.stripe_size, offset + length - start))
+                )
+        errors: List[Exception] = []
+
+        def send_stripe():
+            while not errors:
+                try:
+                    offset, length = ranges.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self.send_range(offset, offset + length)
+                except Exception as e:
+                    errors.append(e)
 
-    def verify_partial_hash(self, file_src, partial_hash):
+        threads = [
+            threading.Thread(target=send_stripe)
+            for _ in range(min(self.stripes, ranges.qsize()))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def find_resume_block(self) -> Optional[int]:
+        """
+        Compares the block trees (see merkle.py) of the blocks both copies
+        of the file have, and returns how many leading blocks the server
+        already has right, or None if its copy is complete. Anything after
+        those blocks is cut from the server's copy.
+        """
+        server_size = self.base_server_file_size
+        if server_size == self.file_size:
+            length = server_size
+        elif self.is_striped:
+            # Without a journal, which stripes arrived is unknown.
+            length = 0
+        else:
+            length = min(server_size, self.file_size)
+            length -= length % self.block_size
+        block_count = 0
+        # Complete only if the server's copy isn't longer, else its end is
+        # cut below even though the blocks both have match.
+        complete = server_size == self.file_size
+        if self.server_root is not None and complete:
+            tree = self.udt.block_tree(self.file_name, self.block_size, length)
+            if tree.root == self.server_root:
+                # Nothing to ask the server, it had the root of its copy
+                # cached.
+                return None
+        if length:
+            path = self.server_file_path
+            # Both sides hash their copy at the same time.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                local = executor.submit(
+                    self.udt.block_tree,
+                    self.file_name,
+                    self.block_size,
+                    length,
+                )
+                root = self.transfer_manager.get_block_tree_root(
+                    path, self.block_size, length
+                )
+                tree = local.result()
+            try:
+                if root == tree.root:
+                    if complete:
+                        return None
+                    block_count = length // self.block_size
+                else:
+                    block_count = tree.first_difference(
+                        lambda level, indices: (
+                            self.transfer_manager.get_block_tree_nodes(
+                                path, level, tuple(indices)
+                            )
+                        )
+                    )
+                    logger.debug(
+                        "%s differs from block %d", self.file_name, block_count
+                    )
+            finally:
+                self.transfer_manager.drop_block_tree(path)
+        if server_size > block_count * self.block_size:
+            self.transfer_manager.truncate_file(
+                self.server_file_path, block_count * self.block_size
+            )
+        return block_count
+
+    def prepare_delta(self) -> List[Tuple[int, int]]:
+        """
+        Has the server rebuild its copy of the file from the blocks it can
+        reuse, see delta.py, and returns the (offset, length) ranges still
+        to send.
         """
-        Takes a file source and hashes the file up to block count and then
-        compares it with the partial hash passed in, fails if they do not match.
+        block_size = delta_block_size(self.file_size)
+        path = self.server_file_path
+        signature = self.transfer_manager.get_delta_signature(path, block_size)
+        copies, literals = self.udt.compute_delta(
+            self.file_name, block_size, signature, self.base_server_file_size
+        )
+        moved = any(target != source for target, source, _ in copies)
+        if moved or self.base_server_file_size != self.file_size:
+            self.transfer_manager.apply_delta(path, copies, self.file_size)
+        return list(literals)
+
+    def verify_delta(self) -> bool:
+        """
+        Compares the block trees of both copies of the file in full.
         """
-        my_hash = getHash(file_src)
-        return partial_hash == my_hash
+        path = self.server_file_path
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            local = executor.submit(
+                self.udt.block_tree,
+                self.file_name,
+                self.block_size,
+                self.file_size,
+            )
+            try:
+                root = self.transfer_manager.get_block_tree_root(
+                    path, self.block_size, self.file_size
+                )
+            finally:
+                self.transfer_manager.drop_block_tree(path)
+            if root == local.result().root:
+                return True
+        logger.debug("File failed validation check.")
+        return False
+
+    def send_range(self, offset, end):
+        _, _, digests = self.udt.send_range(
+            self.file_id,
+            self.file_name,
+            offset,
+            end,
+            self.block_size,
+            self.verify,
+        )
+        if digests:
+            self.block_digests.update(digests)
+
+    def file_block_count(self, file_src):
+        return -(-os.path.getsize(file_src) // self.block_size)
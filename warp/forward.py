@@ -24,9 +24,18 @@ Sample script showing how to do local port forwarding over paramiko.
 This script connects to the requested SSH server and sets up local port
 forwarding (the openssh -L option) from a local port through a tunneled
 connection to a destination reachable from the SSH server machine.
+
+The data of all the forwarded connections is moved by one Forwarder
+thread, FORWARD_BUFFER_SIZE bytes at a time, whatever their number. Clients
+that can talk to a paramiko channel (see control.py) skip the local socket
+altogether with open_channel.
 """
 
-import select
+import queue
+import selectors
+import socket
+import threading
+from typing import Callable, List, Optional
 
 from config import *
 
@@ -44,57 +53,233 @@ g_verbose = True
 class ForwardServer(SocketServer.ThreadingTCPServer):
     daemon_threads = True
     allow_reuse_address = True
+    # Connections opened at once aren't refused.
+    request_queue_size = 128
+
+    def shutdown_request(self, request):
+        # Forwarded connections are the Forwarder's to close.
+        pass
 
 
 class Handler(SocketServer.BaseRequestHandler):
     def handle(self):
+        peername = self.request.getpeername()
         try:
-            chan = self.ssh_transport.open_channel(
-                "direct-tcpip",
-                (self.chain_host, self.chain_port),
-                self.request.getpeername(),
+            chan = open_channel(
+                self.ssh_transport,
+                self.chain_host,
+                self.chain_port,
+                peername,
             )
         except Exception as e:
             verbose(
                 "Incoming request to %s:%d failed: %s"
                 % (self.chain_host, self.chain_port, repr(e))
             )
+            self.request.close()
             return
         if chan is None:
             verbose(
                 "Incoming request to %s:%d was rejected by the SSH server."
                 % (self.chain_host, self.chain_port)
             )
+            self.request.close()
             return
 
         verbose(
             "Connected!  Tunnel open %r -> %r -> %r"
             % (
-                self.request.getpeername(),
+                peername,
                 chan.getpeername(),
                 (self.chain_host, self.chain_port),
             )
         )
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.forwarder.add(
+            self.request,
+            chan,
+            lambda: verbose("Tunnel closed from %r" % (peername,)),
+        )
+
+
+class Tunnel:
+    """
+    A forwarded connection: a socket, the channel it is forwarded over, and
+    what was read from each but not yet written to the other. Reads stop
+    while that isn't written, so a slow end slows the other one down.
+    """
+
+    def __init__(self, sock, chan, done):
+        self.sock = sock
+        self.chan = chan
+        self.done = done
+        self.to_chan = memoryview(b"")
+        self.to_sock = memoryview(b"")
+        self.sock_eof = False
+        self.chan_eof = False
+        # Whether each end was closed for writing.
+        self.sock_shut = False
+        self.chan_shut = False
+
+    def step(self):
+        """
+        Moves what can be moved each way without blocking.
+        """
+        if not self.to_chan and not self.sock_eof:
+            if (data := _recv(self.sock)) is not None:
+                self.to_chan = memoryview(data)
+                self.sock_eof = not data
+        if self.to_chan:
+            self.to_chan = self.to_chan[_send(self.chan, self.to_chan) :]
+        if not self.to_sock and not self.chan_eof:
+            if (data := _recv(self.chan)) is not None:
+                self.to_sock = memoryview(data)
+                self.chan_eof = not data
+        if self.to_sock:
+            self.to_sock = self.to_sock[_send(self.sock, self.to_sock) :]
+        # Ends are closed for writing once everything read is written.
+        if self.sock_eof and not self.to_chan and not self.chan_shut:
+            self.chan.shutdown_write()
+            self.chan_shut = True
+        if self.chan_eof and not self.to_sock and not self.sock_shut:
+            self.sock.shutdown(socket.SHUT_WR)
+            self.sock_shut = True
+
+    @property
+    def finished(self) -> bool:
+        return self.sock_shut and self.chan_shut
+
+    def close(self):
+        self.chan.close()
+        self.sock.close()
+        self.done()
+
+
+class Forwarder:
+    """
+    Forwards any number of connections over their channels in a single
+    thread, waiting on all of them at once. Channels can only be waited on
+    for reading, so while one can't take what is waiting for it (its window
+    is full), the others are waited on for at most FORWARD_POLL_SECONDS.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.tunnels: List[Tunnel] = []
+        self.added: "queue.Queue[Tunnel]" = queue.Queue()
+        # Wakes the thread up when a tunnel is added.
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, sock, chan, done: Optional[Callable] = None):
+        """
+        Forwards sock over chan until both are closed, then calls done.
+        """
+        sock.setblocking(False)
+        chan.settimeout(0)
+        self.added.put(Tunnel(sock, chan, done or (lambda: None)))
+        self.waker.send(b"\0")
+
+    def run(self):
         while True:
-            r, w, x = select.select([self.request, chan], [], [])
-            if self.request in r:
-                data = self.request.recv(1024)
-                if len(data) == 0:
-                    break
-                try:
-                    chan.send(data)
-                except EOFError:
-                    logger.debug("Chanel closed")
-            if chan in r:
-                data = chan.recv(1024)
-                if len(data) == 0:
-                    break
-                self.request.send(data)
+            blocked = any(tunnel.to_chan for tunnel in self.tunnels)
+            ready = self.selector.select(FORWARD_POLL_SECONDS if blocked else None)
+            stepped = set()
+            for key, _ in ready:
+                if key.fileobj is self.wakeup:
+                    self.take_added()
+                elif id(key.data) not in stepped:
+                    stepped.add(id(key.data))
+                    self.step(key.data)
+            for tunnel in list(self.tunnels):
+                if tunnel.to_chan and id(tunnel) not in stepped:
+                    self.step(tunnel)
 
-        peername = self.request.getpeername()
-        chan.close()
-        self.request.close()
-        verbose("Tunnel closed from %r" % (peername,))
+    def take_added(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.added.empty():
+            tunnel = self.added.get()
+            self.tunnels.append(tunnel)
+            self.step(tunnel)
+
+    def step(self, tunnel):
+        try:
+            tunnel.step()
+        except (OSError, EOFError) as e:
+            logger.debug("Tunnel failed: %s", e)
+            self.remove(tunnel)
+            return
+        if tunnel.finished:
+            self.remove(tunnel)
+            return
+        sock_events = 0
+        if not tunnel.to_chan and not tunnel.sock_eof:
+            sock_events |= selectors.EVENT_READ
+        if tunnel.to_sock:
+            sock_events |= selectors.EVENT_WRITE
+        self.watch(tunnel.sock, sock_events, tunnel)
+        chan_events = 0
+        if not tunnel.to_sock and not tunnel.chan_eof:
+            chan_events = selectors.EVENT_READ
+        self.watch(tunnel.chan, chan_events, tunnel)
+
+    def watch(self, fileobj, events, tunnel):
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            if events:
+                self.selector.register(fileobj, events, tunnel)
+            return
+        if not events:
+            self.selector.unregister(fileobj)
+        elif key.events != events:
+            self.selector.modify(fileobj, events, tunnel)
+
+    def remove(self, tunnel):
+        for fileobj in (tunnel.sock, tunnel.chan):
+            self.watch(fileobj, 0, tunnel)
+        self.tunnels.remove(tunnel)
+        try:
+            tunnel.close()
+        except (OSError, EOFError) as e:
+            logger.debug("Tunnel failed to close: %s", e)
+
+
+def _recv(source) -> Optional[bytes]:
+    # None if there is nothing to read yet, b"" at the end.
+    try:
+        return source.recv(FORWARD_BUFFER_SIZE)
+    except (BlockingIOError, socket.timeout):
+        return None
+
+
+def _send(dest, data) -> int:
+    try:
+        return dest.send(data)
+    except (BlockingIOError, socket.timeout):
+        return 0
+
+
+def open_channel(transport, host, port, origin=("127.0.0.1", 0)):
+    """
+    Opens a channel of transport to host:port as seen from the SSH server,
+    with a window large enough for bulk data.
+    """
+    return transport.open_channel(
+        "direct-tcpip",
+        (host, port),
+        origin,
+        window_size=FORWARD_WINDOW_SIZE,
+        max_packet_size=FORWARD_PACKET_SIZE,
+    )
 
 
 def forward_tunnel(local_port, remote_host, remote_port, transport):
@@ -105,6 +290,7 @@ def forward_tunnel(local_port, remote_host, remote_port, transport):
         chain_host = remote_host
         chain_port = remote_port
         ssh_transport = transport
+        forwarder = Forwarder()
 
     server = ForwardServer(("", local_port), SubHander)
     return server
@@ -0,0 +1,23 @@
+"""
+Framing of the data connections. A session keeps a few data connections
+open and every file sent during the session shares them, so each piece of
+data is preceded by a header saying which file it belongs to and where it
+goes in that file.
+"""
+
+import struct
+
+# Frame kind, flags, file id, offset in the file and length of the payload
+# that follows the header. The low bits of the flags say which codec the
+# payload is compressed with, if any (see compression.py); offsets and
+# lengths in the file are those of the uncompressed data.
+FRAME_HEADER = struct.Struct("!BBIQI")
+
+# The payload is file data to be written at the offset.
+FRAME_DATA = 1
+# The payload is the part of a bundle stream (see bundle.py) starting at the
+# offset. The frames of a bundle are all sent on one connection, in order.
+FRAME_BUNDLE = 2
+# The length bytes at the offset are a hole in the file (see
+# ReceivingFile.punch), no payload follows.
+FRAME_HOLE = 3
@@ -0,0 +1,164 @@
+"""
+On-disk cache of file hashes, shared by the client and the server and by
+successive runs. Entries are keyed on the device, inode, size and mtime of
+the file they were computed from, so an entry is only found again while the
+file is unchanged, and on what was computed (a whole-file sha256, a block
+tree for a given block size...). The cache is capped at
+HASH_CACHE_MAX_BYTES of values, least recently used entries going first.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+from config import HASH_CACHE_MAX_BYTES, HASH_CACHE_PATH, logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    value BLOB NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns, kind)
+);
+CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used);
+"""
+
+# What a cache that can't be used raises: the database's errors, or those of
+# making its directory, say in a home that isn't writable.
+CACHE_ERRORS = (sqlite3.Error, OSError)
+
+
+class HashCache:
+    """
+    The cache in the SQLite database at path. Safe to use from several
+    threads and processes at once; if the database can't be used, values
+    are just computed every time.
+    """
+
+    def __init__(self, path=HASH_CACHE_PATH, max_bytes=HASH_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        # The process the connection was opened in, it can't be used from
+        # a forked child.
+        self._pid = None
+        self._size = 0
+        self.disabled = False
+
+    def db(self) -> sqlite3.Connection:
+        if self._db is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            (self._size,) = db.execute(
+                "SELECT COALESCE(SUM(LENGTH(value)), 0) FROM hashes"
+            ).fetchone()
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def cached(self, filepath, kind, compute: Callable[[], bytes]) -> bytes:
+        """
+        Returns the kind value of filepath from the cache, or computes it
+        with compute() and caches it if the file didn't change meanwhile.
+        """
+        if self.disabled:
+            return compute()
+        st = os.stat(filepath)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, kind)
+        try:
+            value = self.get(key)
+        except CACHE_ERRORS as e:
+            logger.debug("Hash cache unusable, not caching: %s", e)
+            self.disabled = True
+            return compute()
+        if value is not None:
+            return value
+        value = compute()
+        st = os.stat(filepath)
+        if key == (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, kind):
+            try:
+                self.put(key, value)
+            except CACHE_ERRORS as e:
+                logger.debug("Could not cache hash of %s: %s", filepath, e)
+        return value
+
+    def lookup(self, filepath, kind) -> Optional[bytes]:
+        """
+        Returns the kind value of filepath if it is cached, without
+        computing it.
+        """
+        if self.disabled:
+            return None
+        st = os.stat(filepath)
+        try:
+            return self.get((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, kind))
+        except CACHE_ERRORS as e:
+            logger.debug("Hash cache unusable: %s", e)
+            self.disabled = True
+            return None
+
+    def get(self, key) -> Optional[bytes]:
+        with self._lock:
+            db = self.db()
+            with db:
+                row = db.execute(
+                    "SELECT value FROM hashes WHERE dev = ? AND ino = ?"
+                    " AND size = ? AND mtime_ns = ? AND kind = ?",
+                    key,
+                ).fetchone()
+                if row is None:
+                    return None
+                db.execute(
+                    "UPDATE hashes SET last_used = ? WHERE dev = ?"
+                    " AND ino = ? AND size = ? AND mtime_ns = ? AND kind = ?",
+                    (time.time(),) + key,
+                )
+            return row[0]
+
+    def put(self, key, value: bytes):
+        with self._lock:
+            db = self.db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO hashes" " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    key + (value, time.time()),
+                )
+            self._size += len(value)
+            if self._size > self.max_bytes:
+                self.evict(db)
+
+    def evict(self, db):
+        """
+        Drops the least recently used entries until the cache is back to
+        90% of its cap.
+        """
+        with db:
+            # Other processes write to the cache too, count again.
+            (self._size,) = db.execute(
+                "SELECT COALESCE(SUM(LENGTH(value)), 0) FROM hashes"
+            ).fetchone()
+            excess = self._size - self.max_bytes * 9 // 10
+            while excess > 0:
+                rows = db.execute(
+                    "SELECT rowid, LENGTH(value) FROM hashes"
+                    " ORDER BY last_used LIMIT 1000"
+                ).fetchall()
+                if not rows:
+                    break
+                for rowid, length in rows:
+                    if excess <= 0:
+                        break
+                    db.execute("DELETE FROM hashes WHERE rowid = ?", (rowid,))
+                    excess -= length
+                    self._size -= length
+
+
+hash_cache = HashCache()
@@ -0,0 +1,45 @@
+"""
+Manifests of batch transfers (warp --manifest), sent in a single session: a
+source and a destination per line, separated by a tab so that paths may
+hold spaces. Blank lines and lines starting with # are skipped. The report
+has a line per entry: OK or FAILED, the source, the destination and, for
+failed entries, why.
+"""
+
+import sys
+from typing import List, Optional, Sequence, Tuple
+
+
+def read_manifest(path) -> List[Tuple[str, str]]:
+    """
+    Returns the (source, destination) entries of the manifest at path, or
+    on stdin if path is -.
+    """
+    f = sys.stdin if path == "-" else open(path)
+    entries = []
+    with f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields) != 2 or not all(fields):
+                raise ValueError(
+                    "Line %d of the manifest isn't a source and a"
+                    " destination separated by a tab" % number
+                )
+            entries.append((fields[0], fields[1]))
+    if not entries:
+        raise ValueError("The manifest has no entries")
+    return entries
+
+
+def write_report(results: Sequence[Tuple[str, str, Optional[str]]], out):
+    """
+    Writes a line to out for each (source, destination, error) of results.
+    """
+    for file_src, file_dest, error in results:
+        if error is None:
+            out.write("OK\t%s\t%s\n" % (file_src, file_dest))
+        else:
+            out.write("FAILED\t%s\t%s\t%s\n" % (file_src, file_dest, error))
@@ -0,0 +1,103 @@
+"""
+Hash trees over the blocks of a file. Both ends of a resumed transfer build
+one over the same range of their copy of a file, and compare them from the
+root down: only the hashes along the way to the first differing block cross
+the wire, and the transfer resumes from that block.
+"""
+
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from hash_cache import hash_cache
+from hashing import DIGEST_SIZE, digest, hash_blocks, new_hash
+
+Digests = List[bytes]
+
+
+class BlockTree:
+    """
+    A hash tree whose leaves are the digests of consecutive blocks, see
+    hashing.py. Each node above hashes the concatenation of its two
+    children; the last node of a level with an odd number of nodes is
+    carried up as is.
+    """
+
+    def __init__(self, leaves: Digests, algorithm="sha256"):
+        self.algorithm = algorithm
+        self.levels: List[Digests] = [leaves]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            self.levels.append(
+                [combine(level[i : i + 2], algorithm) for i in range(0, len(level), 2)]
+            )
+
+    @classmethod
+    def from_file(cls, filepath, block_size, length, algorithm="sha256") -> "BlockTree":
+        """
+        Builds the tree of the first length bytes of filepath, cut into
+        blocks of block_size bytes (the last one possibly shorter). The
+        leaves are kept in the hash cache.
+        """
+        leaves = hash_cache.cached(
+            filepath,
+            "%s:blocks:%d:%d" % (algorithm, block_size, length),
+            lambda: b"".join(hash_blocks(filepath, block_size, length, algorithm)),
+        )
+        return cls(split_digests(leaves), algorithm)
+
+    @classmethod
+    def cached_root(
+        cls, filepath, block_size, length, algorithm="sha256"
+    ) -> Optional[str]:
+        """
+        Returns the root of the tree from_file would build if its leaves are
+        in the hash cache, None rather than reading the file otherwise.
+        """
+        leaves = hash_cache.lookup(
+            filepath, "%s:blocks:%d:%d" % (algorithm, block_size, length)
+        )
+        if leaves is None:
+            return None
+        return cls(split_digests(leaves), algorithm).root
+
+    @property
+    def height(self) -> int:
+        return len(self.levels)
+
+    @property
+    def root(self) -> str:
+        if not self.levels[0]:
+            return new_hash(self.algorithm).hexdigest()
+        return self.levels[-1][0].hex()
+
+    def nodes(self, level, indices) -> Tuple[str, ...]:
+        return tuple(self.levels[level][i].hex() for i in indices)
+
+    def first_difference(
+        self, remote_nodes: Callable[[int, Sequence[int]], Sequence[str]]
+    ) -> int:
+        """
+        Returns the index of the first leaf that differs from the other
+        tree, of the same shape but a different root, whose nodes
+        remote_nodes(level, indices) returns.
+        """
+        index = 0
+        for level in range(self.height - 2, -1, -1):
+            children = [
+                i for i in (2 * index, 2 * index + 1) if i < len(self.levels[level])
+            ]
+            index = children[-1]
+            for child, node in zip(children, remote_nodes(level, children)):
+                if node != self.levels[level][child].hex():
+                    index = child
+                    break
+        return index
+
+
+def split_digests(data: bytes) -> Digests:
+    return [data[i : i + DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)]
+
+
+def combine(pair: Digests, algorithm) -> bytes:
+    if len(pair) == 1:
+        return pair[0]
+    return digest(algorithm, pair[0] + pair[1])
@@ -0,0 +1,47 @@
+import threading
+from typing import List, Tuple
+
+from config import METADATA_BATCH_FILES, logger
+
+
+class MetadataBatch:
+    """
+    Times and modes of the files received, set on the server by
+    TransferManager.commit_files once `size` of them are waiting, and for
+    the rest at the end of the session (see flush), rather than with two
+    round trips per file.
+    """
+
+    def __init__(self, transfer_manager, size=METADATA_BATCH_FILES):
+        self.transfer_manager = transfer_manager
+        self.size = size
+        # (path, atime, mtime, mode) of each file waiting.
+        self.pending: List[Tuple[str, float, float, int]] = []
+        # Files whose status could not be set.
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, path, atime, mtime, mode):
+        with self._lock:
+            self.pending.append((path, atime, mtime, mode))
+            if len(self.pending) < self.size:
+                return
+            batch, self.pending = self.pending, []
+        self.commit(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.commit(batch)
+
+    def commit(self, batch):
+        try:
+            results = self.transfer_manager.commit_files(tuple(batch))
+        except Exception:
+            logger.exception("Could not set the status of %d files", len(batch))
+            results = ()
+        failed = len(batch) - sum(1 for result in results if result)
+        if failed:
+            with self._lock:
+                self.failed += failed
@@ -0,0 +1,98 @@
+import multiprocessing
+import threading
+import time
+
+from common_tools import HumanBytes
+from config import PACING_BURST_SECONDS, PACING_QUANTUM, logger
+
+
+class _Field:
+    # An attribute of a Pacer, kept in its state array.
+
+    def __init__(self, index):
+        self.index = index
+
+    def __get__(self, pacer, owner):
+        return pacer._state[self.index]
+
+    def __set__(self, pacer, value):
+        pacer._state[self.index] = value
+
+
+class Pacer:
+    """
+    Token bucket shared by every data connection of a session, capping their
+    combined send rate at `rate` bytes per second (0 for no cap). Senders
+    report what they sent with consume(), which sleeps for as long as they
+    are ahead of the rate; sends are cut into pieces of `quantum` bytes so
+    the stream stays smooth instead of going out in bursts. The rate can be
+    changed while a transfer is running.
+
+    A shared pacer keeps the bucket in shared memory, so that worker
+    processes forked afterwards (see process_pool.py) all draw from it and
+    follow changes of the rate made by the parent.
+    """
+
+    rate = _Field(0)
+    tokens = _Field(1)
+    stamp = _Field(2)
+    start_time = _Field(3)
+    sent = _Field(4)
+
+    def __init__(self, rate=0, shared=False):
+        if shared:
+            context = multiprocessing.get_context("fork")
+            self._lock = context.Lock()
+            self._state = context.RawArray("d", 5)
+        else:
+            self._lock = threading.Lock()
+            self._state = [0.0] * 5
+        self.rate = rate
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        # Bytes sent since the session started, to know what halving the
+        # rate of an uncapped transfer means.
+        self.start_time = self.stamp
+        self.sent = 0
+
+    @property
+    def quantum(self) -> int:
+        return PACING_QUANTUM if self.rate else 1 << 30
+
+    def consume(self, nbytes):
+        with self._lock:
+            self.sent += nbytes
+            if not self.rate:
+                return
+            now = time.monotonic()
+            burst = max(self.rate * PACING_BURST_SECONDS, PACING_QUANTUM)
+            self.tokens = min(burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            # Going into debt reserves the bytes, so concurrent senders
+            # queue up behind each other rather than all waking at once.
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = max(0, int(rate))
+            self.tokens = min(self.tokens, 0.0)
+            self.stamp = time.monotonic()
+        if self.rate:
+            logger.info("Send rate capped at %s/s", HumanBytes.format(self.rate))
+        else:
+            logger.info("Send rate uncapped")
+
+    def scale(self, factor):
+        """
+        Multiplies the cap by factor. An uncapped transfer is capped relative
+        to the average rate it achieved so far.
+        """
+        rate = self.rate
+        if not rate:
+            if factor >= 1:
+                return
+            rate = self.sent / max(time.monotonic() - self.start_time, 1e-3)
+        self.set_rate(max(rate * factor, 1))
@@ -0,0 +1,131 @@
+"""
+Process mode (--processes): the data side of a session spread over worker
+processes, so that reading, compressing, hashing and sending files use more
+than the one core the GIL leaves a single process. The coordinating process
+keeps the RPC channel and makes every control call; each worker opens its
+own data connections to the session and sends the ranges and bundles it is
+handed.
+"""
+
+import multiprocessing
+from typing import Optional
+
+from common_tools import ThroughputMeter
+from compression import AdaptiveCompressor
+from data_connection_pool import DataConnectionPool
+from merkle import BlockTree
+
+# The connections of a worker process.
+_worker_pool: "Optional[WorkerConnectionPool]" = None
+
+
+class WorkerConnectionPool(DataConnectionPool):
+    """
+    The connections of one worker process, to a session the coordinator
+    already set up.
+    """
+
+    def __init__(self, hostname, tcp_mode, port, nonce, **kwargs):
+        super().__init__(None, hostname, tcp_mode, 1, **kwargs)
+        self.port = port
+        self.nonce = nonce
+
+    def get_server_udt_manager(self):
+        return None
+
+
+def _init_worker(
+    hostname, tcp_mode, port, nonce, compression, pacer, mmap, hash_algorithm
+):
+    global _worker_pool
+    meter = ThroughputMeter()
+    compressor = None
+    if compression is not None:
+        compressor = AdaptiveCompressor(*compression, meter)
+    _worker_pool = WorkerConnectionPool(
+        hostname,
+        tcp_mode,
+        port,
+        nonce,
+        meter=meter,
+        compressor=compressor,
+        pacer=pacer,
+        use_mmap=mmap,
+        hash_algorithm=hash_algorithm,
+    )
+
+
+def _send_range(*args):
+    return _worker_pool.send_range(*args)
+
+
+def _send_bundle(*args):
+    return _worker_pool.send_bundle(*args)
+
+
+def _block_tree(*args):
+    return _worker_pool.block_tree(*args)
+
+
+def _compute_delta(*args):
+    return _worker_pool.compute_delta(*args)
+
+
+class ProcessConnectionPool(DataConnectionPool):
+    """
+    A DataConnectionPool whose sends, source hashing and delta scans are
+    run by `processes` worker processes, each sending one range or bundle
+    at a time over a connection of its own. Control calls still go through
+    the coordinator's RPC channel. The workers share the send rate cap
+    of the pacer, a shared one, so it can still be changed as they run.
+    """
+
+    def __init__(self, *args, processes, compression=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.processes = processes
+        self.compression = compression
+        self.workers = None
+
+    def open(self):
+        self.get_server_udt_manager()
+        # Forked, so that the workers don't re-run the client's __main__.
+        self.workers = multiprocessing.get_context("fork").Pool(
+            self.processes,
+            _init_worker,
+            (
+                self.hostname,
+                self.tcp_mode,
+                self.port,
+                self.nonce,
+                self.compression,
+                self.pacer,
+                self.use_mmap,
+                self.hash_algorithm,
+            ),
+        )
+
+    def send_range(self, file_id, file_src, offset, end, block_size, hash_blocks=False):
+        wire_bytes, seconds, digests = self.workers.apply(
+            _send_range,
+            (file_id, file_src, offset, end, block_size, hash_blocks),
+        )
+        self.meter.record(wire_bytes, seconds)
+        return wire_bytes, seconds, digests
+
+    def send_bundle(self, bundle_id, files, verify):
+        return self.workers.apply(_send_bundle, (bundle_id, files, verify))
+
+    def block_tree(self, file_src, block_size, length) -> BlockTree:
+        return self.workers.apply(_block_tree, (file_src, block_size, length))
+
+    def compute_delta(self, file_src, block_size, signature, server_size):
+        return self.workers.apply(
+            _compute_delta, (file_src, block_size, signature, server_size)
+        )
+
+    def close(self):
+        if self.workers is not None:
+            # The workers' connections close as they exit.
+            self.workers.close()
+            self.workers.join()
+        super().close()
@@ -4,7 +4,7 @@ import sys
 import threading
 import time
 from dataclasses import dataclass
-from typing import Callable, Generic, Tuple, TypeVar, Union
+from typing import Callable, Generic, List, Optional, Tuple, TypeVar, Union
 
 from blessings import Terminal
 
@@ -117,23 +117,55 @@ class Component(Generic[T]):
         pass
 
     def set_update(self, func: Callable[[], T]):
-        def update():
-            while self.active:
-                try:
-                    self.value = func()
-                    self.updateCallback()
-                except Exception:
-                    break
-                time.sleep(SLEEP_TIME)
-
-        thread = threading.Thread(target=update)
-        thread.setDaemon(True)
-        thread.start()
+        """
+        Has self.value set to what func returns every SLEEP_TIME, by the
+        thread that updates all the components.
+        """
+        updater.add(self, func)
 
     def __str__(self):
         return self.value
 
 
+class Updater(object):
+    """
+    Updates components from a single thread, started with the first.
+    """
+
+    def __init__(self):
+        self.updates: List[Tuple[Component, Callable]] = []
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, component, func):
+        with self.lock:
+            self.updates.append((component, func))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                updates = list(self.updates)
+            for component, func in updates:
+                if component.active:
+                    try:
+                        component.value = func()
+                        component.updateCallback()
+                        continue
+                    except Exception:
+                        pass
+                # Inactive and failed components are no longer updated.
+                with self.lock:
+                    self.updates.remove((component, func))
+            time.sleep(SLEEP_TIME)
+
+
+updater = Updater()
+
+
 class CounterComponent(Component[int]):
     def __init__(self, format="{}"):
         self.value = 0
@@ -184,7 +216,7 @@ class ProgressComponent(Component[Tuple[int, int, bool]]):
         than lastProgress.current and time has elapsed.
 
         self.progress is NOT updated here, but in __str__. Its updated value
-        comes from self.value[1], which is set in a thread started by
+        comes from self.value[1], which is set by the updater thread, see
         set_update.
         """
         if (
@@ -197,8 +229,7 @@ class ProgressComponent(Component[Tuple[int, int, bool]]):
             self.lastUpdated = new_time
 
     def __str__(self):
-        # self.value is updated in the update closure created by set_update and
-        # offloaded to a thread.
+        # self.value is updated by the updater thread, see set_update.
         self.progress = self.value[1]
         self.expected_size = self.value[0]
         if self.value[2] and self.progress == self.expected_size:
@@ -225,10 +256,10 @@ class ProgressComponent(Component[Tuple[int, int, bool]]):
         if self.lastProgress.current < self.progress:
             self.lastProgress.current = self.progress
             # Screen.redraw() prints this Component every 0.1s.
-            # The value attr gets updated in a thread via the `update` closure
-            # defined in Component.set_update, also every 0.1s.
+            # The value attr gets updated by the updater thread, see
+            # Component.set_update, also every 0.1s.
             # updateCallback is called mere nanoseconds after self.value is
-            # updated by the set_update thread.
+            # updated by the updater thread.
             # I'm honestly not sure there's any point to advancing lastProgress
             # by a few nanoseconds, but I wasn't there nine years ago to ask
             # Noah what his rationale was; alls I can do is fix the `list < int`
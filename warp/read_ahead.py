@@ -0,0 +1,146 @@
+import mmap
+import os
+import queue
+import threading
+
+from common_tools import pread_into
+from config import READ_AHEAD_BLOCKS
+
+
+def advise(fd, offset, length, advice_name):
+    """
+    posix_fadvise, where the platform has it. advice_name is the name of
+    the os.POSIX_FADV_* constant.
+    """
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice_name))
+        except OSError:
+            pass
+
+
+class ReadAheadReader:
+    """
+    Reads blocks of a file in a background thread, up to `depth` blocks
+    ahead of the sender, so that the disk is busy while the previous blocks
+    are on the wire. Blocks are read into a fixed set of buffers; the block
+    returned by get() stays valid until the next call to get() or close().
+    With use_mmap, blocks are slices of a read-only mapping of the file
+    instead, which the kernel is asked to page in ahead; the file must not
+    be truncated while mapped.
+    """
+
+    def __init__(self, f, end, block_size, depth=READ_AHEAD_BLOCKS, use_mmap=False):
+        self.name = f.name
+        self.fd = f.fileno()
+        self.end = end
+        self.block_size = block_size
+        self.depth = depth
+        self.mmap = None
+        if use_mmap:
+            self.mmap = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            if hasattr(self.mmap, "madvise"):
+                self.mmap.madvise(mmap.MADV_SEQUENTIAL)
+        self._free: "queue.Queue[bytearray]" = queue.Queue()
+        self._ready: "queue.Queue" = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+        self._current = None
+        self.next_offset = None
+        if self.mmap is None:
+            for _ in range(depth):
+                self._free.put(bytearray(block_size))
+
+    def get(self, offset, length):
+        """
+        Returns up to length bytes of the file at offset, fewer only if the
+        file ends before.
+        """
+        if self.mmap is not None:
+            return self._get_mapped(offset, length)
+        self._release_current()
+        if self.next_offset != offset:
+            self._start(offset)
+        item = self._ready.get()
+        if isinstance(item, BaseException):
+            self._stop_thread()
+            raise item
+        buf, n = item
+        self._current = buf
+        self.next_offset = offset + n
+        if n > length:
+            # The reader's blocks don't line up with what is asked for.
+            n = length
+            self.next_offset = None
+        return buf if n == len(buf) else memoryview(buf)[:n]
+
+    def _get_mapped(self, offset, length):
+        ahead = offset + length
+        if hasattr(self.mmap, "madvise") and ahead < len(self.mmap):
+            start = ahead - ahead % mmap.PAGESIZE
+            self.mmap.madvise(
+                mmap.MADV_WILLNEED,
+                start,
+                min(self.depth * self.block_size, len(self.mmap) - start),
+            )
+        return memoryview(self.mmap)[offset : offset + length]
+
+    def _start(self, offset):
+        self._stop_thread()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read, args=(offset, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, offset, stop):
+        advise(self.fd, offset, self.end - offset, "POSIX_FADV_SEQUENTIAL")
+        while offset < self.end:
+            buf = self._free.get()
+            if stop.is_set():
+                self._free.put(buf)
+                return
+            length = min(self.block_size, self.end - offset)
+            advise(self.fd, offset + length, length, "POSIX_FADV_WILLNEED")
+            try:
+                n = pread_into(self.fd, memoryview(buf)[:length], offset)
+            except BaseException as e:
+                self._free.put(buf)
+                self._ready.put(e)
+                return
+            self._ready.put((buf, n))
+            if n < length:
+                return
+            offset += n
+
+    def _release_current(self):
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+
+    def _stop_thread(self):
+        self.next_offset = None
+        if self._thread is None:
+            return
+        self._stop.set()
+        # Handing back the blocks read ahead unblocks the thread if it is
+        # waiting for a free buffer.
+        self._drain()
+        self._thread.join()
+        self._drain()
+        self._thread = None
+
+    def _drain(self):
+        while True:
+            try:
+                item = self._ready.get_nowait()
+            except queue.Empty:
+                return
+            if not isinstance(item, BaseException):
+                self._free.put(item[0])
+
+    def close(self):
+        self._release_current()
+        self._stop_thread()
+        # The mapping is unmapped once the last block handed out from it is
+        # dropped.
+        self.mmap = None
@@ -0,0 +1,269 @@
+import os
+import re
+import struct
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from config import logger
+
+
+class ResumeJournal:
+    """
+    Sidecar file next to a file being received out of order (striped, or
+    large enough to resume). It holds a bitmap of the blocks known to be on
+    disk, so that a resumed transfer only asks for the missing ones, and the
+    identity of the transfer, so that a journal left by another transfer
+    isn't trusted. Blocks are recorded by commit, once the caller has
+    flushed them. The journal is removed once every block is in.
+    """
+
+    SUFFIX = ".warp-journal"
+    # Magic, file size, block size, modification time (ns) of the source,
+    # inode of the destination, CRC-32 of the rest; then the bitmap.
+    HEADER = struct.Struct("!8sQIqQI")
+    MAGIC = b"WARPJNL1"
+
+    # Journals of the files currently being received, by destination path.
+    _registry_lock = threading.Lock()
+    _registry: Dict[str, "ResumeJournal"] = {}
+
+    def __init__(self, filepath, file_size, block_size, source_mtime, inode, bitmap):
+        self.filepath = filepath
+        self.file_size = file_size
+        self.block_size = block_size
+        self.source_mtime = source_mtime
+        self.inode = inode
+        # A bit per block, set once the block is on disk. The bits past the
+        # last block are set.
+        self.bitmap = bitmap
+        self.remaining = self.bit_count - _popcount(bitmap)
+        # Bytes received of blocks partly received, and the blocks fully
+        # received since the last commit.
+        self.partial: Dict[int, int] = {}
+        self.pending: List[int] = []
+        self._lock = threading.Lock()
+
+    @property
+    def journal_path(self) -> str:
+        return self.filepath + self.SUFFIX
+
+    @property
+    def bit_count(self) -> int:
+        return len(self.bitmap) * 8
+
+    @classmethod
+    def load(cls, filepath, file_size, source_mtime) -> "Optional[ResumeJournal]":
+        """
+        Returns the journal of filepath if there is one for a transfer of the
+        same source file, None otherwise.
+        """
+        with cls._registry_lock:
+            journal = cls._registry.get(filepath)
+            if journal is None:
+                journal = cls.read(filepath)
+                if journal is None:
+                    return None
+            try:
+                inode = os.stat(filepath).st_ino
+            except OSError:
+                inode = None
+            if (journal.file_size, journal.source_mtime, journal.inode) != (
+                file_size,
+                source_mtime,
+                inode,
+            ):
+                logger.debug("Stale resume journal for %s", filepath)
+                cls._registry.pop(filepath, None)
+                return None
+            # What a previous connection left of partly received blocks
+            # will be sent again.
+            journal.partial.clear()
+            cls._registry[filepath] = journal
+            return journal
+
+    @classmethod
+    def read(cls, filepath) -> "Optional[ResumeJournal]":
+        try:
+            with open(filepath + cls.SUFFIX, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < cls.HEADER.size:
+            return None
+        magic, size, block_size, mtime, inode, crc = cls.HEADER.unpack_from(data)
+        bitmap = bytearray(data[cls.HEADER.size :])
+        if (
+            magic != cls.MAGIC
+            or crc != _crc(size, block_size, mtime, inode, bitmap)
+            or not block_size
+            or len(bitmap) != _bitmap_size(size, block_size)
+        ):
+            logger.debug("Corrupt resume journal for %s", filepath)
+            return None
+        return cls(filepath, size, block_size, mtime, inode, bitmap)
+
+    @classmethod
+    def create(
+        cls, filepath, file_size, block_size, source_mtime, done=0
+    ) -> "ResumeJournal":
+        """
+        Starts the journal of a transfer of filepath, with its first done
+        bytes, a whole number of blocks, already received.
+        """
+        block_count = -(-file_size // block_size)
+        bitmap = bytearray(_bitmap_size(file_size, block_size))
+        full = min(done // block_size, block_count)
+        bitmap[: full // 8] = b"\xff" * (full // 8)
+        for block in range(full - full % 8, full):
+            _set(bitmap, block)
+        # Blocks past the end of the file are never missing.
+        for block in range(block_count, len(bitmap) * 8):
+            _set(bitmap, block)
+        journal = cls(
+            filepath,
+            file_size,
+            block_size,
+            source_mtime,
+            os.stat(filepath).st_ino,
+            bitmap,
+        )
+        journal.save()
+        with cls._registry_lock:
+            cls._registry[filepath] = journal
+        return journal
+
+    @classmethod
+    def opened(cls, filepath, file_size) -> "Optional[ResumeJournal]":
+        """
+        Returns the journal of filepath if it is being received, with
+        file_size bytes.
+        """
+        with cls._registry_lock:
+            journal = cls._registry.get(filepath)
+        if journal is None or journal.file_size != file_size:
+            return None
+        return journal
+
+    def missing(self) -> List[Tuple[int, int]]:
+        """
+        Returns the (offset, length) of every run of blocks not yet on disk.
+        """
+        runs: List[List[int]] = []
+
+        def add(first, end):
+            if runs and runs[-1][1] == first:
+                runs[-1][1] = end
+            else:
+                runs.append([first, end])
+
+        with self._lock:
+            bitmap = bytes(self.bitmap)
+        # Whole bytes of missing blocks are the common case, only the bytes
+        # at the edges of a run are looked at bit by bit.
+        for run in re.finditer(rb"\x00+|[^\xff]", bitmap):
+            if run.group()[0] == 0:
+                add(run.start() * 8, run.end() * 8)
+                continue
+            for bit in range(8):
+                if not run.group()[0] & 0x80 >> bit:
+                    add(run.start() * 8 + bit, run.start() * 8 + bit + 1)
+        return [
+            (
+                first * self.block_size,
+                min(end * self.block_size, self.file_size) - first * self.block_size,
+            )
+            for first, end in runs
+        ]
+
+    def received(self, offset, length):
+        """
+        Counts length bytes written at offset, finding the blocks they
+        complete. Nothing is recorded until commit.
+        """
+        end = offset + length
+        with self._lock:
+            while offset < end:
+                block = offset // self.block_size
+                block_end = min((block + 1) * self.block_size, self.file_size)
+                n = min(end, block_end) - offset
+                got = self.partial.pop(block, 0) + n
+                if got < block_end - block * self.block_size:
+                    self.partial[block] = got
+                else:
+                    self.pending.append(block)
+                offset += n
+
+    def commit(self) -> bool:
+        """
+        Records the blocks completed since the last commit as on disk. The
+        caller must have flushed them first. Returns whether every block is
+        in, in which case the journal is gone.
+        """
+        with self._lock:
+            if not self.pending:
+                return not self.remaining
+            for block in self.pending:
+                if not _test(self.bitmap, block):
+                    _set(self.bitmap, block)
+                    self.remaining -= 1
+            self.pending.clear()
+            if self.remaining:
+                self.save()
+                return False
+        with self._registry_lock:
+            self._registry.pop(self.filepath, None)
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def save(self):
+        # Written aside and renamed over the old journal so a crash leaves
+        # either the old or the new state, never a torn file.
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(
+                self.HEADER.pack(
+                    self.MAGIC,
+                    self.file_size,
+                    self.block_size,
+                    self.source_mtime,
+                    self.inode,
+                    _crc(
+                        self.file_size,
+                        self.block_size,
+                        self.source_mtime,
+                        self.inode,
+                        self.bitmap,
+                    ),
+                )
+            )
+            f.write(self.bitmap)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+
+def _crc(size, block_size, mtime, inode, bitmap) -> int:
+    header = struct.pack("!QIqQ", size, block_size, mtime, inode)
+    return zlib.crc32(bitmap, zlib.crc32(header))
+
+
+def _bitmap_size(file_size, block_size) -> int:
+    # At least a byte, so that an empty bitmap isn't mistaken for a
+    # truncated journal.
+    return -(-file_size // block_size // 8) or 1
+
+
+def _set(bitmap, bit):
+    bitmap[bit >> 3] |= 0x80 >> (bit & 7)
+
+
+def _test(bitmap, bit) -> bool:
+    return bool(bitmap[bit >> 3] & 0x80 >> (bit & 7))
+
+
+def _popcount(bitmap) -> int:
+    return bin(int.from_bytes(bitmap, "big")).count("1")
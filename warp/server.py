@@ -13,21 +13,42 @@ from os.path import expanduser
 import plac
 from rpyc.utils.server import ThreadedServer
 
-from config import logger
+from config import CONTROL_PROTOCOLS, logger
+from control import ControlServer
+from daemon import start_daemon
 from server_transfer_controller import ServerTransferController
 
 logger.setLevel("DEBUG")
 logger.propagate = True
 
 
-def main():
+@plac.annotations(
+    control=(
+        "Control protocol: binary or rpyc",
+        "option",
+        "c",
+        str,
+        CONTROL_PROTOCOLS,
+    ),
+    daemon=("Serve later sessions too, print the port and token", "flag", "d"),
+)
+def main(daemon, control="rpyc"):
     os.chdir(expanduser("~"))
-    server = ThreadedServer(
-        ServerTransferController,
-        hostname="localhost",
-        port=0,
-        protocol_config={"allow_public_attrs": True},
-    )
+    if daemon:
+        if control != "binary":
+            sys.exit("--daemon needs --control binary")
+        # The daemon may have been running already.
+        sys.stdout.write("%d %s\n" % start_daemon())
+        return
+    if control == "binary":
+        server = ControlServer(hostname="localhost", port=0)
+    else:
+        server = ThreadedServer(
+            ServerTransferController,
+            hostname="localhost",
+            port=0,
+            protocol_config={"allow_public_attrs": True},
+        )
     sys.stdout.write(str(server.port))
     sys.stdout.write("     ")
     server.start()
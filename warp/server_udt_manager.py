@@ -1,105 +1,769 @@
+import asyncio
+import hashlib
+import itertools
+import os
+import queue
 import random
 import socket
 import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
 
 from udt4py import UDTSocket
 
+from buffer_pool import BufferPool
+from bundle import BundleReader
+from compression import CODEC_MASK, decompress
 from common_tools import *
 from config import *
+from framing import FRAME_HEADER, FRAME_HOLE
+from hashing import negotiate, new_hash, zeros_digest
+from merkle import BlockTree
+from resume_journal import ResumeJournal
+
+buffer_pool = BufferPool()
+
+
+class Receiving:
+    """
+    Something the data connections of a session are writing to, and the
+    number of payload bytes written to it so far. Received data is written
+    to it by the session's WriteBehind.
+    """
+
+    def __init__(self, filepath, write_behind):
+        self.filepath = filepath
+        self.write_behind = write_behind
+        self.received = 0
+        self.failed = False
+        # Connections currently writing a frame to it.
+        self.writers = 0
+        self.changed = threading.Condition()
+
+    def write(self, data, offset):
+        raise NotImplementedError
+
+    def submit(self, buf, length, offset, flags=0, on_room=None) -> bool:
+        """
+        Queues the first length bytes of buf, the payload of a frame with
+        the given flags, to be written at offset. buf then belongs to the
+        WriteBehind, which hands it back to the buffer pool. See
+        WriteBehind.put for on_room and what is returned.
+        """
+        return self.write_behind.put(self, buf, length, offset, flags, on_room)
+
+    def punch(self, offset, length):
+        raise NotImplementedError
+
+    def submit_hole(self, offset, length, on_room=None) -> bool:
+        """
+        Queues a hole of length bytes at offset, after the data before it.
+        """
+        return self.write_behind.put(self, None, length, offset, 0, on_room)
+
+    def wrote(self, length):
+        with self.changed:
+            self.received += length
+            self.changed.notify_all()
+
+    def fail(self):
+        with self.changed:
+            self.failed = True
+            self.changed.notify_all()
+
+    def begin_frame(self):
+        with self.changed:
+            self.writers += 1
+
+    def end_frame(self):
+        with self.changed:
+            self.writers -= 1
+            self.changed.notify_all()
+
+    def close(self):
+        # No connection may be left writing to it once it is closed.
+        with self.changed:
+            self.changed.wait_for(lambda: self.writers == 0)
+
+
+class WriteBehind:
+    """
+    Writes received data to disk in a thread of its own, so the receive
+    loops go back to the network while the disk catches up. About `depth`
+    buffers wait to be written; receivers wait beyond that, so a slow disk
+    slows the senders down rather than filling up memory. A single thread
+    keeps the writes to each file in the order they were received.
+    """
+
+    def __init__(self, depth=WRITE_BEHIND_BUFFERS):
+        self.depth = depth
+        self.queue: "queue.Queue" = queue.Queue()
+        # Writes queued, and what to call once there are fewer than depth.
+        self.pending = 0
+        self.on_room: List[Callable[[], None]] = []
+        self.changed = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, receiving, buf, length, offset, flags, on_room=None) -> bool:
+        """
+        Queues a write. Without on_room, first waits while depth writes are
+        queued. With it, as the event loop must not block, queues it at once
+        and returns whether the queue is full, in which case on_room is
+        called from the writer thread once it has room again.
+        """
+        # Counted as a writer until written, so the file isn't closed with
+        # data still queued for it.
+        receiving.begin_frame()
+        with self.changed:
+            if on_room is None:
+                self.changed.wait_for(lambda: self.pending < self.depth)
+            self.pending += 1
+            full = on_room is not None and self.pending >= self.depth
+            if full:
+                self.on_room.append(on_room)
+        self.queue.put((receiving, buf, length, offset, flags))
+        return full
+
+    def taken(self):
+        with self.changed:
+            self.pending -= 1
+            self.changed.notify_all()
+            if self.pending >= self.depth:
+                return
+            on_room, self.on_room = self.on_room, []
+        for callback in on_room:
+            callback()
+
+    def run(self):
+        while (item := self.queue.get()) is not None:
+            self.taken()
+            receiving, buf, length, offset, flags = item
+            try:
+                if receiving.failed:
+                    pass
+                elif buf is None:
+                    receiving.punch(offset, length)
+                else:
+                    data = memoryview(buf)[:length]
+                    if flags & CODEC_MASK:
+                        data = decompress(flags, data)
+                    receiving.write(data, offset)
+            except Exception:
+                logger.exception("Can't write %s", receiving.filepath)
+                receiving.fail()
+            finally:
+                if buf is not None:
+                    buffer_pool.release(buf)
+                receiving.end_frame()
+
+    def close(self):
+        self.queue.put(None)
+
+
+class ReceivingFile(Receiving):
+    """
+    A file opened for writing by the data connections of a session. Data is
+    written by the session's WriteBehind and flushed according to sync, one
+    of SYNC_POLICIES. When file_size is known the file's blocks are
+    reserved up front, unless it is sparse: its holes are punched as they
+    arrive instead. With a block_size, each block is hashed with algorithm
+    as it is written, for the client to check.
+    """
+
+    def __init__(
+        self,
+        filepath,
+        write_behind,
+        sync,
+        file_size=0,
+        journal=None,
+        block_size=0,
+        algorithm="sha256",
+        sparse=False,
+    ):
+        super().__init__(filepath, write_behind)
+        self.sync = sync
+        self.fd = os.open(filepath, os.O_WRONLY)
+        self.journal: Optional[ResumeJournal] = journal
+        # Bytes received and time since the journal was last brought up
+        # to date.
+        self.unjournaled = 0
+        self.journaled_at = time.monotonic()
+        self.unsynced = 0
+        self.block_size = block_size
+        self.algorithm = algorithm
+        # Hashes of the blocks written, by block index. A block's frame is
+        # written in order, by the one WriteBehind thread.
+        self.block_hashes: Dict[int, "hashlib._Hash"] = {}
+        # Digests of the blocks received as holes.
+        self.hole_digests: Dict[int, bytes] = {}
+        if sparse:
+            return
+        # The size of a file received in order tells how far a transfer got,
+        # so it must only grow as the data lands. A file with a journal is
+        # already at its final size, the journal tells what is missing.
+        preallocate(self.fd, 0, file_size, keep_size=journal is None)
+
+    def write(self, data, offset):
+        pwrite_all(self.fd, data, offset)
+        if self.block_size:
+            block = offset // self.block_size
+            if block not in self.block_hashes:
+                self.block_hashes[block] = new_hash(self.algorithm)
+            self.block_hashes[block].update(data)
+        self.account(offset, len(data))
+
+    def punch(self, offset, length):
+        """
+        Leaves a hole of length bytes at offset: deallocated where the file
+        already extends, past its end by growing it.
+        """
+        size = os.fstat(self.fd).st_size
+        if offset < size:
+            punch_hole(self.fd, offset, min(length, size - offset))
+        if offset + length > size:
+            os.ftruncate(self.fd, offset + length)
+        if self.block_size:
+            self.hole_digests[offset // self.block_size] = zeros_digest(
+                self.algorithm, length
+            )
+        self.account(offset, length)
+
+    def account(self, offset, length):
+        """
+        Counts length bytes at offset as received, flushing as sync and the
+        journal require.
+        """
+        if self.sync == "periodic":
+            self.unsynced += length
+            if self.unsynced >= SYNC_PERIOD_BYTES:
+                os.fdatasync(self.fd)
+                self.unsynced = 0
+        if self.journal is not None:
+            self.journal.received(offset, length)
+            self.unjournaled += length
+            if (
+                self.unjournaled >= RESUME_FLUSH_BYTES
+                or time.monotonic() - self.journaled_at >= RESUME_FLUSH_SECONDS
+            ):
+                self.update_journal()
+        self.wrote(length)
+
+    def update_journal(self):
+        """
+        Flushes the file, then records the blocks completed in its journal.
+        """
+        if self.journal.pending:
+            os.fdatasync(self.fd)
+            self.unsynced = 0
+            self.journal.commit()
+        self.unjournaled = 0
+        self.journaled_at = time.monotonic()
+
+    def digest(self) -> str:
+        """
+        Returns the root of the block tree of the blocks written.
+        """
+        digests = dict(self.hole_digests)
+        for block, block_hash in self.block_hashes.items():
+            digests[block] = block_hash.digest()
+        return BlockTree(
+            [digests[block] for block in sorted(digests)], self.algorithm
+        ).root
+
+    def close(self):
+        # The descriptor could be reused for another file as soon as it is
+        # closed, so wait for the writers first.
+        super().close()
+        try:
+            # What arrived before a failure is kept for the transfer to
+            # resume from.
+            if self.journal is not None:
+                self.update_journal()
+            if self.sync != "none" and not self.failed:
+                os.fdatasync(self.fd)
+        finally:
+            os.close(self.fd)
+
+
+class ReceivingBundle(Receiving):
+    """
+    A bundle of small files being unpacked as its frames arrive.
+    """
+
+    def __init__(self, dest_root, write_behind, copy_status, verify, sync, algorithm):
+        super().__init__(dest_root, write_behind)
+        self.reader = BundleReader(dest_root, copy_status, verify, sync, algorithm)
+
+    def write(self, data, offset):
+        if offset != self.received:
+            raise ConnectionError("Bundle frames out of order")
+        self.reader.feed(data)
+        self.wrote(len(data))
+
+    def close(self):
+        super().close()
+        self.reader.close()
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    One TCP data connection, received on the session's event loop: the
+    nonce, then frames whose payload is received straight into pooled
+    buffers and handed to the WriteBehind. A connection whose payload
+    fills the write-behind queue pauses reading until the queue has room,
+    so while the disk is behind, the loop goes on with the others.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.transport = None
+        self.verified = False
+        # The buffer being received into, and how much of it is filled.
+        self.buf = bytearray(NONCE_SIZE)
+        self.view = memoryview(self.buf)
+        self.filled = 0
+        # The frame being received and what of its payload is still to come.
+        self.receiving: Optional[Receiving] = None
+        self.flags = 0
+        self.offset = 0
+        self.remaining = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.manager.connections.add(transport)
+        logger.info("Connected by %s", transport.get_extra_info("peername"))
+
+    def get_buffer(self, sizehint):
+        return self.view[self.filled :]
+
+    def buffer_updated(self, nbytes):
+        self.filled += nbytes
+        if self.filled < len(self.view):
+            return
+        try:
+            if not self.verified:
+                self.verify_nonce()
+            elif self.receiving is None:
+                self.begin_frame()
+            else:
+                self.payload_received()
+        except Exception:
+            logger.exception("Data connection failed")
+            self.transport.abort()
+
+    def verify_nonce(self):
+        nonce = self.buf.decode(errors="replace")
+        if nonce != self.manager.nonce:
+            logger.error(
+                "Received nonce %s doesn't match %s.",
+                nonce,
+                self.manager.nonce,
+            )
+            self.transport.close()
+            return
+        logger.debug("Nonce verified.")
+        self.verified = True
+        self.expect(bytearray(FRAME_HEADER.size))
+
+    def begin_frame(self):
+        kind, flags, file_id, offset, length = FRAME_HEADER.unpack(self.buf)
+        with self.manager.files_lock:
+            receiving = self.manager.files[file_id]
+        if kind == FRAME_HOLE:
+            if self.manager.submit_hole(receiving, file_id, offset, length, self.room):
+                self.transport.pause_reading()
+            self.expect(bytearray(FRAME_HEADER.size))
+            return
+        receiving.begin_frame()
+        self.receiving = receiving
+        self.flags, self.offset, self.remaining = flags, offset, length
+        self.next_payload()
+
+    def next_payload(self):
+        if not self.remaining:
+            self.receiving.end_frame()
+            self.receiving = None
+            self.expect(bytearray(FRAME_HEADER.size))
+        elif self.flags & CODEC_MASK:
+            # Compressed payloads are decompressed whole.
+            self.expect(bytearray(self.remaining))
+        else:
+            buf = buffer_pool.acquire()
+            self.expect(buf, min(self.remaining, len(buf)))
+
+    def payload_received(self):
+        buf, length = self.buf, len(self.view)
+        # The buffer is the WriteBehind's now.
+        self.expect(bytearray(0))
+        if self.receiving.submit(buf, length, self.offset, self.flags, self.room):
+            self.transport.pause_reading()
+        self.offset += length
+        self.remaining -= length
+        self.next_payload()
+
+    def room(self):
+        # From the writer thread, once the write-behind queue has room.
+        try:
+            self.manager.loop.call_soon_threadsafe(self.resume)
+        except RuntimeError:
+            # The loop was closed with the session.
+            pass
+
+    def resume(self):
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def expect(self, buf, length=None):
+        self.buf = buf
+        self.view = memoryview(buf)[:length]
+        self.filled = 0
+
+    def connection_lost(self, exc):
+        self.manager.connections.discard(self.transport)
+        if self.receiving is not None:
+            logger.error("Data connection closed mid-frame: %s", exc)
+            self.receiving.fail()
+            self.receiving.end_frame()
+            self.receiving = None
+        elif self.filled and self.verified:
+            logger.error("Data connection closed mid-frame header")
+        buffer_pool.release(self.buf)
 
 
 class ServerUDTManager:
-    def __init__(self, tcp_mode):
+    """
+    The data side of a session: a single listening socket that accepts the
+    session's data connections, all authenticated with the same nonce, and
+    the files they are writing to. Connections carry frames (see framing.py)
+    so any of them can carry data for any open file. TCP connections are all
+    received by one event loop (see FrameProtocol); UDT sockets only block,
+    so each UDT connection gets a thread.
+    """
+
+    def __init__(self, tcp_mode, sync="none", hash_algorithm="sha256"):
         self.tcp_mode = tcp_mode
+        if sync not in SYNC_POLICIES:
+            raise ValueError("Unknown sync policy " + sync)
+        self.sync = sync
+        # Hash algorithm of the session, see hashing.py.
+        self.hash_algorithm = negotiate((hash_algorithm,))
 
         self.udt_sock = None
-        self.conn = None
+        self.closed = False
 
         self.sock = self.get_socket()
         self.port = self.sock.getsockname()[1]
         self.nonce = self.generate_nonce()
-        self.size = 0
+
+        self.files: Dict[int, Receiving] = {}
+        self.files_lock = threading.Lock()
+        self.file_ids = itertools.count(1)
+        self.write_behind = WriteBehind()
+        # In TCP mode, the loop receiving all the data connections, and
+        # their transports. In UDT mode, the connections being received.
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.connections: Set[asyncio.BaseTransport] = set()
+        self.udt_connections: Set[UDTSocket] = set()
+        self.listening_thread: Optional[threading.Thread] = None
 
     def open_connection(self):
         if not self.tcp_mode:
             self.udt_sock = UDTSocket()
             self.udt_sock.bind(self.sock.fileno())
             self.udt_sock.listen()
+            target = self.accept_connections
+        else:
+            self.loop = asyncio.new_event_loop()
+            target = self.serve
 
-        listening_thread = threading.Thread(target=self.accept_and_verify)
-        listening_thread.start()
+        self.listening_thread = threading.Thread(target=target)
+        self.listening_thread.daemon = True
+        self.listening_thread.start()
 
         return (self.port, self.nonce)
 
-    def get_total_recieved(self):
-        return self.size
+    def serve(self):
+        """
+        Runs the event loop that accepts and receives the TCP data
+        connections of the session, until the session is closed.
+        """
+        loop = self.loop
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(
+            loop.create_server(lambda: FrameProtocol(self), sock=self.sock)
+        )
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            for transport in list(self.connections):
+                transport.abort()
+            # Lets the aborted connections run connection_lost.
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
 
-    def accept_and_verify(self):
-        if not self.tcp_mode:
-            self.conn, addr = self.udt_sock.accept()
-            logger.info("Connected by %s", addr)
+    def open_file(self, filepath, file_size=0, block_size=0, sparse=False) -> int:
+        """
+        Opens filepath to be written by the data connections and returns the
+        file id its frames are tagged with. file_size is the size the file
+        will have once received, if known. Each block of block_size bytes
+        received is hashed, unless block_size is 0. A sparse file isn't
+        preallocated, so its holes stay holes.
+        """
+        return self.add_receiving(
+            ReceivingFile(
+                filepath,
+                self.write_behind,
+                self.sync,
+                file_size,
+                ResumeJournal.opened(filepath, file_size),
+                block_size,
+                self.hash_algorithm,
+                sparse,
+            )
+        )
 
-            recvd_nonce = bytearray(NONCE_SIZE)
-            self.conn.recv(recvd_nonce)
-            recvd_nonce = str(recvd_nonce)
-        else:
-            self.conn, addr = self.sock.accept()
-            logger.info("Connected by %s", addr)
+    def open_bundle(self, dest_root, copy_status, verify) -> int:
+        """
+        Prepares to unpack a bundle of small files under dest_root and returns
+        the id its frames are tagged with.
+        """
+        return self.add_receiving(
+            ReceivingBundle(
+                dest_root,
+                self.write_behind,
+                copy_status,
+                verify,
+                self.sync,
+                self.hash_algorithm,
+            )
+        )
 
-            recvd_nonce = self.conn.recv(NONCE_SIZE)
+    def add_receiving(self, receiving) -> int:
+        with self.files_lock:
+            file_id = next(self.file_ids)
+            self.files[file_id] = receiving
+        return file_id
+
+    def finish_file(self, file_id, expected_size):
+        """
+        Waits for the data of the file, see close_receiving. Returns whether
+        all of it arrived and, if its blocks were hashed, the root of their
+        block tree.
+        """
+        receiving, received = self.close_receiving(file_id, expected_size)
+        if received and receiving.block_size:
+            return True, receiving.digest()
+        return received, None
 
-        if recvd_nonce != self.nonce:
-            fail(
-                format(
-                    "Received nonce %s doesn't match %s.",
-                    recvd_nonce,
-                    self.nonce,
-                )
+    def close_receiving(self, file_id, expected_size):
+        """
+        Waits until expected_size bytes have been written to the file, or a
+        connection carrying its data failed, then closes it. Returns it and
+        whether all the data arrived.
+        """
+        with self.files_lock:
+            receiving = self.files[file_id]
+        with receiving.changed:
+            receiving.changed.wait_for(
+                lambda: receiving.received >= expected_size
+                or receiving.failed
+                or self.closed
             )
+        with self.files_lock:
+            if self.files.pop(file_id, None) is None:
+                # Closed with the session, see close.
+                return receiving, False
+        receiving.close()
+        return (
+            receiving,
+            receiving.received == expected_size and not receiving.failed,
+        )
 
-        logger.debug("Nonce verified.")
+    def finish_bundle(self, bundle_id, stream_size):
+        """
+        Waits for the stream_size bytes of the bundle and commits its files.
+        Returns the result of each file (see BundleReader), or None if the
+        stream did not all arrive.
+        """
+        receiving, received = self.close_receiving(bundle_id, stream_size)
+        if not received:
+            return None
+        return tuple(receiving.reader.results)
 
-    def receive_data(self, output_file, block_count, file_size):
+    def abort_file(self, file_id):
         """
-        Receives data and writes it to disk, stops when it is no longer receiving
-        data.
+        Gives up on a file the client could not send all the data of.
         """
+        with self.files_lock:
+            receiving = self.files[file_id]
+        receiving.fail()
+        self.close_receiving(file_id, 0)
+
+    def get_total_recieved(self, file_id):
+        with self.files_lock:
+            receiving = self.files.get(file_id)
+        return receiving.received if receiving is not None else 0
+
+    def get_all_received(self):
+        """
+        Returns (file id, bytes received) for every open file, so a client
+        can poll the progress of all its files in one call.
+        """
+        with self.files_lock:
+            return tuple(
+                (file_id, receiving.received)
+                for file_id, receiving in self.files.items()
+            )
+
+    def accept_connections(self):
+        while not self.closed:
+            try:
+                conn, addr = self.udt_sock.accept()
+            except (OSError, RuntimeError):
+                if self.closed:
+                    return
+                raise
+            logger.info("Connected by %s", addr)
+            thread = threading.Thread(target=self.verify_and_receive, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def verify_and_receive(self, conn):
+        recvd_nonce = bytearray(NONCE_SIZE)
+        if not self.recv_exactly(conn, memoryview(recvd_nonce)):
+            conn.close()
+            return
+        if recvd_nonce.decode(errors="replace") != self.nonce:
+            logger.error(
+                "Received nonce %s doesn't match %s.",
+                recvd_nonce.decode(errors="replace"),
+                self.nonce,
+            )
+            conn.close()
+            return
 
-        def receive_data_threaded(output_file, block_count, file_size):
-            logger.debug("Receiving data...")
-            output_file = open(output_file, "r+")
-            output_file.seek(block_count * CHUNK_SIZE)
+        logger.debug("Nonce verified.")
+        self.udt_connections.add(conn)
+        try:
+            self.receive_frames(conn)
+        finally:
+            self.udt_connections.discard(conn)
+            conn.close()
 
-            self.size = block_count * CHUNK_SIZE
-            data = bytearray(CHUNK_SIZE)
+    def receive_frames(self, conn):
+        """
+        Receives frames until the client closes the connection, writing their
+        payload to the files they are tagged with.
+        """
+        header = bytearray(FRAME_HEADER.size)
+        receiving = None
+        try:
+            while self.recv_exactly(conn, memoryview(header)):
+                kind, flags, file_id, offset, length = FRAME_HEADER.unpack(header)
+                with self.files_lock:
+                    receiving = self.files[file_id]
+                if kind == FRAME_HOLE:
+                    self.submit_hole(receiving, file_id, offset, length)
+                    receiving = None
+                    continue
+                receiving.begin_frame()
+                try:
+                    # Receives are gathered in pooled buffers handed to the
+                    # disk once full, so the disk sees large writes.
+                    # Compressed payloads are decompressed whole.
+                    while length:
+                        if flags & CODEC_MASK:
+                            buf = bytearray(length)
+                        else:
+                            buf = buffer_pool.acquire()
+                        n = min(length, len(buf))
+                        try:
+                            received = self.recv_exactly(conn, memoryview(buf)[:n])
+                        except BaseException:
+                            buffer_pool.release(buf)
+                            raise
+                        if not received:
+                            buffer_pool.release(buf)
+                            raise ConnectionError("Closed mid-frame")
+                        receiving.submit(buf, n, offset, flags)
+                        offset += n
+                        length -= n
+                finally:
+                    receiving.end_frame()
+                receiving = None
+        except Exception:
+            logger.exception("Data connection failed")
+            if receiving is not None:
+                receiving.fail()
 
-            if not self.tcp_mode:
-                while 1:
-                    len_rec = self.conn.recv(data)
-                    data = str(data)
-                    output_file.write(data[:len_rec])
-                    self.size += len_rec
+    def submit_hole(self, receiving, file_id, offset, length, on_room=None) -> bool:
+        """
+        Queues the hole of a FRAME_HOLE frame for file_id, see
+        Receiving.submit_hole. Bundles have no holes: the bundle fails, but
+        as the frame has no payload, the connection goes on with the next
+        frame.
+        """
+        if isinstance(receiving, ReceivingBundle):
+            logger.error(
+                "Protocol error: hole frame for bundle %d, failing it",
+                file_id,
+            )
+            receiving.fail()
+            return False
+        return receiving.submit_hole(offset, length, on_room)
 
-                    if len_rec == 0 or str(self.size) == str(file_size):
-                        break
+    def recv_exactly(self, conn, view) -> bool:
+        """
+        Fills view from conn. Returns False if the connection was closed before
+        anything was received, raises ConnectionError if it was closed part
+        way.
+        """
+        filled = 0
+        while filled < len(view):
+            if self.tcp_mode:
+                len_rec = conn.recv_into(view[filled:])
             else:
-                while 1:
-                    data = self.conn.recv(CHUNK_SIZE)
-                    output_file.write(data)
-                    self.size += len(data)
-                    if len(data) == 0:
-                        break
-
-            logger.debug("Closing file...  " + output_file.name)
-            output_file.close()
-
-        thread = threading.Thread(
-            target=receive_data_threaded,
-            args=(output_file, block_count, file_size),
-        )
-        thread.start()
+                len_rec = conn.recv(view[filled:])
+            if len_rec == 0:
+                if filled == 0:
+                    return False
+                raise ConnectionError("Data connection closed mid-frame")
+            filled += len_rec
+        return True
 
-        return thread
+    def close(self):
+        """
+        Ends the session: stops receiving, writes what was received, then
+        closes the files still open, flushed as sync requires and with their
+        journal up to date, so their transfer can resume from there.
+        """
+        self.closed = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            # Its connections are aborted before it returns, so none is
+            # left writing a frame.
+            if self.listening_thread is not None:
+                self.listening_thread.join()
+        else:
+            self.sock.close()
+            for conn in list(self.udt_connections):
+                conn.close()
+        with self.files_lock:
+            files = list(self.files.values())
+            self.files.clear()
+        for receiving in files:
+            try:
+                # Waits for the WriteBehind to write what is queued for it.
+                receiving.close()
+            except Exception:
+                logger.exception("Can't close %s", receiving.filepath)
+            # Wakes up close_receiving.
+            receiving.fail()
+        self.write_behind.close()
 
     def get_socket(self):
         """
@@ -120,7 +784,7 @@ class ServerUDTManager:
         try:
             s.bind(("", 0))
             if self.tcp_mode:
-                s.listen(1)
+                s.listen(DATA_CONNECTIONS_BACKLOG)
         except socket.error as msg:
             s.close()
             fail(str(msg))
@@ -1,14 +1,25 @@
 import os
+import shutil
 import sys
-from typing import AnyStr, Tuple
+import threading
+from typing import Dict, Optional, Tuple
 
-from common_tools import getHash
-from config import CHUNK_SIZE, logger
+from bundle import PART_SUFFIX
+from common_tools import choose_block_size, getHash
+from config import MAX_BLOCK_SIZE, MIN_BLOCK_SIZE, logger
+from delta import apply_delta, signature
+from hashing import negotiate
+from merkle import BlockTree
+from resume_journal import ResumeJournal
 
 
 class TransferManager:
     def __init__(self):
-        pass
+        # Hash algorithm of the session, see hashing.py.
+        self.hash_algorithm = "sha256"
+        # Block trees of files being compared with the client's copy.
+        self._trees: Dict[str, BlockTree] = {}
+        self._trees_lock = threading.Lock()
 
     def __del__(self):
         pass
@@ -16,11 +27,118 @@ class TransferManager:
     def is_file(self, filepath):
         return os.path.isfile(filepath)
 
+    def negotiate_hash(self, proposed) -> str:
+        """
+        Picks the hash algorithm of the session among those the client
+        proposed, preferred first.
+        """
+        self.hash_algorithm = negotiate(proposed)
+        return self.hash_algorithm
+
     def get_file_hash(self, filepath):
-        return getHash(filepath)
+        return getHash(filepath, self.hash_algorithm)
+
+    def get_block_tree_root(self, filepath, block_size, length) -> str:
+        """
+        Builds the hash tree of the first length bytes of filepath in blocks
+        of block_size, and returns its root. The tree is kept for
+        get_block_tree_nodes until drop_block_tree.
+        """
+        tree = BlockTree.from_file(filepath, block_size, length, self.hash_algorithm)
+        with self._trees_lock:
+            self._trees[filepath] = tree
+        return tree.root
+
+    def get_block_tree_nodes(self, filepath, level, indices) -> Tuple[str, ...]:
+        with self._trees_lock:
+            tree = self._trees[filepath]
+        return tree.nodes(level, indices)
+
+    def drop_block_tree(self, filepath):
+        with self._trees_lock:
+            self._trees.pop(filepath, None)
 
-    def get_blocks(self, filepath: AnyStr) -> float:
-        return os.path.getsize(filepath) / CHUNK_SIZE
+    def truncate_file(self, filepath, size):
+        os.truncate(filepath, size)
+
+    def get_delta_signature(self, filepath, block_size) -> bytes:
+        return signature(filepath, block_size, self.hash_algorithm)
+
+    def apply_delta(self, filepath, copies, size):
+        """
+        Rebuilds filepath in place from the blocks the client reuses, see
+        delta.py. The client then sends the rest.
+        """
+        apply_delta(filepath, copies, size)
+
+    def negotiate_block_size(self, proposed: int) -> int:
+        """
+        Returns the block size to use for a transfer: the size the client
+        proposed, clamped to the bounds this server accepts.
+        """
+        return max(MIN_BLOCK_SIZE, min(int(proposed), MAX_BLOCK_SIZE))
+
+    def get_missing_ranges(
+        self, filepath, file_size, source_mtime
+    ) -> Optional[Tuple[int, Tuple[Tuple[int, int], ...]]]:
+        """
+        Returns the block size of the unfinished transfer of filepath from a
+        source of file_size bytes modified at source_mtime (ns), and the
+        (offset, length) ranges of blocks it still has to receive. None if
+        there is no journal of such a transfer.
+        """
+        journal = ResumeJournal.load(filepath, file_size, source_mtime)
+        if journal is None:
+            return None
+        return journal.block_size, tuple(journal.missing())
+
+    def start_resumable_file(
+        self, filepath, file_size, block_size, source_mtime, done=0
+    ) -> Tuple[Tuple[int, int], ...]:
+        """
+        Prepares filepath to receive file_size bytes written at their
+        offsets, keeping its first done bytes, and journals the blocks
+        received (see resume_journal.py). Returns the ranges missing.
+        """
+        os.truncate(filepath, file_size)
+        journal = ResumeJournal.create(
+            filepath, file_size, block_size, source_mtime, done
+        )
+        return tuple(journal.missing())
+
+    def link_files(self, links) -> Tuple[bool, ...]:
+        """
+        Makes the destination of each of links, (source, destination, hard
+        link or not, (atime, mtime, mode) or None) tuples, a hard link to or
+        a copy of its source, a file already received. A hard link that
+        can't be made is copied instead, and copies are given the times and
+        mode if any. Returns whether each destination was made.
+        """
+        results = []
+        for source, dest, hardlink, status in links:
+            part_path = dest + PART_SUFFIX
+            try:
+                os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+                if os.path.lexists(part_path):
+                    os.remove(part_path)
+                if hardlink:
+                    try:
+                        os.link(source, part_path)
+                    except OSError as e:
+                        logger.debug("Copying %s instead: %s", source, e)
+                        hardlink = False
+                if not hardlink:
+                    shutil.copyfile(source, part_path)
+                    if status is not None:
+                        atime, mtime, mode = status
+                        os.utime(part_path, (atime, mtime))
+                        os.chmod(part_path, mode)
+                os.replace(part_path, dest)
+                results.append(True)
+            except OSError:
+                logger.exception("Can't make %s from %s", dest, source)
+                results.append(False)
+        return tuple(results)
 
     def create_dir(self, directory):
         if not os.path.exists(directory):
@@ -41,6 +159,62 @@ class TransferManager:
     def set_protection(self, filepath, bits):
         os.chmod(filepath, bits)
 
+    def prepare_files(
+        self, records
+    ) -> Tuple[Tuple[bool, str, int, int, Optional[str]], ...]:
+        """
+        Prepares a batch of files to be received, in one round trip rather
+        than several per file. records are (destination, client path,
+        create directories, size, proposed block size) tuples, see
+        validate_filepath and negotiate_block_size. Returns for each whether
+        its destination is valid, its path (or why not), the size of the
+        copy already there (an empty one is created if none), the block
+        size, and the root of the block tree of a copy of the same size if
+        it is in the hash cache.
+
+        A copy of the same size is likely complete, its block size depends
+        on the size alone so that the cached tree of an earlier comparison
+        is found again.
+        """
+        results = []
+        for dest, client_path, create_dirs, size, block_size in records:
+            valid, path = self.validate_filepath(dest, client_path, create_dirs)
+            if not valid:
+                results.append((False, path, 0, 0, None))
+                continue
+            try:
+                existing = self.get_size_and_init_file_path(path)
+            except OSError as e:
+                logger.error("Can't create %s: %s", path, e)
+                results.append((False, str(e), 0, 0, None))
+                continue
+            root = None
+            if existing and existing == size:
+                block_size = self.negotiate_block_size(choose_block_size(size))
+                root = BlockTree.cached_root(
+                    path, block_size, size, self.hash_algorithm
+                )
+            else:
+                block_size = self.negotiate_block_size(block_size)
+            results.append((True, path, existing, block_size, root))
+        return tuple(results)
+
+    def commit_files(self, records) -> Tuple[bool, ...]:
+        """
+        Sets the times and mode of a batch of received files, (path, atime,
+        mtime, mode) tuples. Returns whether each could be set.
+        """
+        results = []
+        for path, atime, mtime, mode in records:
+            try:
+                os.utime(path, (atime, mtime))
+                os.chmod(path, mode)
+                results.append(True)
+            except OSError as e:
+                logger.error("Can't set the status of %s: %s", path, e)
+                results.append(False)
+        return tuple(results)
+
     def get_size_and_init_file_path(self, filepath):
         if not os.path.isfile(filepath):
             output_file = open(filepath, "w")
@@ -5,6 +5,7 @@ This is the main driver script that will run on the client.
 """
 
 import logging
+import signal
 import sys
 import time
 
@@ -12,8 +13,11 @@ import mock
 import plac
 
 from client_transfer_controller import ClientTransferController
-from config import logger
+from common_tools import fail, parse_size
+from compression import parse_compression
+from config import CONTROL_PROTOCOLS, SYNC_POLICIES, logger
 from connection import Connection
+from manifest import read_manifest, write_report
 from progress import WarpInterface
 
 gui = WarpInterface()
@@ -28,25 +32,92 @@ gui = WarpInterface()
     timer=("Time transfer", "flag", "T"),
     follow_links=("Follow symbolic links", "flag", "L"),
     copy_status=("Copy file permissions/timestamps", "flag", "s"),
+    stripes=("Connections used for each large file", "option", "S", int),
+    bundle=("Bundle files smaller than this many bytes", "option", "B", int),
+    compress=("Compress data: zlib, bz2 or lzma[:level]", "option", "z"),
+    bwlimit=("Cap the send rate in bytes/s, e.g. 50M", "option", "l"),
+    use_mmap=("Read files through mmap (they mustn't shrink)", "flag", "m"),
+    sync=(
+        "Flush received files: none, end or periodic",
+        "option",
+        "y",
+        str,
+        SYNC_POLICIES,
+    ),
+    processes=("Worker processes sending the data", "option", "P", int),
+    delta=("Only send what changed in files the server has", "flag", "D"),
+    dedup=("Send duplicate files once, link or copy the rest", "flag", "H"),
+    control=(
+        "Control protocol: rpyc (default) or binary",
+        "option",
+        "C",
+        str,
+        CONTROL_PROTOCOLS,
+    ),
+    persist=(
+        "Keep the SSH session and server this many seconds for later runs",
+        "option",
+        "K",
+        int,
+    ),
+    manifest=(
+        "Send the source<TAB>destination lines of this file, - for stdin",
+        "option",
+        "M",
+    ),
 )
 def main(
     remote_host,
     recursive,
-    file_src,
-    file_dest,
     tcp_mode,
     disable_verify,
     timer,
     follow_links,
     copy_status,
+    use_mmap,
+    delta,
+    dedup,
+    file_src=None,
+    file_dest=None,
     verbose=False,
     parallelism=3,
+    stripes=1,
+    bundle=0,
+    compress=None,
+    bwlimit="0",
+    sync="none",
+    processes=0,
+    control="rpyc",
+    persist=0,
+    manifest=None,
 ):
     if verbose:
         logger.setLevel(logging.DEBUG)
         global gui
         gui = mock.Mock()
     startTime = time.time()
+    compression = None
+    if compress:
+        try:
+            compression = parse_compression(compress)
+        except ValueError as e:
+            fail(str(e))
+    try:
+        rate = parse_size(bwlimit)
+    except ValueError:
+        fail("Invalid --bwlimit " + bwlimit)
+    if persist and control != "binary":
+        fail("--persist needs --control binary")
+    entries = None
+    if manifest is not None:
+        if file_src is not None:
+            fail("Give either a manifest or a source and a destination")
+        try:
+            entries = read_manifest(manifest)
+        except (OSError, ValueError) as e:
+            fail(str(e))
+    elif file_src is None or file_dest is None:
+        fail("Source and destination required")
     # Extract the username and hostname from the arguments,
     # the ssh_port does not need to be specified, will default to 22.
     username, hostname, ssh_port = Connection.unpack_remote_host(remote_host)
@@ -57,7 +128,11 @@ def main(
     # Start an ssh connection used by the xmlrpc connection.
     # the comm_port is used for port forwarding.
     connection = Connection(
-        hostname=hostname, username=username, ssh_port=ssh_port
+        hostname=hostname,
+        username=username,
+        ssh_port=ssh_port,
+        control=control,
+        persist=persist,
     )
     # get the rpc channel
     channel = connection.connect()
@@ -73,14 +148,30 @@ def main(
         parallelism,
         follow_links,
         copy_status,
+        stripes,
+        bundle,
+        compression,
+        rate,
+        use_mmap,
+        sync,
+        processes,
+        delta,
+        dedup,
+        entries,
     )
+    # The cap can be lowered and raised while the transfer runs: SIGUSR1
+    # halves it, SIGUSR2 doubles it.
+    signal.signal(signal.SIGUSR1, lambda *_: controller.pacer.scale(0.5))
+    signal.signal(signal.SIGUSR2, lambda *_: controller.pacer.scale(2))
 
     logger.debug("Starting transfer")
     gui.log_message("Starting transfer")
 
     start_thread = controller.start()
 
-    gui.files_processed_indicator.set_update(lambda: controller.files_processed)
+    gui.files_processed_indicator.set_update(
+        lambda: controller.files_processed
+    )
     gui.files_sent_indicator.set_update(
         lambda: controller.get_files_transfered()
     )
@@ -114,6 +205,8 @@ def main(
     gui.exit()
     if timer:
         logger.info("Total time: " + str(time.time() - startTime))
+    if entries is not None:
+        write_report(controller.entry_results(), sys.stdout)
     if success:
         print("Successfully transfered")
     else: